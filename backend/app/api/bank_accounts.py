@@ -1,9 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from typing import List
 from pydantic import BaseModel
 
 from app.core.supabase_client import get_supabase
 from app.core.auth import get_current_user
+from app.core.cache import cached_json_response
 
 router = APIRouter()
 
@@ -16,9 +17,14 @@ class GetBankAccountsResponse(BaseModel):
     logo: str
 
 @router.get("/", response_model=List[GetBankAccountsResponse])
-async def get_bank_accounts(user_id: str = Depends(get_current_user)) -> List[GetBankAccountsResponse]:
+async def list_bank_accounts(request: Request, user_id: str = Depends(get_current_user)):
+    return await cached_json_response(
+        request, user_id, lambda: get_bank_accounts(user_id), List[GetBankAccountsResponse]
+    )
+
+async def get_bank_accounts(user_id: str) -> List[GetBankAccountsResponse]:
     supabase = await get_supabase()
-    result = await supabase.table('gocardless_accounts').select('*').eq('user_id', user_id).execute()
+    result = await supabase.table('gocardless_accounts').select('results, logo').eq('user_id', user_id).execute()
     
     transformed_accounts = [
         GetBankAccountsResponse(
@@ -31,7 +37,6 @@ async def get_bank_accounts(user_id: str = Depends(get_current_user)) -> List[Ge
         )
         for account in result.data
     ]
-    print(transformed_accounts)
     return transformed_accounts
 
 
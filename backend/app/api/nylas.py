@@ -1,7 +1,8 @@
-from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, Request, Header
+from fastapi import APIRouter, HTTPException, Depends, Request, Header
 from fastapi.responses import JSONResponse, RedirectResponse
 from typing import Dict, Optional, List
 import logging, os, hmac, hashlib
+import orjson
 from datetime import datetime
 
 from nylas.models.auth import URLForAuthenticationConfig, CodeExchangeRequest
@@ -12,6 +13,7 @@ from app.core.nylas_client import get_nylas_client
 from app.core.openai_client import get_openai_client
 from app.core.auth import get_current_user
 from app.services.nylas import store_nylas_credentials, get_nylas_credentials, EmailAssistant
+from app.services.webhook_queue import WebhookQueue
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -46,19 +48,34 @@ def verify_webhook_signature(
     
     return hmac.compare_digest(computed_signature, signature)
 
+async def process_webhook_event(webhook_data: Dict):
+    """Run one queued webhook event through the email assistant"""
+    assistant = EmailAssistant(get_nylas_client(), await get_supabase(), get_openai_client())
+    await assistant.process_incoming_email(webhook_data)
+
+# Webhook events are acknowledged as soon as they are queued; the work runs on
+# the queue's workers with retries (app/services/webhook_queue.py)
+webhook_queue = WebhookQueue("nylas", process_webhook_event, get_client=get_supabase)
+
+def webhook_event_key(webhook_data: Dict, raw_body: bytes) -> str:
+    """Deduplication key: event type and message id, so Nylas redeliveries of a message collapse"""
+    event_type = webhook_data.get("type", "unknown")
+    data_object = (webhook_data.get("data") or {}).get("object") or {}
+    message_id = webhook_data.get("message_id") or data_object.get("id")
+    if message_id:
+        return f"{event_type}:{message_id}"
+    if webhook_data.get("id"):
+        return f"{event_type}:{webhook_data['id']}"
+    return f"{event_type}:{hashlib.sha256(raw_body).hexdigest()}"
+
 @router.api_route("/webhook", methods=["GET", "POST"])
 async def nylas_webhook(
     request: Request,
-    background_tasks: BackgroundTasks,
-    nylas_client=Depends(get_nylas_client),
-    supabase=Depends(get_supabase),
-    openai_client=Depends(get_openai_client),
     x_nylas_signature: Optional[str] = Header(None)
 ):
     """Handle Nylas webhooks for email processing"""
     try:
-        # Log request details for debugging
-        logger.info(f"Received webhook request: Method={request.method}, Headers={dict(request.headers)}")
+        logger.debug(f"Received webhook request: Method={request.method}, Headers={dict(request.headers)}")
         
         # Handle webhook challenge (GET request with challenge)
         if request.method == "GET" and request.query_params.get("challenge"):
@@ -75,36 +92,37 @@ async def nylas_webhook(
         if request.method == "POST":
             # Get raw request body for signature verification
             raw_body = await request.body()
-            logger.info(f"Received webhook body: {raw_body.decode('utf-8', errors='replace')}")
-            
-            # Log signature information
-            logger.info(f"Webhook signature: {x_nylas_signature}")
-            logger.info(f"Webhook secret configured: {'Yes' if nylas_config['webhook_secret'] else 'No'}")
+            logger.debug(f"Received webhook body: {raw_body.decode('utf-8', errors='replace')}")
             
-            # TEMPORARILY DISABLED FOR TESTING
-            # Verify webhook signature
-            # if not verify_webhook_signature(
-            #     raw_body,
-            #     x_nylas_signature,
-            #     nylas_config["webhook_secret"]
-            # ):
-            #     logger.error("Invalid webhook signature")
-            #     raise HTTPException(status_code=401, detail="Invalid signature")
+            if nylas_config["webhook_secret"]:
+                if not verify_webhook_signature(raw_body, x_nylas_signature, nylas_config["webhook_secret"]):
+                    logger.error("Invalid webhook signature")
+                    return JSONResponse(status_code=401, content={"detail": "Invalid signature"})
+            else:
+                logger.warning("NYLAS_WEBHOOK_SECRET is not set; accepting webhook without signature verification")
                 
             # Parse webhook data
-            webhook_data = await request.json()
-            logger.info(f"Received webhook type: {webhook_data.get('type', 'unknown')}")
-            logger.info(f"Webhook data: {webhook_data}")
+            try:
+                webhook_data = orjson.loads(raw_body)
+            except orjson.JSONDecodeError:
+                webhook_data = None
+            if not isinstance(webhook_data, dict):
+                return JSONResponse(status_code=400, content={"detail": "Invalid JSON body"})
+            webhook_type = webhook_data.get('type', 'unknown')
             
-            # Process webhook in background
-            assistant = EmailAssistant(nylas_client, supabase, openai_client)
-            background_tasks.add_task(
-                assistant.process_incoming_email,
-                webhook_data
-            )
+            key = webhook_event_key(webhook_data, raw_body)
+            outcome = webhook_queue.submit(key, webhook_data)
+            if outcome == "full":
+                # Nylas retries non-2xx deliveries, so shed load rather than buffer
+                logger.warning(f"Webhook queue full, rejecting {key}")
+                return JSONResponse(
+                    status_code=503,
+                    content={"detail": "Webhook queue is full"},
+                    headers={"Retry-After": "30"}
+                )
             
-            logger.info("Successfully queued webhook for processing")
-            return {"status": "processing", "webhook_type": webhook_data.get('type', 'unknown')}
+            logger.info(f"Webhook {key} {outcome}")
+            return {"status": outcome, "webhook_type": webhook_type}
         
         # If neither GET nor POST, return method not allowed
         logger.warning(f"Unsupported method: {request.method}")
@@ -128,7 +146,7 @@ async def nylas_webhook(
 @router.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy"}
+    return {"status": "healthy", "webhook_queue": webhook_queue.metrics()}
 
 @router.get("/auth")
 async def nylas_auth(
@@ -314,7 +332,7 @@ async def delete_webhook(
     """Delete a webhook"""
     try:
         # Check if webhook belongs to user
-        result = await supabase.table('nylas_webhooks').select('*').eq('webhook_id', webhook_id).eq('user_id', user_id).execute()
+        result = await supabase.table('nylas_webhooks').select('webhook_id').eq('webhook_id', webhook_id).eq('user_id', user_id).execute()
         if not result.data:
             raise HTTPException(status_code=404, detail="Webhook not found")
             
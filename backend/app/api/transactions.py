@@ -1,15 +1,25 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 import os
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional
 import logging
 
 from fastapi.responses import StreamingResponse
 
 from app.core.supabase_client import get_supabase
 from app.core.auth import get_current_user
-from app.schemas.transactions import GetTransactions, Insights
+from app.core.cache import cached_json_response, invalidate_user
+from app.schemas.transactions import (
+    AnalyticsInsights,
+    CashFlowMonth,
+    CategoryTrend,
+    GetTransactions,
+    GetTransactionsPage,
+    Insights,
+    RecurringVendor,
+)
+from app.services.export import ExportFormat, export_filename, export_media_type
 from app.services.transactions import TransactionService
 
 load_dotenv()
@@ -44,22 +54,57 @@ async def create_transaction(
 
 @router.get("/", response_model=GetTransactions)
 async def get_transactions(
+    request: Request,
     user_id: str = Depends(get_current_user),
     page: int = Query(default=1, ge=1),
     page_size: int = Query(default=10, ge=1, le=100)
 ):
     try:
         transaction_service = TransactionService()
-        result = await transaction_service.get_user_transactions(
-            user_id=user_id,
-            page=page,
-            page_size=page_size
+        return await cached_json_response(
+            request,
+            user_id,
+            lambda: transaction_service.get_user_transactions(
+                user_id=user_id,
+                page=page,
+                page_size=page_size
+            ),
+            GetTransactions
         )
-        return result
     except Exception as e:
         logging.error(f"Error in get_transactions: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/cursor", response_model=GetTransactionsPage)
+async def get_transactions_by_cursor(
+    request: Request,
+    user_id: str = Depends(get_current_user),
+    cursor: Optional[str] = Query(default=None),
+    page_size: int = Query(default=10, ge=1, le=100),
+    count: Literal['none', 'estimated', 'exact'] = Query(default='none')
+):
+    """
+    Keyset-paginated transactions; pass next_cursor back to get the following page
+    """
+    try:
+        transaction_service = TransactionService()
+        return await cached_json_response(
+            request,
+            user_id,
+            lambda: transaction_service.get_user_transactions_after(
+                user_id=user_id,
+                page_size=page_size,
+                cursor=cursor,
+                count=count
+            ),
+            GetTransactionsPage
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.error(f"Error in get_transactions_by_cursor: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.put("/{transaction_id}")
 async def update_transaction(
     transaction_id: str,
@@ -99,24 +144,10 @@ async def patch_transactions_batch(
     user_id: str = Depends(get_current_user)
 ):
     try:
-        print("\n=== Batch Update Request Details ===")
-        print(f"User ID: {user_id}")
-        print(f"Number of transactions to update: {len(update_data.transactions)}")
-        print(f"Page: {update_data.page}")
-        print(f"Page Size: {update_data.page_size}")
-        print("\nTransaction Updates:")
-        for idx, transaction in enumerate(update_data.transactions, 1):
-            print(f"\nTransaction {idx}:")
-            print(f"  ID: {transaction.id}")
-            print(f"  Category: {transaction.category}")
-            print(f"  Chart of Account: {transaction.chart_of_accounts}")
-            print(f"  Raw transaction data: {transaction.dict()}")
-        print("\n=== End Request Details ===\n")
-
         supabase = await get_supabase()
         logging.info(f"Starting batch update for user {user_id} with {len(update_data.transactions)} transactions")
         # Verify all transactions belong to the user
-        transaction_ids = [t.id for t in update_data.transactions]
+        transaction_ids = list(dict.fromkeys(t.id for t in update_data.transactions))
         logging.debug(f"Transaction IDs to update: {transaction_ids}")
         
         verification = await supabase.table("gocardless_transactions")\
@@ -134,67 +165,136 @@ async def patch_transactions_batch(
                 detail="Some transactions do not belong to the user"
             )
         
-        # Perform batch update
-        results = []
-        for transaction in update_data.transactions:
-            print("transaction id", transaction.id)
-            # Convert to dict and exclude None values
-            update_dict = transaction.dict(exclude_unset=True, exclude={'id'})
-            print("update_dict", update_dict)
-            logging.debug(f"Updating transaction {transaction.id} with data: {update_dict}")
-            
-            try:
-                result = await supabase.table("gocardless_transactions")\
-                    .update(update_dict)\
-                    .eq("id", transaction.id)\
-                    .eq("user_id", user_id)\
-                    .execute()
-                results.extend(result.data)
-                logging.debug(f"Successfully updated transaction {transaction.id}")
-            except Exception as transaction_error:
-                logging.error(f"Error updating transaction {transaction.id}: {str(transaction_error)}")
-                raise
+        # Perform batch update, one query per distinct set of changes
+        transaction_service = TransactionService()
+        result = await transaction_service.update_transactions_batch(
+            user_id,
+            [
+                (transaction.id, transaction.dict(exclude_unset=True, exclude={'id'}))
+                for transaction in update_data.transactions
+            ]
+        )
+        
+        failed = [r for r in result["results"] if r["status"] == "failed"]
+        if failed and len(failed) == len(result["results"]):
+            raise HTTPException(status_code=500, detail=failed[0]["error"])
             
-        logging.info(f"Successfully completed batch update of {len(results)} transactions")
-        return results
+        logging.info(f"Successfully completed batch update of {result['updated_count']} transactions "
+                     f"({len(failed)} failed)")
+        if result["updated_count"]:
+            await invalidate_user(user_id)
+        return result
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Batch update failed with error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/fetch_csv")
 async def export_transactions_csv(
-    user_id: str = Depends(get_current_user)
+    user_id: str = Depends(get_current_user),
+    format: ExportFormat = Query(default='csv'),
+    gzip: bool = Query(default=False)
 ):
     """
-    Export all transactions for the current user to CSV format
+    Export all transactions for the current user, streamed as CSV (default), Parquet or XLSX
     """
-    logging.info(f"Exporting transactions to CSV for user {user_id}")
+    logging.info(f"Exporting transactions to {format} for user {user_id}")
     try:
         transaction_service = TransactionService()
-        csv_data = await transaction_service.export_transactions_to_csv(user_id)
+        chunks = await transaction_service.export_transactions(user_id, format, gzip)
         
         return StreamingResponse(
-            iter([csv_data]),
-            media_type="text/csv",
+            chunks,
+            media_type=export_media_type(format, gzip),
             headers={
-                "Content-Disposition": "attachment; filename=transactions.csv"
+                "Content-Disposition": f"attachment; filename={export_filename(format, gzip)}"
             }
         )
     except Exception as e:
-        logging.error(f"Error exporting transactions to CSV: {str(e)}")
+        logging.error(f"Error exporting transactions to {format}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/insights", response_model=Insights)
 async def get_insights(
+    request: Request,
     user_id: str = Depends(get_current_user)
 ) -> Insights:
     try:
         transaction_service = TransactionService()
-        insights = await transaction_service.get_insights(user_id)
-        return insights
+        return await cached_json_response(
+            request, user_id, lambda: transaction_service.get_insights(user_id), Insights
+        )
     except Exception as e:
         logging.error(f"Error getting insights: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    
 
+@router.get("/insights/analytics", response_model=AnalyticsInsights)
+async def get_analytics(
+    request: Request,
+    user_id: str = Depends(get_current_user),
+    currency: Optional[str] = Query(default=None)
+) -> AnalyticsInsights:
+    try:
+        transaction_service = TransactionService()
+        return await cached_json_response(
+            request, user_id, lambda: transaction_service.get_analytics(user_id, currency), AnalyticsInsights
+        )
+    except Exception as e:
+        logging.error(f"Error getting analytics: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/insights/cash-flow", response_model=List[CashFlowMonth])
+async def get_cash_flow(
+    request: Request,
+    user_id: str = Depends(get_current_user),
+    currency: Optional[str] = Query(default=None)
+) -> List[CashFlowMonth]:
+    try:
+        transaction_service = TransactionService()
+        
+        async def compute():
+            analytics = await transaction_service.get_analytics(user_id, currency)
+            return analytics.cash_flow
+        
+        return await cached_json_response(request, user_id, compute, List[CashFlowMonth])
+    except Exception as e:
+        logging.error(f"Error getting cash flow: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/insights/recurring-vendors", response_model=List[RecurringVendor])
+async def get_recurring_vendors(
+    request: Request,
+    user_id: str = Depends(get_current_user),
+    currency: Optional[str] = Query(default=None)
+) -> List[RecurringVendor]:
+    try:
+        transaction_service = TransactionService()
+        
+        async def compute():
+            analytics = await transaction_service.get_analytics(user_id, currency)
+            return analytics.recurring_vendors
+        
+        return await cached_json_response(request, user_id, compute, List[RecurringVendor])
+    except Exception as e:
+        logging.error(f"Error getting recurring vendors: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/insights/category-trends", response_model=List[CategoryTrend])
+async def get_category_trends(
+    request: Request,
+    user_id: str = Depends(get_current_user),
+    currency: Optional[str] = Query(default=None)
+) -> List[CategoryTrend]:
+    try:
+        transaction_service = TransactionService()
+        
+        async def compute():
+            analytics = await transaction_service.get_analytics(user_id, currency)
+            return analytics.category_trends
+        
+        return await cached_json_response(request, user_id, compute, List[CategoryTrend])
+    except Exception as e:
+        logging.error(f"Error getting category trends: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
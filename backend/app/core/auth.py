@@ -1,10 +1,14 @@
+import asyncio
+import hashlib
 import httpx
-from typing import Dict
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 import os
 
 from fastapi import HTTPException, Security
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from jose import jwt
+from jose import jwk, jwt
 import logging
 
 logger = logging.getLogger(__name__)
@@ -19,27 +23,125 @@ if not CLERK_JWT_ISSUER:
 if not CLERK_PUBLIC_KEY:
     logger.error("CLERK_PUBLIC_KEY environment variable is not set")
 
-# Cache for JWKS
-_jwks_cache: Dict = {}
+JWKS_URL = f"{CLERK_JWT_ISSUER}/.well-known/jwks.json"
+# Keys are re-fetched in the background on this interval so rotations are
+# picked up without a restart
+JWKS_REFRESH_SECONDS = 60 * 60
+# An unknown kid forces a refresh, but no more often than this
+JWKS_MIN_REFRESH_SECONDS = 30
+# Verified tokens remembered (by hash) until they expire
+VERIFIED_TOKEN_CACHE_SIZE = 10_000
 
-async def get_jwks():
-    """Fetch the JWKS from Clerk"""
-    global _jwks_cache
-    
-    try:
-        # Return cached JWKS if available
-        if _jwks_cache:
-            return _jwks_cache
-            
-        jwks_url = f"{CLERK_JWT_ISSUER}/.well-known/jwks.json"
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.get(jwks_url)
+
+class JWKSKeyStore:
+    """
+    Clerk's signing keys indexed by kid.
+
+    Keys are parsed once when fetched. Concurrent refreshes share one request
+    (single flight), and a background task refreshes the set periodically.
+    """
+
+    def __init__(self, jwks_url: str):
+        self.jwks_url = jwks_url
+        self._keys: Dict[str, jwk.Key] = {}
+        self._fetched_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._background_task: Optional[asyncio.Task] = None
+
+    def __contains__(self, kid: str) -> bool:
+        return kid in self._keys
+
+    async def _fetch(self) -> None:
+        async with httpx.AsyncClient(timeout=10) as client:
+            response = await client.get(self.jwks_url)
             response.raise_for_status()
-            
-            _jwks_cache = response.json()
-            return _jwks_cache
-            
+            jwks = response.json()
+
+        keys = {}
+        for key in jwks.get('keys', []):
+            kid = key.get('kid')
+            if not kid:
+                continue
+            try:
+                keys[kid] = jwk.construct(key, algorithm='RS256')
+            except Exception as e:
+                logger.warning(f"Skipping unusable JWKS key {kid}: {str(e)}")
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        logger.info(f"Loaded {len(keys)} JWKS keys")
+
+    async def refresh(self) -> None:
+        """Fetch the key set, joining a fetch that is already in flight."""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch())
+        # Shielded so one cancelled request does not cancel the shared fetch
+        await asyncio.shield(self._refresh_task)
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(JWKS_REFRESH_SECONDS)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Background JWKS refresh failed: {str(e)}")
+
+    def start_background_refresh(self) -> None:
+        if self._background_task is None or self._background_task.done():
+            self._background_task = asyncio.create_task(self._refresh_periodically())
+
+    async def get_key(self, kid: str) -> Optional[jwk.Key]:
+        """Key for a kid, refreshing once if the kid is unknown (e.g. just rotated)."""
+        self.start_background_refresh()
+        key = self._keys.get(kid)
+        if key is None and (
+            not self._fetched_at or time.monotonic() - self._fetched_at > JWKS_MIN_REFRESH_SECONDS
+        ):
+            await self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of token hashes that passed full verification, valid until their exp."""
+
+    def __init__(self, max_size: int = VERIFIED_TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[bytes, Tuple[str, float, str]]" = OrderedDict()
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str, keys: JWKSKeyStore) -> Optional[str]:
+        digest = self._digest(token)
+        entry = self._entries.get(digest)
+        if entry is None:
+            return None
+        user_id, expires_at, kid = entry
+        # Drop tokens that have expired or whose signing key has been rotated out
+        if expires_at <= time.time() or kid not in keys:
+            del self._entries[digest]
+            return None
+        self._entries.move_to_end(digest)
+        return user_id
+
+    def add(self, token: str, user_id: str, expires_at: float, kid: str) -> None:
+        digest = self._digest(token)
+        self._entries[digest] = (user_id, expires_at, kid)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+jwks_keys = JWKSKeyStore(JWKS_URL)
+verified_tokens = VerifiedTokenCache()
+
+async def get_jwks() -> Dict[str, jwk.Key]:
+    """Get Clerk's signing keys by kid, fetching them on first use"""
+    try:
+        if not jwks_keys._fetched_at:
+            await jwks_keys.refresh()
+        return dict(jwks_keys._keys)
     except Exception as e:
         logger.error(f"Error fetching JWKS: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching JWKS: {str(e)}")
@@ -62,6 +164,11 @@ async def validate_token(token: str) -> str:
     Helper function to validate a raw JWT token and return the user ID
     """
     try:
+        # Tokens already verified are trusted until they expire, skipping RSA verification
+        user_id = verified_tokens.get(token, jwks_keys)
+        if user_id:
+            return user_id
+        
         # Decode header without verification to get the key ID
         try:
             header = jwt.get_unverified_header(token)
@@ -74,13 +181,12 @@ async def validate_token(token: str) -> str:
         if not kid:
             raise HTTPException(status_code=401, detail="No 'kid' in token header")
             
-        # Get JWKS and find the matching key
-        jwks = await get_jwks()
-        key = None
-        for jwk in jwks.get('keys', []):
-            if jwk.get('kid') == kid:
-                key = jwk
-                break
+        # Find the matching key, refreshing the key set if the kid is new
+        try:
+            key = await jwks_keys.get_key(kid)
+        except Exception as e:
+            logger.error(f"Error fetching JWKS: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Error fetching JWKS: {str(e)}")
                 
         if not key:
             logger.error(f"No matching key found for kid: {kid}")
@@ -108,9 +214,14 @@ async def validate_token(token: str) -> str:
             logger.error("No user ID found in token payload")
             raise HTTPException(status_code=401, detail="Invalid user ID in token")
             
+        if payload.get("exp"):
+            verified_tokens.add(token, user_id, float(payload["exp"]), kid)
+            
         logger.info(f"Successfully validated token for user: {user_id}")
         return user_id
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Unexpected error during token validation: {str(e)}")
         raise HTTPException(status_code=401, detail=str(e))
@@ -0,0 +1,199 @@
+"""
+Per-user response cache for read endpoints.
+
+Entries are keyed by (user, generation, endpoint, query). Write paths call
+invalidate_user, which bumps the user's generation so every cached response
+for that user is skipped from then on; nothing has to enumerate keys. Entries
+live in an in-process LRU, and optionally in Redis (set RESPONSE_CACHE_REDIS_URL)
+so generations and bodies are shared between workers.
+"""
+
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+import orjson
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2048"))
+CACHE_REDIS_URL = os.getenv("RESPONSE_CACHE_REDIS_URL")
+
+_KEY_PREFIX = "response-cache"
+
+
+class CacheEntry(NamedTuple):
+    body: bytes
+    etag: str
+    expires_at: float
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        ttl: int = CACHE_TTL_SECONDS,
+        redis_url: Optional[str] = CACHE_REDIS_URL
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[str, int, str, str], CacheEntry]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._redis_url = redis_url
+        self._redis = None
+        self.hits = 0
+        self.misses = 0
+
+    def _backend(self):
+        """Redis client when configured and installed, otherwise None."""
+        if self._redis is None and self._redis_url:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                logger.warning("RESPONSE_CACHE_REDIS_URL is set but redis is not installed; using in-process cache only")
+                self._redis_url = None
+                return None
+            self._redis = redis.from_url(self._redis_url)
+        return self._redis
+
+    async def generation(self, user_id: str) -> int:
+        backend = self._backend()
+        if backend is not None:
+            try:
+                value = await backend.get(f"{_KEY_PREFIX}:gen:{user_id}")
+                return int(value or 0)
+            except Exception as e:
+                logger.warning(f"Response cache backend unavailable, using local generation: {str(e)}")
+        return self._generations.get(user_id, 0)
+
+    async def invalidate_user(self, user_id: str) -> None:
+        """Make every cached response for a user stale; call after any write to their data."""
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+        for key in [key for key in self._entries if key[0] == user_id]:
+            del self._entries[key]
+
+        backend = self._backend()
+        if backend is not None:
+            try:
+                await backend.incr(f"{_KEY_PREFIX}:gen:{user_id}")
+            except Exception as e:
+                logger.warning(f"Failed to bump shared cache generation for user {user_id}: {str(e)}")
+        logger.debug(f"Invalidated cached responses for user {user_id}")
+
+    async def get(self, key: Tuple[str, int, str, str]) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry
+            del self._entries[key]
+
+        backend = self._backend()
+        if backend is not None:
+            try:
+                body = await backend.get(self._backend_key(key))
+            except Exception as e:
+                logger.warning(f"Response cache backend read failed: {str(e)}")
+                body = None
+            if body is not None:
+                entry = CacheEntry(body, _etag(body), time.monotonic() + self.ttl)
+                self._store_local(key, entry)
+                return entry
+        return None
+
+    async def set(self, key: Tuple[str, int, str, str], body: bytes) -> CacheEntry:
+        entry = CacheEntry(body, _etag(body), time.monotonic() + self.ttl)
+        self._store_local(key, entry)
+
+        backend = self._backend()
+        if backend is not None:
+            try:
+                await backend.set(self._backend_key(key), body, ex=self.ttl)
+            except Exception as e:
+                logger.warning(f"Response cache backend write failed: {str(e)}")
+        return entry
+
+    def _store_local(self, key: Tuple[str, int, str, str], entry: CacheEntry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _backend_key(key: Tuple[str, int, str, str]) -> str:
+        user_id, generation, scope, query = key
+        digest = hashlib.sha256(f"{scope}?{query}".encode()).hexdigest()
+        return f"{_KEY_PREFIX}:{user_id}:{generation}:{digest}"
+
+
+response_cache = ResponseCache()
+
+
+async def invalidate_user(user_id: str) -> None:
+    await response_cache.invalidate_user(user_id)
+
+
+async def cached_json_response(
+    request: Request,
+    user_id: str,
+    compute: Callable[[], Awaitable[Any]],
+    response_model: Optional[Any] = None
+) -> Response:
+    """
+    Serve a user's JSON response from the cache, computing it on a miss.
+
+    The cache key is the request path plus its sorted query parameters. Clients
+    that send back the ETag in If-None-Match get a 304 without a body.
+
+    Args:
+        request (Request): The incoming request
+        user_id (str): Owner of the data; the response is invalidated with their generation
+        compute (Callable[[], Awaitable[Any]]): Produces the response data on a cache miss
+        response_model (Optional[Any]): Type used to validate and serialise the data, as
+            FastAPI would for a route's response_model
+
+    Returns:
+        Response: The JSON body with ETag, or an empty 304
+    """
+    query = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    generation = await response_cache.generation(user_id)
+    key = (user_id, generation, request.url.path, query)
+
+    entry = await response_cache.get(key)
+    if entry is None:
+        response_cache.misses += 1
+        data = await compute()
+        if response_model is not None:
+            adapter = TypeAdapter(response_model)
+            body = adapter.dump_json(adapter.validate_python(data, from_attributes=True))
+        else:
+            body = orjson.dumps(jsonable_encoder(data))
+        # Stored under the generation read before computing, so a write that
+        # lands mid-compute leaves this entry unreachable rather than stale
+        entry = await response_cache.set(key, body)
+    else:
+        response_cache.hits += 1
+
+    headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
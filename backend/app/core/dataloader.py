@@ -0,0 +1,143 @@
+"""
+Request-scoped batching of Supabase point lookups.
+
+Lookups made through a loader in the same event-loop tick are coalesced into
+one in_() query per (table, column, columns), and every result is memoised for
+the rest of the request, so repeated lookups of the same key cost nothing.
+
+    loader = get_loader('gocardless_agreements', 'reference', 'id, user_id')
+    rows = await loader.load(reference)
+
+Each request gets fresh loaders via DataLoaderMiddleware. Outside a request
+(scripts, background jobs) get_loader returns a loader that still batches
+but is not shared between calls.
+"""
+
+import asyncio
+import logging
+from contextvars import ContextVar
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from app.core.supabase_client import get_supabase
+
+logger = logging.getLogger(__name__)
+
+# Keys per in_() query; keeps the request URL well under proxy limits
+MAX_BATCH_SIZE = 200
+
+LoaderKey = Tuple[str, str, str]
+
+
+class DataLoader:
+    """Batches and memoises lookups of rows in one table by one column."""
+
+    def __init__(self, table: str, column: str, columns: str = '*'):
+        self.table = table
+        self.column = column
+        # The key column is needed to route rows back to their lookups
+        if columns != '*' and column not in [c.strip() for c in columns.split(',')]:
+            columns = f"{columns}, {column}"
+        self.columns = columns
+        self._results: Dict[Hashable, asyncio.Future] = {}
+        self._queue: List[Hashable] = []
+        self._dispatch_scheduled = False
+
+    async def load(self, key: Hashable) -> List[Dict[str, Any]]:
+        """All rows whose column equals key (an empty list when there are none)."""
+        future = self._results.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._results[key] = future
+            self._queue.append(key)
+            if not self._dispatch_scheduled:
+                self._dispatch_scheduled = True
+                # Let every coroutine that is ready this tick enqueue its key first
+                asyncio.get_running_loop().call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+        return await asyncio.shield(future)
+
+    async def load_one(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        rows = await self.load(key)
+        return rows[0] if rows else None
+
+    async def load_many(self, keys: List[Hashable]) -> List[List[Dict[str, Any]]]:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    def prime(self, key: Hashable, rows: List[Dict[str, Any]]) -> None:
+        """Record rows for a key without querying, e.g. right after inserting them."""
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(rows)
+        self._results[key] = future
+
+    def clear(self, key: Hashable) -> None:
+        self._results.pop(key, None)
+
+    async def _dispatch(self) -> None:
+        keys, self._queue = self._queue, []
+        self._dispatch_scheduled = False
+        await asyncio.gather(*(
+            self._fetch(keys[start:start + MAX_BATCH_SIZE])
+            for start in range(0, len(keys), MAX_BATCH_SIZE)
+        ))
+
+    async def _fetch(self, keys: List[Hashable]) -> None:
+        logger.debug(f"Loading {len(keys)} {self.table} rows by {self.column}")
+        try:
+            supabase = await get_supabase()
+            result = await supabase.table(self.table) \
+                .select(self.columns) \
+                .in_(self.column, keys) \
+                .execute()
+        except Exception as e:
+            for key in keys:
+                future = self._results.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+
+        rows_by_key: Dict[Hashable, List[Dict[str, Any]]] = {key: [] for key in keys}
+        for row in result.data:
+            rows_by_key.setdefault(row.get(self.column), []).append(row)
+        for key in keys:
+            future = self._results.get(key)
+            if future is not None and not future.done():
+                future.set_result(rows_by_key.get(key, []))
+
+
+class DataLoaderRegistry:
+    def __init__(self):
+        self._loaders: Dict[LoaderKey, DataLoader] = {}
+
+    def get(self, table: str, column: str, columns: str = '*') -> DataLoader:
+        key = (table, column, columns)
+        loader = self._loaders.get(key)
+        if loader is None:
+            loader = self._loaders[key] = DataLoader(table, column, columns)
+        return loader
+
+
+_registry: ContextVar[Optional[DataLoaderRegistry]] = ContextVar("dataloader_registry", default=None)
+
+
+def get_loader(table: str, column: str, columns: str = '*') -> DataLoader:
+    """The current request's loader for looking up table rows by column."""
+    registry = _registry.get()
+    if registry is None:
+        return DataLoader(table, column, columns)
+    return registry.get(table, column, columns)
+
+
+class DataLoaderMiddleware:
+    """ASGI middleware giving each HTTP request its own set of loaders."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = _registry.set(DataLoaderRegistry())
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _registry.reset(token)
@@ -1,9 +1,12 @@
 import os
 from dotenv import load_dotenv
 import logging
-from typing import Optional
+from typing import Any, Dict, Optional, Union
 import asyncio
 
+import httpx
+from postgrest import AsyncPostgrestClient
+from postgrest.utils import AsyncClient as PostgrestHTTPClient
 from supabase._async.client import AsyncClient
 
 load_dotenv()
@@ -20,8 +23,71 @@ SUPABASE_ANON_KEY = os.getenv("SUPABASE_KEY")
 if not SUPABASE_ANON_KEY:
     raise ValueError("SUPABASE_KEY is not set in the environment variables")
 
+# HTTP transport for PostgREST; every service's table/rpc calls share this pool
+SUPABASE_HTTP_MAX_CONNECTIONS = int(os.getenv("SUPABASE_HTTP_MAX_CONNECTIONS", "100"))
+SUPABASE_HTTP_MAX_KEEPALIVE = int(os.getenv("SUPABASE_HTTP_MAX_KEEPALIVE", "20"))
+SUPABASE_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_HTTP_KEEPALIVE_EXPIRY", "30"))
+SUPABASE_HTTP_TIMEOUT = float(os.getenv("SUPABASE_HTTP_TIMEOUT", "30"))
+SUPABASE_HTTP_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_HTTP_CONNECT_TIMEOUT", "5"))
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "true").lower() == "true"
+
+# Optional direct Postgres pool for bulk and analytical queries. Needs asyncpg
+# and SUPABASE_DB_URL (use the transaction pooler URL when running several workers)
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
+SUPABASE_DB_POOL_MIN = int(os.getenv("SUPABASE_DB_POOL_MIN", "1"))
+SUPABASE_DB_POOL_MAX = int(os.getenv("SUPABASE_DB_POOL_MAX", "10"))
+
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    """PostgREST client whose HTTP session uses the configured pool limits and timeouts."""
+
+    def create_session(
+        self,
+        base_url: str,
+        headers: Dict[str, str],
+        timeout: Union[int, float, httpx.Timeout],
+        verify: bool = True,
+        proxy: Optional[str] = None,
+    ) -> PostgrestHTTPClient:
+        return PostgrestHTTPClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=httpx.Timeout(SUPABASE_HTTP_TIMEOUT, connect=SUPABASE_HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=SUPABASE_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=SUPABASE_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=SUPABASE_HTTP_KEEPALIVE_EXPIRY,
+            ),
+            verify=verify,
+            proxy=proxy,
+            follow_redirects=True,
+            http2=SUPABASE_HTTP2,
+        )
+
+
+class PooledAsyncClient(AsyncClient):
+    def _init_postgrest_client(
+        self,
+        rest_url: str,
+        headers: Dict[str, str],
+        schema: str,
+        timeout: Union[int, float, httpx.Timeout] = SUPABASE_HTTP_TIMEOUT,
+        verify: bool = True,
+        proxy: Optional[str] = None,
+    ) -> AsyncPostgrestClient:
+        return PooledPostgrestClient(
+            rest_url,
+            headers=headers,
+            schema=schema,
+            timeout=timeout,
+            verify=verify,
+            proxy=proxy,
+        )
+
+
 class SupabaseConnection:
     _client: Optional[AsyncClient] = None
+    _pg_pool = None
     _initialization_lock = asyncio.Lock()
     _initialized = False
 
@@ -34,7 +100,7 @@ class SupabaseConnection:
                     logger.info("Initializing Supabase client...")
                     # Use the validated variables from top level instead
                     try:
-                        cls._client = AsyncClient(SUPABASE_URL, SUPABASE_ANON_KEY)
+                        cls._client = PooledAsyncClient(SUPABASE_URL, SUPABASE_ANON_KEY)
                         cls._initialized = True
                         logger.info("Supabase client initialized successfully")
                     except Exception as e:
@@ -43,11 +109,69 @@ class SupabaseConnection:
 
         return cls._client
 
+    @classmethod
+    async def init_pg_pool(cls):
+        """Create the asyncpg pool if SUPABASE_DB_URL is set and asyncpg is installed."""
+        if cls._pg_pool is not None or not SUPABASE_DB_URL:
+            return cls._pg_pool
+        try:
+            import asyncpg
+        except ImportError:
+            logger.warning("SUPABASE_DB_URL is set but asyncpg is not installed; direct Postgres pool disabled")
+            return None
+
+        cls._pg_pool = await asyncpg.create_pool(
+            SUPABASE_DB_URL,
+            min_size=SUPABASE_DB_POOL_MIN,
+            max_size=SUPABASE_DB_POOL_MAX,
+            # Prepared statements are not supported behind Supabase's transaction pooler
+            statement_cache_size=0,
+        )
+        logger.info(f"Postgres pool initialized (min={SUPABASE_DB_POOL_MIN}, max={SUPABASE_DB_POOL_MAX})")
+        return cls._pg_pool
+
+    @classmethod
+    def pool_metrics(cls) -> Dict[str, Any]:
+        """Connection counts for the PostgREST HTTP pool and the Postgres pool."""
+        metrics: Dict[str, Any] = {"postgrest": None, "postgres": None}
+
+        if cls._client is not None and cls._client._postgrest is not None:
+            pool = getattr(cls._client._postgrest.session._transport, "_pool", None)
+            connections = list(getattr(pool, "connections", []))
+            idle = sum(1 for connection in connections if connection.is_idle())
+            metrics["postgrest"] = {
+                "max_connections": SUPABASE_HTTP_MAX_CONNECTIONS,
+                "max_keepalive": SUPABASE_HTTP_MAX_KEEPALIVE,
+                "http2": SUPABASE_HTTP2,
+                "open": len(connections),
+                "idle": idle,
+                "active": len(connections) - idle,
+            }
+
+        if cls._pg_pool is not None:
+            size = cls._pg_pool.get_size()
+            idle = cls._pg_pool.get_idle_size()
+            metrics["postgres"] = {
+                "min_size": cls._pg_pool.get_min_size(),
+                "max_size": cls._pg_pool.get_max_size(),
+                "size": size,
+                "idle": idle,
+                "active": size - idle,
+            }
+        return metrics
+
     @classmethod
     async def close(cls) -> None:
-        """Close the Supabase client connection."""
+        """Close the Supabase client's HTTP connections and the Postgres pool."""
+        global supabase
+        if cls._client is not None and cls._client._postgrest is not None:
+            await cls._client._postgrest.aclose()
+        if cls._pg_pool is not None:
+            await cls._pg_pool.close()
         cls._client = None
+        cls._pg_pool = None
         cls._initialized = False
+        supabase = None
         logger.info("Supabase client connection closed")
 
 # Create the global instance
@@ -68,3 +192,21 @@ async def get_supabase() -> AsyncClient:
         supabase = await supabase_client.get_client()
     return supabase
 
+async def get_pg_pool():
+    """
+    The direct Postgres pool for bulk and analytical queries, or None when not configured.
+    Callers should fall back to the PostgREST client when this returns None.
+    """
+    return SupabaseConnection._pg_pool
+
+async def init_connections() -> None:
+    """Open the Supabase client and, if configured, the Postgres pool (called at startup)."""
+    await get_supabase()
+    await SupabaseConnection.init_pg_pool()
+
+async def close_connections() -> None:
+    await SupabaseConnection.close()
+
+def pool_metrics() -> Dict[str, Any]:
+    return SupabaseConnection.pool_metrics()
+
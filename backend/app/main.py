@@ -1,6 +1,10 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.main import api_router
+from app.api.nylas import webhook_queue
+from app.core.dataloader import DataLoaderMiddleware
+from app.core.supabase_client import close_connections, init_connections, pool_metrics
 from starlette.middleware.sessions import SessionMiddleware
 import logging
 import os
@@ -18,7 +22,18 @@ docs_url = "/api/v1/docs" if ENVIRONMENT == "development" else None
 redoc_url = "/api/v1/redoc" if ENVIRONMENT == "development" else None
 openapi_url = "/api/v1/openapi.json" if ENVIRONMENT == "development" else None
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.debug("Starting up FastAPI server...")
+    await init_connections()
+    yield
+    logger.debug("Shutting down FastAPI server...")
+    # Let queued webhook events finish while the connections are still open
+    await webhook_queue.stop()
+    await close_connections()
+
 app = FastAPI(
+    lifespan=lifespan,
     title="BankStream API",
     description="API for banking and payment operations",
     version="0.1.0",
@@ -44,6 +59,9 @@ app.add_middleware(
     max_age=86400  # 24 hours
 )
 
+# Fresh request-scoped lookup batching for every request
+app.add_middleware(DataLoaderMiddleware)
+
 app.include_router(api_router, prefix="/api/v1")
 
 @app.get("/")
@@ -51,10 +69,6 @@ async def root():
     logger.info("Root endpoint accessed")
     return {"message": "Welcome to BankStream IO"}
 
-@app.on_event("startup")
-async def startup_event():
-    logger.debug("Starting up FastAPI server...")
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    logger.debug("Shutting down FastAPI server...")
+@app.get("/health")
+async def health():
+    return {"status": "ok", "pools": pool_metrics()}
@@ -43,6 +43,14 @@ class GetTransactions(BaseModel):
     page_size: int
     total_pages: int
 
+class GetTransactionsPage(BaseModel):
+    """Keyset-paginated transactions; pass next_cursor back to fetch the following page"""
+    transactions: List[TransactionsTable]
+    next_cursor: Optional[str] = None
+    has_more: bool
+    page_size: int
+    total_count: Optional[int] = None  # only when requested; may be an estimate
+
 class TransactionCreate(TransactionsTable):
     pass
 
@@ -59,3 +67,37 @@ class Insights(BaseModel):
     # average_transaction_size: float  # Average transaction amount
     # transactions_count: int  # Number of transactions processed in the period
 
+
+class CashFlowMonth(BaseModel):
+    month: str  # First day of the month, YYYY-MM-DD
+    inflow: float
+    outflow: float
+    net: float
+    transaction_count: int
+    gross_burn: float
+    net_burn: float  # Cash shortfall for the month, 0 when net is positive
+    rolling_gross_burn: float
+    rolling_net_burn: float
+
+class RecurringVendor(BaseModel):
+    vendor: str
+    cadence: str  # weekly, monthly, quarterly or annual
+    occurrences: int
+    average_amount: float
+    last_payment: str
+    next_expected: str
+    annualised_cost: float
+
+class CategoryTrend(BaseModel):
+    category: str
+    total: float
+    monthly_average: float
+    latest_month: float
+    slope: float  # Change in monthly spend per month
+    change_pct: Optional[float] = None  # Latest month against the average of the previous months
+
+class AnalyticsInsights(BaseModel):
+    currency: Optional[str] = None
+    cash_flow: List[CashFlowMonth]
+    recurring_vendors: List[RecurringVendor]
+    category_trends: List[CategoryTrend]
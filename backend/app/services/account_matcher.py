@@ -1,9 +1,17 @@
 
 """ NON TESTED AI GENERATED CODE"""
 
+import logging
+from collections import defaultdict
 from typing import List, Dict, Any
-from app.services.etl.vectorise_data import get_voyage_embedding
+
+import numpy as np
+
+from app.services.etl.vectorise_data import get_voyage_embedding, get_voyage_embeddings
 from app.core.supabase_client import get_supabase
+from app.services.coa_index import get_coa_index, invalidate_coa_index
+
+logger = logging.getLogger(__name__)
 
 async def prepare_account_text(account: Dict[str, Any]) -> str:
     """Prepare account text for embedding by combining relevant fields"""
@@ -27,61 +35,78 @@ async def embed_accounts(accounts: List[Dict[str, Any]]) -> None:
     """Create and store embeddings for chart of accounts"""
     supabase = await get_supabase()
     
-    for account in accounts:
-        account_text = await prepare_account_text(account)
-        embedding = await get_voyage_embedding(account_text, input_type="document")
-        
+    account_texts = [await prepare_account_text(account) for account in accounts]
+    embeddings = await get_voyage_embeddings(account_texts, input_type="document")
+    
+    for account, embedding in zip(accounts, embeddings):
         # Update the account with its embedding
         await supabase.table('chart_of_accounts').update({
             'embedding': embedding
         }).eq('id', account['id']).execute()
 
+    # Cached indexes hold the old vectors
+    for user_id in {account.get('user_id') for account in accounts if account.get('user_id')}:
+        invalidate_coa_index(user_id)
+
 async def find_matching_account(
     transaction: Dict[str, Any],
     similarity_threshold: float = 0.7,
     max_matches: int = 5
 ) -> List[Dict[str, Any]]:
     """Find matching accounts for a transaction using vector similarity"""
-    supabase = await get_supabase()
-    
     # Prepare and embed transaction text
     transaction_text = await prepare_transaction_text(transaction)
-    print(f"Transaction text: {transaction_text}")  # Debugging
+    logger.debug(f"Transaction text: {transaction_text}")
     query_embedding = await get_voyage_embedding(transaction_text, input_type="query")
     
-    # Debugging: Print embedding shape
-    print(f"Query embedding length: {len(query_embedding)}")
-    
-    # Search for similar accounts
-    result = await supabase.rpc(
-        'search_account_embeddings',
-        {
-            'query_embedding': query_embedding,
-            'similarity_threshold': similarity_threshold,
-            'match_count': max_matches,
-            'user_id': transaction['user_id']
-        }
-    ).execute()
-    
-    # Debugging: Print raw results
-    print(f"Search results: {result.data}")
+    # Search for similar accounts in the user's in-process index
+    index = await get_coa_index(transaction['user_id'])
+    matches = index.search(query_embedding, max_matches, similarity_threshold)
+    logger.debug(f"Found {len(matches)} matching accounts")
     
-    return result.data
+    return matches
 
 async def batch_process_transactions(
-    transactions: List[Dict[str, Any]]
+    transactions: List[Dict[str, Any]],
+    similarity_threshold: float = 0.7,
+    max_matches: int = 5
 ) -> List[Dict[str, Any]]:
-    """Process a batch of transactions and find matching accounts"""
-    results = []
-    
-    for transaction in transactions:
-        matches = await find_matching_account(transaction)
-        results.append({
+    """
+    Find matching accounts for many transactions at once.
+
+    Distinct transaction texts are embedded in batched Voyage requests, then each
+    user's transactions are scored against their COA index in one matrix operation.
+    """
+    if not transactions:
+        return []
+
+    # Recurring transactions share text, so each distinct text is embedded once
+    transaction_texts = [await prepare_transaction_text(tx) for tx in transactions]
+    unique_texts = list(dict.fromkeys(text for text in transaction_texts if text))
+    logger.info(f"Embedding {len(unique_texts)} distinct texts for {len(transactions)} transactions")
+    embeddings = await get_voyage_embeddings(unique_texts, input_type="query")
+    embedding_by_text = dict(zip(unique_texts, embeddings))
+
+    # Group positions by user so each user's index is searched once
+    positions_by_user = defaultdict(list)
+    for position, (transaction, text) in enumerate(zip(transactions, transaction_texts)):
+        if text:
+            positions_by_user[transaction['user_id']].append(position)
+
+    matches_by_position: Dict[int, List[Dict[str, Any]]] = {}
+    for user_id, positions in positions_by_user.items():
+        index = await get_coa_index(user_id)
+        query_matrix = np.asarray([embedding_by_text[transaction_texts[p]] for p in positions])
+        user_matches = index.search_many(query_matrix, max_matches, similarity_threshold)
+        matches_by_position.update(zip(positions, user_matches))
+
+    return [
+        {
             'transaction': transaction,
-            'matches': matches
-        })
-    
-    return results
+            'matches': matches_by_position.get(position, [])
+        }
+        for position, transaction in enumerate(transactions)
+    ]
 
 async def verify_embeddings(user_id: str) -> bool:
     """Verify that embeddings exist and are valid"""
@@ -116,6 +141,6 @@ async def test_matching():
     if matches:
         print("Matching accounts found:")
         for match in matches:
-            print(f"- {match['name']} (similarity: {match['similarity']})")
+            print(f"- {match['account_name']} (similarity: {match['similarity']})")
     else:
         print("No matches found. Consider lowering the similarity threshold.") 
\ No newline at end of file
@@ -23,7 +23,7 @@ async def get_expiring_agreements(days_threshold: int = 7):
         
         # Query for agreements expiring soon
         result = await supabase.table('gocardless_agreements')\
-            .select('*')\
+            .select('id, user_id, institution_id, expires_at')\
             .gte('expires_at', now.isoformat())\
             .lte('expires_at', expiry_threshold.isoformat())\
             .execute()
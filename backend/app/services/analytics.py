@@ -0,0 +1,306 @@
+"""Vectorised time-series analytics over a user's transactions"""
+
+import logging
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import orjson
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Columns read for analytics; the Ntropy counterparty is extracted server-side
+# so the full enriched_data document is never transferred
+ANALYTICS_COLUMNS = [
+    "id",
+    "created_at",
+    "booking_date",
+    "amount",
+    "currency",
+    "creditor_name",
+    "debtor_name",
+    "llm_category",
+    "ntropy_transactions(counterparty:enriched_data->entities->counterparty->>name)",
+]
+
+# Same rows in one round trip over the direct Postgres pool, when configured
+ANALYTICS_SQL = """
+    select t.id, t.created_at, t.booking_date, t.amount, t.currency,
+           t.creditor_name, t.debtor_name, t.llm_category,
+           n.enriched_data #>> '{entities,counterparty,name}' as counterparty
+    from gocardless_transactions t
+    left join ntropy_transactions n on n.ntropy_id = t.id
+    where t.user_id = $1
+"""
+
+BURN_WINDOW_MONTHS = 3
+TREND_MONTHS = 6
+
+# Expected gap in days between payments for each cadence, with tolerance
+RECURRING_CADENCES = {
+    "weekly": (7, 2),
+    "monthly": (30.4, 4),
+    "quarterly": (91.3, 8),
+    "annual": (365.25, 15),
+}
+RECURRING_MIN_OCCURRENCES = 3
+# Maximum coefficient of variation of payment gaps and of amounts
+RECURRING_MAX_INTERVAL_CV = 0.25
+RECURRING_MAX_AMOUNT_CV = 0.2
+
+
+def _category(value: Any) -> Optional[str]:
+    """llm_category is {"category": ...}, a bare string, or JSON text of either."""
+    if isinstance(value, str):
+        try:
+            value = orjson.loads(value)
+        except ValueError:
+            return value or None
+    if isinstance(value, dict):
+        return value.get("category")
+    return value if isinstance(value, str) else None
+
+
+def _counterparty(value: Any) -> Optional[str]:
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return value.get("counterparty") if isinstance(value, dict) else None
+
+
+def build_transaction_frame(rows: List[Dict]) -> pd.DataFrame:
+    """
+    Build a columnar frame from transaction rows.
+
+    Args:
+        rows (List[Dict]): Rows selected with ANALYTICS_COLUMNS or ANALYTICS_SQL
+
+    Returns:
+        pd.DataFrame: One row per transaction with date (datetime64), month
+            (period start), amount (major units, negative = outgoing), currency,
+            vendor and category, sorted by date
+    """
+    columns = ["id", "date", "month", "amount", "currency", "vendor", "category"]
+    if not rows:
+        return pd.DataFrame(columns=columns)
+
+    raw = pd.DataFrame.from_records(rows)
+    dates = pd.to_datetime(raw.get("booking_date"), utc=True, errors="coerce")
+    dates = dates.fillna(pd.to_datetime(raw["created_at"], utc=True, errors="coerce")).dt.tz_localize(None)
+
+    if "counterparty" in raw:
+        vendor = raw["counterparty"]
+    else:
+        vendor = raw.get("ntropy_transactions", pd.Series(None, index=raw.index)).map(_counterparty)
+    for fallback in ("creditor_name", "debtor_name"):
+        if fallback in raw:
+            vendor = vendor.fillna(raw[fallback])
+
+    frame = pd.DataFrame({
+        "id": raw["id"],
+        "date": dates,
+        "month": dates.dt.to_period("M").dt.to_timestamp(),
+        # Stored in minor units
+        "amount": pd.to_numeric(raw["amount"], errors="coerce").fillna(0.0) / 100,
+        "currency": raw.get("currency", pd.Series(None, index=raw.index)),
+        "vendor": vendor.str.strip().replace("", np.nan),
+        "category": raw.get("llm_category", pd.Series(None, index=raw.index)).map(_category),
+    }, columns=columns)
+    return frame.dropna(subset=["date"]).sort_values("date", kind="stable").reset_index(drop=True)
+
+
+def primary_currency(frame: pd.DataFrame) -> Optional[str]:
+    """The user's most used currency; analytics are computed in a single currency."""
+    counts = frame["currency"].value_counts()
+    return counts.index[0] if len(counts) else None
+
+
+def monthly_cash_flow(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Money in, money out and net per calendar month, with empty months filled.
+
+    Returns:
+        pd.DataFrame: Indexed by month start with inflow, outflow (positive),
+            net and transaction_count columns
+    """
+    if frame.empty:
+        return pd.DataFrame(columns=["inflow", "outflow", "net", "transaction_count"])
+
+    amounts = frame["amount"].to_numpy()
+    flows = pd.DataFrame({
+        "month": frame["month"],
+        "inflow": np.where(amounts > 0, amounts, 0.0),
+        "outflow": np.where(amounts < 0, -amounts, 0.0),
+    })
+    monthly = flows.groupby("month").agg(
+        inflow=("inflow", "sum"),
+        outflow=("outflow", "sum"),
+        transaction_count=("inflow", "size"),
+    )
+    months = pd.date_range(monthly.index.min(), monthly.index.max(), freq="MS")
+    monthly = monthly.reindex(months, fill_value=0)
+    monthly["net"] = monthly["inflow"] - monthly["outflow"]
+    return monthly[["inflow", "outflow", "net", "transaction_count"]]
+
+
+def rolling_burn(cash_flow: pd.DataFrame, window: int = BURN_WINDOW_MONTHS) -> pd.DataFrame:
+    """
+    Gross and net burn per month and their rolling averages.
+
+    Net burn is the monthly cash shortfall (zero in months with positive net).
+    """
+    burn = pd.DataFrame(index=cash_flow.index)
+    burn["gross_burn"] = cash_flow["outflow"]
+    burn["net_burn"] = (-cash_flow["net"]).clip(lower=0)
+    rolling = burn.rolling(window, min_periods=1).mean()
+    burn["rolling_gross_burn"] = rolling["gross_burn"]
+    burn["rolling_net_burn"] = rolling["net_burn"]
+    return burn
+
+
+def recurring_vendors(
+    frame: pd.DataFrame,
+    min_occurrences: int = RECURRING_MIN_OCCURRENCES,
+) -> pd.DataFrame:
+    """
+    Vendors paid at a regular cadence for a consistent amount.
+
+    Payment gaps are computed for every vendor at once with a grouped diff,
+    then each vendor's median gap is matched against RECURRING_CADENCES.
+
+    Returns:
+        pd.DataFrame: One row per recurring vendor with cadence, occurrences,
+            average_amount (positive), last_payment, next_expected and
+            annualised_cost, ordered by annualised_cost
+    """
+    columns = ["vendor", "cadence", "occurrences", "average_amount", "last_payment",
+               "next_expected", "annualised_cost"]
+    payments = frame.loc[(frame["amount"] < 0) & frame["vendor"].notna(), ["vendor", "date", "amount"]]
+    if payments.empty:
+        return pd.DataFrame(columns=columns)
+
+    payments = payments.sort_values(["vendor", "date"], kind="stable")
+    payments = payments.assign(
+        gap=payments.groupby("vendor")["date"].diff().dt.total_seconds() / 86400,
+        spend=-payments["amount"],
+    )
+    stats = payments.groupby("vendor").agg(
+        occurrences=("spend", "size"),
+        average_amount=("spend", "mean"),
+        amount_std=("spend", "std"),
+        median_gap=("gap", "median"),
+        gap_mean=("gap", "mean"),
+        gap_std=("gap", "std"),
+        last_payment=("date", "max"),
+    )
+    stats = stats[stats["occurrences"] >= min_occurrences]
+    if stats.empty:
+        return pd.DataFrame(columns=columns)
+
+    amount_cv = (stats["amount_std"] / stats["average_amount"]).fillna(0)
+    gap_cv = (stats["gap_std"] / stats["gap_mean"]).fillna(0)
+
+    # Match each vendor's median gap to the nearest cadence within tolerance
+    names = list(RECURRING_CADENCES)
+    periods = np.array([RECURRING_CADENCES[name][0] for name in names])
+    tolerances = np.array([RECURRING_CADENCES[name][1] for name in names])
+    distance = np.abs(stats["median_gap"].to_numpy()[:, None] - periods[None, :])
+    within = distance <= tolerances[None, :]
+    nearest = np.where(within, distance, np.inf).argmin(axis=1)
+    matched = within.any(axis=1)
+
+    regular = matched & (gap_cv.to_numpy() <= RECURRING_MAX_INTERVAL_CV) \
+        & (amount_cv.to_numpy() <= RECURRING_MAX_AMOUNT_CV)
+    result = stats.loc[regular].copy()
+    period_days = periods[nearest[regular]]
+    result["cadence"] = np.array(names, dtype=object)[nearest[regular]]
+    result["next_expected"] = result["last_payment"] + pd.to_timedelta(period_days, unit="D")
+    result["annualised_cost"] = result["average_amount"] * (365.25 / period_days)
+
+    result = result.reset_index().sort_values("annualised_cost", ascending=False)
+    return result[columns].reset_index(drop=True)
+
+
+def category_trends(frame: pd.DataFrame, months: int = TREND_MONTHS) -> pd.DataFrame:
+    """
+    Spending trend per category over the last few months.
+
+    Spend is pivoted to a month x category matrix and the least-squares slope
+    of every column is computed in one matrix expression.
+
+    Returns:
+        pd.DataFrame: One row per category with total, monthly_average,
+            latest_month, slope (change per month) and change_pct (latest month
+            against the average of the months before it), ordered by total
+    """
+    columns = ["category", "total", "monthly_average", "latest_month", "slope", "change_pct"]
+    spend = frame.loc[(frame["amount"] < 0) & frame["category"].notna()]
+    if spend.empty:
+        return pd.DataFrame(columns=columns)
+
+    matrix = spend.assign(spend=-spend["amount"]).pivot_table(
+        index="month", columns="category", values="spend", aggfunc="sum", fill_value=0.0
+    )
+    window = pd.date_range(end=frame["month"].max(), periods=months, freq="MS")
+    matrix = matrix.reindex(window, fill_value=0.0)
+
+    values = matrix.to_numpy(dtype=float)
+    t = np.arange(len(window), dtype=float)
+    t_centred = t - t.mean()
+    slope = t_centred @ (values - values.mean(axis=0)) / (t_centred @ t_centred)
+
+    latest = values[-1]
+    previous = values[:-1].mean(axis=0) if len(values) > 1 else np.zeros_like(latest)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change_pct = np.where(previous > 0, (latest - previous) / previous * 100, np.nan)
+
+    trends = pd.DataFrame({
+        "category": matrix.columns,
+        "total": values.sum(axis=0),
+        "monthly_average": values.mean(axis=0),
+        "latest_month": latest,
+        "slope": slope,
+        "change_pct": change_pct,
+    }, columns=columns)
+    return trends.sort_values("total", ascending=False).reset_index(drop=True)
+
+
+def _records(frame: pd.DataFrame) -> List[Dict[str, Any]]:
+    """DataFrame rows as JSON-friendly dicts (rounded floats, ISO dates, None for NaN)."""
+    columns = {}
+    for column in frame.columns:
+        series = frame[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            series = series.dt.strftime("%Y-%m-%d")
+        elif pd.api.types.is_float_dtype(series):
+            series = series.round(2)
+        columns[column] = [None if pd.isna(value) else value for value in series.tolist()]
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def compute_analytics(rows: List[Dict], currency: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Cash flow, burn, recurring vendors and category trends for one user.
+
+    Args:
+        rows (List[Dict]): Transaction rows selected with ANALYTICS_COLUMNS or ANALYTICS_SQL
+        currency (Optional[str]): Currency to analyse; defaults to the most used one
+
+    Returns:
+        Dict[str, Any]: currency, cash_flow (monthly inflow/outflow/net with
+            burn), recurring_vendors and category_trends
+    """
+    frame = build_transaction_frame(rows)
+    currency = currency or primary_currency(frame)
+    if currency is not None:
+        frame = frame[frame["currency"] == currency]
+
+    cash_flow = monthly_cash_flow(frame)
+    burn = rolling_burn(cash_flow)
+    monthly = cash_flow.join(burn).rename_axis("month").reset_index()
+
+    return {
+        "currency": currency,
+        "cash_flow": _records(monthly),
+        "recurring_vendors": _records(recurring_vendors(frame)),
+        "category_trends": _records(category_trends(frame)),
+    }
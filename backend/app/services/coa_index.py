@@ -0,0 +1,220 @@
+"""In-process vector index over a user's chart of accounts"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import orjson
+
+from app.core.supabase_client import get_supabase
+from app.services.hybrid_search import DEFAULT_VECTOR_WEIGHT, BM25Index, fuse_scores, top_k
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on how long an index is trusted without an explicit invalidation,
+# for COA edits made outside this process (e.g. directly in Supabase)
+INDEX_TTL_SECONDS = 600
+
+# Columns needed to build an index; the RPC returns the same fields under these names
+ACCOUNT_FIELDS = "id, account_id, code, name, account_type, description, status"
+
+
+def _parse_embedding(value: Any) -> Optional[List[float]]:
+    """pgvector columns come back from PostgREST as a '[0.1,0.2,...]' string."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        # orjson parses these float arrays several times faster than json
+        value = orjson.loads(value)
+    return value if len(value) else None
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class CoAVectorIndex:
+    """
+    A NumPy matrix of unit-normalized account embeddings for one user.
+
+    Cosine similarity against every account is a single matrix multiply, so a
+    whole statement's worth of query embeddings is scored in one call. A BM25
+    index over account names, codes, types and descriptions backs hybrid search.
+    """
+
+    def __init__(self, accounts: List[Dict[str, Any]], embeddings: np.ndarray):
+        self.accounts = accounts
+        self.matrix = _normalize(embeddings.astype(np.float32, copy=False))
+        self.keywords = BM25Index([
+            ' '.join(filter(None, (
+                account.get('account_code'),
+                account.get('account_name'),
+                account.get('account_type'),
+                account.get('description'),
+            )))
+            for account in accounts
+        ])
+        self.loaded_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.accounts)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() - self.loaded_at > INDEX_TTL_SECONDS
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Dict[str, Any]], embedding_column: str) -> "CoAVectorIndex":
+        accounts, vectors = [], []
+        for row in rows:
+            embedding = _parse_embedding(row.get(embedding_column))
+            if embedding is None:
+                continue
+            accounts.append({
+                'id': row.get('id'),
+                'account_id': row.get('account_id'),
+                'account_code': row.get('code'),
+                'account_name': row.get('name'),
+                'account_type': row.get('account_type'),
+                'description': row.get('description') or '',
+            })
+            vectors.append(embedding)
+
+        if not vectors:
+            return cls([], np.zeros((0, 0), dtype=np.float32))
+        return cls(accounts, np.asarray(vectors, dtype=np.float32))
+
+    def search_many(
+        self,
+        query_embeddings: Sequence[Sequence[float]] | np.ndarray,
+        match_count: int = 10,
+        similarity_threshold: float = 0.0,
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Return the top matching accounts for each query embedding.
+
+        Args:
+            query_embeddings: Query vectors, one per row
+            match_count: Maximum number of accounts per query
+            similarity_threshold: Minimum cosine similarity to include
+
+        Returns:
+            One list of matches per query, best first, each shaped like the
+            search_account_embeddings RPC rows with a 'similarity' score
+        """
+        similarities = self.similarities(query_embeddings)
+        indices, scores = top_k(similarities, match_count)
+        return [
+            [
+                {**self.accounts[i], 'similarity': score}
+                for i, score in zip(row_indices, row_scores)
+                if score >= similarity_threshold
+            ]
+            for row_indices, row_scores in zip(indices.tolist(), scores.tolist())
+        ]
+
+    def similarities(self, query_embeddings: Sequence[Sequence[float]] | np.ndarray) -> np.ndarray:
+        """Cosine similarity of each query (rows) against each account (columns)."""
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[np.newaxis, :]
+        if not len(self.accounts) or not len(queries):
+            return np.zeros((len(queries), len(self.accounts)), dtype=np.float32)
+        if queries.shape[1] != self.matrix.shape[1]:
+            raise ValueError(
+                f"Query dimension {queries.shape[1]} does not match index dimension {self.matrix.shape[1]}"
+            )
+        return _normalize(queries) @ self.matrix.T
+
+    def hybrid_search_many(
+        self,
+        query_texts: Sequence[str],
+        query_embeddings: Sequence[Sequence[float]] | np.ndarray,
+        match_count: int = 10,
+        vector_weight: float = DEFAULT_VECTOR_WEIGHT,
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Rank accounts by a fusion of vector similarity and BM25 keyword score.
+
+        Args:
+            query_texts: Query strings, aligned with query_embeddings
+            query_embeddings: Query vectors, one per row
+            match_count: Maximum number of accounts per query
+            vector_weight: Share of the fused score given to vector similarity
+
+        Returns:
+            One list of matches per query, best first, with 'similarity' (cosine),
+            'keyword_score' (raw BM25) and the fused 'score'
+        """
+        similarities = self.similarities(query_embeddings)
+        keyword_scores = self.keywords.scores_many(list(query_texts))
+        if not len(self.accounts):
+            return [[] for _ in range(len(similarities))]
+        fused = fuse_scores(similarities, keyword_scores, vector_weight)
+        indices, scores = top_k(fused, match_count)
+        return [
+            [
+                {
+                    **self.accounts[i],
+                    'similarity': float(similarities[row, i]),
+                    'keyword_score': float(keyword_scores[row, i]),
+                    'score': score,
+                }
+                for i, score in zip(row_indices, row_scores)
+            ]
+            for row, (row_indices, row_scores) in enumerate(zip(indices.tolist(), scores.tolist()))
+        ]
+
+    def search(
+        self,
+        query_embedding: Sequence[float],
+        match_count: int = 10,
+        similarity_threshold: float = 0.0,
+    ) -> List[Dict[str, Any]]:
+        return self.search_many([query_embedding], match_count, similarity_threshold)[0]
+
+
+_indexes: Dict[Tuple[str, str], CoAVectorIndex] = {}
+_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+
+
+async def _load_index(user_id: str, embedding_column: str) -> CoAVectorIndex:
+    supabase = await get_supabase()
+    query = supabase.table('chart_of_accounts') \
+        .select(f"{ACCOUNT_FIELDS}, {embedding_column}") \
+        .eq('status', 'ACTIVE')
+    # 'ALL' is the shared chart of accounts used by the search_account_embeddings RPC
+    if user_id != 'ALL':
+        query = query.eq('user_id', user_id)
+    result = await query.execute()
+
+    index = CoAVectorIndex.from_rows(result.data, embedding_column)
+    logger.info(f"Loaded COA index for user {user_id} ({embedding_column}): {len(index)} accounts")
+    return index
+
+
+async def get_coa_index(user_id: str, embedding_column: str = 'embedding') -> CoAVectorIndex:
+    """Get the cached index for a user, loading it from Supabase on first use or after expiry."""
+    key = (user_id, embedding_column)
+    index = _indexes.get(key)
+    if index is not None and not index.expired:
+        return index
+
+    lock = _locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        index = _indexes.get(key)
+        if index is None or index.expired:
+            index = await _load_index(user_id, embedding_column)
+            _indexes[key] = index
+    return index
+
+
+def invalidate_coa_index(user_id: str) -> None:
+    """Drop cached indexes for a user; call after any write to their chart_of_accounts rows."""
+    for key in [key for key in _indexes if key[0] in (user_id, 'ALL')]:
+        _indexes.pop(key, None)
+    logger.debug(f"Invalidated COA index for user {user_id}")
@@ -0,0 +1,35 @@
+"""Normalisation of counterparty names from bank statements and invoices"""
+
+import re
+
+# Tokens that vary between statements of the same counterparty
+LEGAL_SUFFIXES = {
+    "ltd", "limited", "plc", "llc", "llp", "inc", "incorporated", "corp",
+    "corporation", "co", "company", "gmbh", "bv", "sa", "sarl", "pte", "pty",
+}
+# Payment-type words banks add around the counterparty on statement lines
+STATEMENT_NOISE = {
+    "card", "payment", "payments", "to", "from", "dd", "direct", "debit", "so",
+    "standing", "order", "fp", "faster", "bgc", "bacs", "tfr", "transfer", "ref", "pos",
+}
+_DOMAIN_SUFFIX = re.compile(r"\.(com|co\.uk|uk|io|ai|net|org|co|app|dev)\b")
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_counterparty(name: str, statement: bool = False) -> str:
+    """
+    Comparable form of a counterparty name.
+
+    Lowercases, drops domain suffixes, punctuation, bare reference numbers and
+    legal suffixes: "DIGITALOCEAN.COM" and "DigitalOcean LLC" both become
+    "digitalocean". With statement=True, bank payment-type words are dropped
+    too, so "CARD PAYMENT TO DIGITALOCEAN" also becomes "digitalocean".
+    """
+    text = _DOMAIN_SUFFIX.sub(" ", name.lower())
+    ignored = LEGAL_SUFFIXES | STATEMENT_NOISE if statement else LEGAL_SUFFIXES
+    tokens = [
+        token for token in _NON_ALNUM.sub(" ", text).split()
+        if not token.isdigit() and token not in ignored
+    ]
+    # A name made only of suffixes or digits still needs a stable form
+    return " ".join(tokens) or _NON_ALNUM.sub(" ", name.lower()).strip()
@@ -0,0 +1,198 @@
+import json
+import logging
+from functools import lru_cache
+from typing import Iterable, List, NamedTuple, Sequence
+
+import numpy as np
+from tiktoken import Encoding, encoding_for_model
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gpt-4o"
+
+# Separator used by process_pdf between pages so the page structure survives
+# being stored as a single text blob.
+PAGE_BREAK = "\f"
+
+
+class Chunk(NamedTuple):
+    text: str
+    token_count: int
+
+
+@lru_cache(maxsize=8)
+def get_encoder(model: str = DEFAULT_MODEL) -> Encoding:
+    """Return the tiktoken encoder for a model, loading it only once per process."""
+    logger.debug(f"Loading tiktoken encoder for {model}")
+    return encoding_for_model(model)
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    return len(get_encoder(model).encode_ordinary(text))
+
+
+def _token_byte_offsets(encoder: Encoding, tokens: np.ndarray) -> np.ndarray:
+    """
+    Map every token boundary to a byte offset in the UTF-8 encoded text.
+
+    Byte lengths are looked up once per distinct token, so the cost is bounded by
+    the document's vocabulary rather than its length.
+    """
+    unique_tokens, inverse = np.unique(tokens, return_inverse=True)
+    unique_lengths = np.fromiter(
+        (len(encoder.decode_single_token_bytes(int(t))) for t in unique_tokens),
+        dtype=np.int64,
+        count=len(unique_tokens),
+    )
+    offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+    np.cumsum(unique_lengths[inverse], out=offsets[1:])
+    return offsets
+
+
+def _window_chunks(
+    text: str,
+    max_window_size: int,
+    overlap: int,
+    encoder: Encoding,
+) -> List[Chunk]:
+    """Tokenize once and cut overlapping windows as byte slices of the source text."""
+    if max_window_size <= 0:
+        raise ValueError("max_window_size must be positive")
+    if not 0 <= overlap < max_window_size:
+        raise ValueError("overlap must be between 0 and max_window_size - 1")
+    if not text:
+        return []
+
+    tokens = np.asarray(encoder.encode_ordinary(text), dtype=np.uint32)
+    n_tokens = len(tokens)
+    if n_tokens <= max_window_size:
+        return [Chunk(text, n_tokens)]
+
+    offsets = _token_byte_offsets(encoder, tokens)
+    data = memoryview(text.encode("utf-8"))
+
+    starts = np.arange(0, n_tokens, max_window_size - overlap)
+    ends = np.minimum(starts + max_window_size, n_tokens)
+    chunks = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        # Windows start and end on token boundaries; a token that splits a
+        # multi-byte character leaves a partial byte which is dropped.
+        window = data[offsets[start]:offsets[end]]
+        chunks.append(Chunk(str(window, "utf-8", "ignore"), end - start))
+    return chunks
+
+
+def sliding_window_chunking(text: str, max_window_size: int = 600, overlap: int = 200) -> List[str]:
+    """
+    Split text into overlapping chunks of specified token size.
+
+    Args:
+        text (str): The input text to be chunked
+        max_window_size (int, optional): Maximum number of tokens per chunk. Defaults to 600.
+        overlap (int, optional): Number of overlapping tokens between chunks. Defaults to 200.
+
+    Returns:
+        List[str]: List of text chunks with specified overlap
+    """
+    return [chunk.text for chunk in _window_chunks(text, max_window_size, overlap, get_encoder())]
+
+
+def chunk_text(
+    text: str,
+    max_window_size: int = 600,
+    overlap: int = 200,
+    model: str = DEFAULT_MODEL,
+) -> List[Chunk]:
+    """
+    Sliding-window chunking that also returns each chunk's token count.
+
+    Args:
+        text (str): The input text to be chunked
+        max_window_size (int, optional): Maximum number of tokens per chunk. Defaults to 600.
+        overlap (int, optional): Number of overlapping tokens between chunks. Defaults to 200.
+        model (str, optional): Model whose tokenizer is used. Defaults to gpt-4o.
+
+    Returns:
+        List[Chunk]: Chunks with their token counts
+    """
+    return _window_chunks(text, max_window_size, overlap, get_encoder(model))
+
+
+def _pack_segments(
+    segments: Sequence[str],
+    max_window_size: int,
+    overlap: int,
+    encoder: Encoding,
+    split_oversized: bool,
+) -> List[Chunk]:
+    """Greedily merge consecutive segments into newline-joined chunks under the budget."""
+    # encode_ordinary_batch tokenizes the segments on tiktoken's thread pool
+    token_counts = [len(tokens) for tokens in encoder.encode_ordinary_batch(list(segments))]
+
+    chunks: List[Chunk] = []
+    buffer: List[str] = []
+    buffer_tokens = 0
+    for segment, segment_tokens in zip(segments, token_counts):
+        if not segment_tokens:
+            continue
+        oversized = segment_tokens > max_window_size
+        # +1 accounts for the newline joining segments in a merged chunk
+        if buffer and (oversized or buffer_tokens + segment_tokens + 1 > max_window_size):
+            chunks.append(Chunk("\n".join(buffer), buffer_tokens))
+            buffer, buffer_tokens = [], 0
+        if oversized and split_oversized:
+            chunks.extend(_window_chunks(segment, max_window_size, overlap, encoder))
+            continue
+        buffer_tokens += segment_tokens + (1 if buffer else 0)
+        buffer.append(segment)
+    if buffer:
+        chunks.append(Chunk("\n".join(buffer), buffer_tokens))
+    return chunks
+
+
+def chunk_by_pages(
+    pages: Sequence[str],
+    max_window_size: int = 600,
+    overlap: int = 200,
+    model: str = DEFAULT_MODEL,
+) -> List[Chunk]:
+    """
+    Pack whole pages into chunks without crossing the token budget.
+
+    Consecutive small pages are merged into one chunk; a page larger than the
+    budget is split on its own with the sliding window, so chunks never straddle
+    a page break unless the pages fit together entirely.
+
+    Args:
+        pages (Sequence[str]): Page texts in document order
+        max_window_size (int, optional): Maximum number of tokens per chunk. Defaults to 600.
+        overlap (int, optional): Overlap used when a single page has to be split. Defaults to 200.
+        model (str, optional): Model whose tokenizer is used. Defaults to gpt-4o.
+
+    Returns:
+        List[Chunk]: Chunks with their token counts
+    """
+    return _pack_segments(pages, max_window_size, overlap, get_encoder(model), split_oversized=True)
+
+
+def chunk_by_rows(
+    rows: Iterable[dict],
+    max_window_size: int = 600,
+    model: str = DEFAULT_MODEL,
+) -> List[Chunk]:
+    """
+    Group table rows into chunks of whole rows, one JSON object per line.
+
+    A single row that exceeds the budget is kept intact as its own chunk, since
+    splitting a row would separate values from their column headers.
+
+    Args:
+        rows (Iterable[dict]): Table rows, e.g. from process_excel or process_csv
+        max_window_size (int, optional): Maximum number of tokens per chunk. Defaults to 600.
+        model (str, optional): Model whose tokenizer is used. Defaults to gpt-4o.
+
+    Returns:
+        List[Chunk]: Chunks with their token counts
+    """
+    lines = [json.dumps(row, ensure_ascii=False) for row in rows]
+    return _pack_segments(lines, max_window_size, 0, get_encoder(model), split_oversized=False)
@@ -10,6 +10,7 @@ from fastapi import UploadFile, BackgroundTasks
 
 from app.core.supabase_client import get_supabase
 from app.services.etl.vectorise_data import kb_item_to_chunks
+from app.services.etl.chunking import PAGE_BREAK
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -56,7 +57,8 @@ async def process_pdf(file: UploadFile) -> str:
 
     pdf_content = await file.read()
     pdf_reader = PdfReader(io.BytesIO(pdf_content))
-    content = "\n".join(page.extract_text() for page in pdf_reader.pages)
+    # Keep page boundaries so chunking can split on them
+    content = PAGE_BREAK.join(page.extract_text() for page in pdf_reader.pages)
     logger.info(f"PDF processed. Number of pages: {len(pdf_reader.pages)}")
     return content
 
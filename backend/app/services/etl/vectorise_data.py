@@ -1,5 +1,5 @@
+import asyncio
 import logging
-from tiktoken import encoding_for_model
 import requests
 import json
 import os
@@ -12,6 +12,7 @@ load_dotenv()
 from openai import AsyncOpenAI
 import voyageai
 from app.core.supabase_client import get_supabase
+from app.services.etl.chunking import PAGE_BREAK, chunk_by_pages, count_tokens, sliding_window_chunking
 
 openai = AsyncOpenAI()
 
@@ -46,35 +47,6 @@ def clean_data(data: str) -> str:
     )
     return cleaned_text
 
-def count_tokens(text: str, model: str = "gpt-4o") -> int:
-    encoder = encoding_for_model(model)
-    tokens = encoder.encode(text)
-    return len(tokens)
-
-def sliding_window_chunking(text: str, max_window_size: int = 600, overlap: int = 200) -> List[str]:
-    """
-    Split text into overlapping chunks of specified token size.
-
-    Args:
-        text (str): The input text to be chunked
-        max_window_size (int, optional): Maximum number of tokens per chunk. Defaults to 600.
-        overlap (int, optional): Number of overlapping tokens between chunks. Defaults to 200.
-
-    Returns:
-        List[str]: List of text chunks with specified overlap
-    """
-    encoder = encoding_for_model("gpt-4o")  # Use the same model as in count_tokens
-    tokens = encoder.encode(text)
-    chunks = []
-    start = 0
-    while start < len(tokens):
-        end = start + max_window_size
-        chunk_tokens = tokens[start:end]
-        chunk = encoder.decode(chunk_tokens)
-        chunks.append(chunk)
-        start += max_window_size - overlap
-    return chunks
-
 async def insert_chunk(
     parent_id: str, 
     content: str, 
@@ -191,6 +163,54 @@ async def get_voyage_embedding(text: str, input_type: Literal["document", "query
         logger.error(f"Failed to get embedding from Voyage AI: {str(e)}")
         raise
 
+# Voyage accepts at most this many texts per embed request
+VOYAGE_BATCH_SIZE = 128
+
+async def get_voyage_embeddings(
+    texts: List[str],
+    input_type: Literal["document", "query"],
+    batch_size: int = VOYAGE_BATCH_SIZE,
+    max_concurrency: int = 4,
+) -> List[List[float]]:
+    """
+    Embed many texts with Voyage AI using batched requests.
+
+    Args:
+        texts (List[str]): Texts to embed; the result keeps the same order
+        input_type (Literal["document", "query"]): Voyage input type
+        batch_size (int, optional): Texts per request. Defaults to 128.
+        max_concurrency (int, optional): Requests in flight at once. Defaults to 4.
+
+    Returns:
+        List[List[float]]: One embedding per input text
+    """
+    voyage_api_key = os.getenv("VOYAGE_API_KEY")
+    if not voyage_api_key:
+        raise ValueError("VOYAGE_API_KEY is not set")
+    if not texts:
+        return []
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    logger.info(f"Requesting {len(texts)} embeddings from Voyage AI in {len(batches)} batches")
+    client = voyageai.AsyncClient(api_key=voyage_api_key, max_retries=3)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def embed_batch(batch: List[str]) -> List[List[float]]:
+        async with semaphore:
+            response = await client.embed(
+                texts=batch,
+                model="voyage-finance-2",
+                input_type=input_type
+            )
+            return response.embeddings
+
+    try:
+        results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    except Exception as e:
+        logger.error(f"Failed to get batch embeddings from Voyage AI: {str(e)}")
+        raise
+    return [embedding for batch in results for embedding in batch]
+
 
 async def process_item(item_id: str, content: str, user_id: str, title: str, source_table: str) -> int:
     """
@@ -209,16 +229,15 @@ async def process_item(item_id: str, content: str, user_id: str, title: str, sou
         Exception: If chunk processing fails
     """
     logger.info(f"Processing item {item_id} for user {user_id}")
-    chunks = sliding_window_chunking(content)
+    # Page breaks are only present for PDFs; other documents are a single page
+    chunks = chunk_by_pages(content.split(PAGE_BREAK))
     logger.info(f"Created {len(chunks)} chunks for processing")
     total_tokens = 0
-    for index, chunk in enumerate(chunks):
+    for index, (chunk, token_count) in enumerate(chunks):
         logger.debug(f"Processing chunk {index}/{len(chunks)}")
         try:
             # Get embeddings from Voyage AI (no token count)
             embedding = await get_voyage_embedding(text=chunk, input_type="document")
-            # Estimate token count using tiktoken (approximate)
-            token_count = count_tokens(chunk)
             await insert_chunk(
                 item_id,
                 chunk,
@@ -0,0 +1,190 @@
+"""Streaming encoders for transaction exports as CSV, Parquet or XLSX"""
+
+import asyncio
+import csv
+import tempfile
+import zlib
+from io import StringIO
+from typing import Any, AsyncIterator, Dict, List, Literal
+
+ExportFormat = Literal['csv', 'parquet', 'xlsx']
+
+EXPORT_FIELDS = [
+    "id",
+    "user_id",
+    "creditor_name",
+    "debtor_name",
+    "amount",
+    "currency",
+    "remittance_info",
+    "code",
+    "created_at",
+    "institution_id",
+    "iban",
+    "bban",
+    "transaction_id",
+    "internal_transaction_id",
+    "logo",
+    "category",
+    "chart_of_accounts",
+    "agreement_id",
+    "ntropy_enrich",
+    "coa_reason",
+    "coa_confidence",
+    "coa_set_by"
+]
+
+# Rows per database round trip; well under PostgREST's max-rows cap
+EXPORT_BATCH_SIZE = 1000
+
+# Size of the pieces a finished XLSX file is streamed back in
+FILE_CHUNK_SIZE = 64 * 1024
+
+MEDIA_TYPES: Dict[str, str] = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+Batch = List[Dict[str, Any]]
+
+
+async def csv_chunks(batches: AsyncIterator[Batch]) -> AsyncIterator[bytes]:
+    """Encode batches as CSV, one chunk per batch, starting with the header."""
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    yield buffer.getvalue().encode('utf-8')
+
+    async for rows in batches:
+        buffer.seek(0)
+        buffer.truncate(0)
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back out instead of keeping them."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def writable(self) -> bool:
+        return True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _parquet_schema():
+    import pyarrow as pa
+
+    types = {
+        "amount": pa.float64(),
+        "created_at": pa.timestamp('us', tz='UTC'),
+        "ntropy_enrich": pa.bool_(),
+        "coa_confidence": pa.float64(),
+    }
+    return pa.schema([(field, types.get(field, pa.string())) for field in EXPORT_FIELDS])
+
+
+def _parquet_table(rows: Batch, schema):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    columns = []
+    for field in schema:
+        values = [row.get(field.name) for row in rows]
+        if pa.types.is_timestamp(field.type):
+            # PostgREST returns ISO 8601 strings; Arrow parses them natively
+            columns.append(pc.cast(pa.array(values, type=pa.string()), field.type))
+        else:
+            columns.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+async def parquet_chunks(batches: AsyncIterator[Batch]) -> AsyncIterator[bytes]:
+    """Encode batches as a Parquet file, one row group per batch."""
+    import pyarrow.parquet as pq
+
+    schema = _parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    try:
+        async for rows in batches:
+            writer.write_table(_parquet_table(rows, schema))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    # Closing writes the footer, which readers need to open the file
+    yield sink.drain()
+
+
+async def xlsx_chunks(batches: AsyncIterator[Batch]) -> AsyncIterator[bytes]:
+    """
+    Encode batches as an XLSX workbook.
+
+    XLSX is a zip archive, so nothing can be sent until the workbook is complete.
+    Write-only mode spools rows to a temporary file as they are appended, keeping
+    memory flat; the finished file is then streamed back in chunks.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Transactions")
+    sheet.append(EXPORT_FIELDS)
+    async for rows in batches:
+        for row in rows:
+            sheet.append([row.get(field) for field in EXPORT_FIELDS])
+
+    with tempfile.TemporaryFile() as output:
+        await asyncio.to_thread(workbook.save, output)
+        output.seek(0)
+        while chunk := output.read(FILE_CHUNK_SIZE):
+            yield chunk
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes], level: int = 6) -> AsyncIterator[bytes]:
+    """Gzip a byte stream incrementally."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+ENCODERS = {
+    'csv': csv_chunks,
+    'parquet': parquet_chunks,
+    'xlsx': xlsx_chunks,
+}
+
+
+def export_filename(export_format: ExportFormat, gzip: bool = False) -> str:
+    return f"transactions.{export_format}" + (".gz" if gzip else "")
+
+
+def export_media_type(export_format: ExportFormat, gzip: bool = False) -> str:
+    return 'application/gzip' if gzip else MEDIA_TYPES[export_format]
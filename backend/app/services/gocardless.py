@@ -1,3 +1,4 @@
+import asyncio
 import os 
 import requests
 from dotenv import load_dotenv
@@ -6,7 +7,10 @@ import logging
 import uuid  # Add UUID import
 from datetime import datetime, timedelta
 
+from app.core.cache import invalidate_user
+from app.core.dataloader import get_loader
 from app.core.supabase_client import get_supabase
+from app.services.transactions import invalidate_transaction_count
 
 load_dotenv()
 
@@ -139,8 +143,8 @@ async def store_requisition_data(requisition_data: dict):
     # First verify the user exists
     user_id = requisition_data.get('user_id')
     if user_id:
-        user_result = await supabase.table('users').select('user_id').eq('user_id', user_id).execute()
-        if not user_result.data:
+        user_rows = await get_loader('users', 'user_id', 'user_id').load(user_id)
+        if not user_rows:
             logger.error(f"User {user_id} not found in users table")
             raise ValueError(f"User {user_id} not found in users table. Please ensure user exists before creating agreement.")
     
@@ -162,6 +166,7 @@ async def store_requisition_data(requisition_data: dict):
         result = await supabase.table('gocardless_agreements').insert(data).execute()
         # Store in cache using reference as key
         link_data_cache[data['reference']] = data
+        agreements_by_reference().prime(data['reference'], [data])
         logger.info("Link data stored successfully in database and cache")
         return result
     except Exception as e:
@@ -178,8 +183,11 @@ async def add_account(reference: str):
         access_token = access_token['access']
         logger.debug("Successfully obtained access token")
 
-        requisition_id = await get_requisition_id(reference)
-        user_id = await get_user_id_from_reference(reference)
+        # Both lookups resolve from a single agreements query
+        requisition_id, user_id = await asyncio.gather(
+            get_requisition_id(reference),
+            get_user_id_from_reference(reference)
+        )
 
         # Fetch requisition details
         requisition_data = await get_requisition_data(requisition_id, access_token)
@@ -254,6 +262,7 @@ async def store_account_details(account_details: dict, user_id: str, agreement_i
             .execute()
             
         logger.info(f"Successfully stored/updated account details for account {account_details.get('id')}")
+        await invalidate_user(user_id)
         return result
     except Exception as e:
         logger.error(f"Failed to store account details: {str(e)}")
@@ -430,11 +439,17 @@ async def store_transactions(transactions: dict, user_id: str, agreement_id: str
     try:
         result = await supabase.table('gocardless_transactions').insert(formatted_transactions).execute()
         logger.info(f"Successfully stored {len(formatted_transactions)} transactions")
+        invalidate_transaction_count(user_id)
+        await invalidate_user(user_id)
         return result
     except Exception as e:
         logger.error(f"Failed to store transactions: {str(e)}")
         raise
 
+def agreements_by_reference():
+    """Request-scoped loader for agreements by reference, shared by the lookups below."""
+    return get_loader('gocardless_agreements', 'reference', 'id, user_id, reference')
+
 async def get_user_id_from_reference(reference: str) -> str:
     logger.info(f"Fetching user ID for reference: {reference}")
     
@@ -443,11 +458,11 @@ async def get_user_id_from_reference(reference: str) -> str:
         return link_data_cache[reference]['user_id']
     
     logger.debug("User ID not in cache, querying database")
-    supabase = await get_supabase()
-    result = await supabase.table('gocardless_agreements').select('user_id').eq('reference', reference).execute()
+    agreement = await agreements_by_reference().load_one(reference)
     
-    if result.data and len(result.data) > 0 and result.data[0]['user_id']:
-        user_id = result.data[0]['user_id']
+    if agreement and agreement.get('user_id'):
+        user_id = agreement['user_id']
+        link_data_cache[reference] = agreement
         logger.debug(f"Found user ID in database: {user_id}")
         return user_id
     
@@ -462,13 +477,12 @@ async def get_requisition_id(reference: str) -> str:
         return link_data_cache[reference]['id']
     
     logger.debug("Requisition ID not in cache, querying database")
-    supabase = await get_supabase()
-    result = await supabase.table('gocardless_agreements').select('id').eq('reference', reference).execute()
+    agreement = await agreements_by_reference().load_one(reference)
     
-    if result.data and len(result.data) > 0:
-        requisition_id = result.data[0]['id']
+    if agreement:
+        requisition_id = agreement['id']
         # Store in cache for future use
-        link_data_cache[reference] = result.data[0]
+        link_data_cache[reference] = agreement
         logger.debug("Found requisition ID in database")
         return requisition_id
     
@@ -0,0 +1,116 @@
+"""Keyword (BM25) scoring and score fusion for hybrid retrieval"""
+
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Weight of the vector score in the fused score; the remainder goes to BM25
+DEFAULT_VECTOR_WEIGHT = 0.6
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase alphanumeric tokens, so account codes and amounts stay searchable."""
+    return _TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+class BM25Index:
+    """
+    An in-memory inverted index scored with Okapi BM25.
+
+    Postings are stored per term as NumPy arrays of (document position, term
+    frequency), so scoring a query only touches documents containing its terms.
+    """
+
+    def __init__(self, documents: Sequence[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.size = len(documents)
+
+        postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        lengths = np.zeros(self.size, dtype=np.float32)
+        for position, document in enumerate(documents):
+            terms = Counter(tokenize(document))
+            lengths[position] = sum(terms.values())
+            for term, frequency in terms.items():
+                postings[term].append((position, frequency))
+
+        average_length = float(lengths.mean()) if self.size and lengths.mean() > 0 else 1.0
+        # Length normalisation only depends on the document, so it is precomputed
+        self._length_norm = k1 * (1 - b + b * lengths / average_length)
+
+        self._postings: Dict[str, Tuple[np.ndarray, np.ndarray, float]] = {}
+        for term, entries in postings.items():
+            positions = np.fromiter((p for p, _ in entries), dtype=np.int64, count=len(entries))
+            frequencies = np.fromiter((f for _, f in entries), dtype=np.float32, count=len(entries))
+            document_frequency = len(entries)
+            idf = math.log(1 + (self.size - document_frequency + 0.5) / (document_frequency + 0.5))
+            self._postings[term] = (positions, frequencies, idf)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every document for the query (zeros where no term matches)."""
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(tokenize(query)):
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            positions, frequencies, idf = posting
+            scores[positions] += idf * frequencies * (self.k1 + 1) / (
+                frequencies + self._length_norm[positions]
+            )
+        return scores
+
+    def scores_many(self, queries: Sequence[str]) -> np.ndarray:
+        if not queries:
+            return np.zeros((0, self.size), dtype=np.float32)
+        return np.vstack([self.scores(query) for query in queries])
+
+
+def fuse_scores(
+    vector_scores: np.ndarray,
+    keyword_scores: np.ndarray,
+    vector_weight: float = DEFAULT_VECTOR_WEIGHT,
+) -> np.ndarray:
+    """
+    Combine cosine similarities with BM25 scores into one score in [0, 1].
+
+    BM25 scores are unbounded, so each query's row is scaled by its best keyword
+    match before the weighted sum; rows with no keyword hit rely on vectors only.
+    """
+    vector_scores = np.clip(np.atleast_2d(vector_scores), 0.0, 1.0)
+    keyword_scores = np.atleast_2d(keyword_scores)
+    row_max = keyword_scores.max(axis=1, keepdims=True) if keyword_scores.size else keyword_scores
+    keyword_norm = np.divide(
+        keyword_scores, row_max, out=np.zeros_like(keyword_scores), where=row_max > 0
+    )
+    return vector_weight * vector_scores + (1 - vector_weight) * keyword_norm
+
+
+def top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Indices and values of the k best scores per row, best first."""
+    scores = np.atleast_2d(scores)
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.zeros((scores.shape[0], 0))
+        return empty.astype(np.int64), empty
+    # argpartition finds the top k per row without sorting every candidate
+    indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    values = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-values, axis=1)
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+
+def score_margin(ranked_scores: Sequence[float]) -> float:
+    """Gap between the best and second-best score; a lone candidate has the full score as margin."""
+    if not ranked_scores:
+        return 0.0
+    if len(ranked_scores) == 1:
+        return float(ranked_scores[0])
+    return float(ranked_scores[0] - ranked_scores[1])
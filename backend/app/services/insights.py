@@ -0,0 +1,89 @@
+"""Spending insights served from the per-month rollups in sql/insight_rollups.sql"""
+
+import logging
+from collections import defaultdict
+from datetime import date
+from typing import Dict, List, Optional, Set
+
+from app.core.supabase_client import get_supabase
+from app.schemas.transactions import Insights
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_TABLE = 'insight_rollups'
+ROLLUP_FIELDS = 'month, dimension, key, amount, tx_count'
+
+# Users whose rollups have been rebuilt by this process, so an account with no
+# enriched transactions does not trigger a rebuild on every dashboard load
+_rebuilt_users: Set[str] = set()
+
+
+async def load_rollups(user_id: str, since: Optional[date] = None) -> List[Dict]:
+    """
+    Fetch a user's monthly rollup rows.
+
+    Args:
+        user_id (str): The ID of the user
+        since (Optional[date]): Only include months starting on or after this date
+
+    Returns:
+        List[Dict]: Rows with month, dimension ('category' or 'entity'), key, amount and tx_count
+    """
+    supabase = await get_supabase()
+    query = supabase.table(ROLLUP_TABLE).select(ROLLUP_FIELDS).eq('user_id', user_id)
+    if since is not None:
+        query = query.gte('month', since.isoformat())
+    result = await query.execute()
+    return result.data
+
+
+async def rebuild_rollups(user_id: str) -> int:
+    """Recompute a user's rollups from gocardless_transactions; returns the number of rows written."""
+    supabase = await get_supabase()
+    result = await supabase.rpc('rebuild_insight_rollups', {'p_user_id': user_id}).execute()
+    _rebuilt_users.add(user_id)
+    logger.info(f"Rebuilt insight rollups for user {user_id}: {result.data} rows")
+    return result.data or 0
+
+
+def summarise_rollups(rows: List[Dict]) -> Insights:
+    """Collapse monthly rollups into spending totals per category and per entity."""
+    totals: Dict[str, Dict[str, float]] = {'category': defaultdict(float), 'entity': defaultdict(float)}
+    for row in rows:
+        dimension_totals = totals.get(row['dimension'])
+        if dimension_totals is not None:
+            dimension_totals[row['key']] += float(row['amount'] or 0)
+
+    def ranked(dimension: str, label: str) -> List[Dict]:
+        # Amounts are stored in minor units
+        items = [
+            {label: str(key), "amount": round(amount / 100, 2)}
+            for key, amount in totals[dimension].items()
+        ]
+        items.sort(key=lambda x: x["amount"], reverse=True)
+        return items
+
+    return Insights(
+        spending_by_category=ranked('category', 'category'),
+        spending_by_entity=ranked('entity', 'entity')
+    )
+
+
+async def get_user_insights(user_id: str, since: Optional[date] = None) -> Insights:
+    """
+    Spending by category and entity for a user, read from the rollups.
+
+    Users whose rollups predate the trigger have none yet; they are rebuilt once
+    on first read.
+    """
+    rows = await load_rollups(user_id, since)
+    if not rows and user_id not in _rebuilt_users:
+        if await rebuild_rollups(user_id):
+            rows = await load_rollups(user_id, since)
+
+    insights = summarise_rollups(rows)
+    logger.info(
+        f"Loaded insights for user {user_id} from {len(rows)} rollup rows: "
+        f"{len(insights.spending_by_category)} categories, {len(insights.spending_by_entity)} entities"
+    )
+    return insights
@@ -0,0 +1,397 @@
+"""Match bank transactions to open invoices by amount, currency, date and counterparty"""
+
+import asyncio
+import logging
+import re
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+from dateutil import parser as date_parser
+from rapidfuzz import fuzz, process
+
+from app.core.supabase_client import get_supabase
+from app.services.counterparty import normalize_counterparty
+
+logger = logging.getLogger(__name__)
+
+# Links written by match_open_invoices (sql/invoice_transaction_matches.sql);
+# invoices and transactions listed there are no longer open
+INVOICE_MATCH_TABLE = 'invoice_transaction_matches'
+TRANSACTION_MATCH_COLUMNS = 'id, amount, currency, booking_date, creditor_name, debtor_name, remittance_info'
+# Rows per request when loading invoices and transactions; stays under PostgREST's max-rows
+LOAD_PAGE_SIZE = 1000
+
+# Amounts may differ by the larger of these, for bank fees and FX rounding
+AMOUNT_TOLERANCE_PENCE = 100
+AMOUNT_TOLERANCE_RATIO = 0.01
+# Payments are expected from this long before the due date (or issue date)
+# until this long after it
+MAX_DAYS_EARLY = 45
+MAX_DAYS_LATE = 90
+# Date score of invoices with no parseable date
+UNDATED_SCORE = 0.5
+# Ceiling of the amount score for amounts that differ at all, so an exact
+# amount beats a near one when everything else is equal
+INEXACT_AMOUNT_SCORE = 0.8
+
+AMOUNT_WEIGHT = 0.45
+NAME_WEIGHT = 0.4
+DATE_WEIGHT = 0.15
+# An exact amount on the due date scores 0.6 without any name similarity,
+# so a match needs the counterparty to agree as well
+MIN_MATCH_SCORE = 0.75
+# Unrelated names still share letters and score 0.3-0.5
+MIN_NAME_SCORE = 0.6
+
+_CURRENCY_SYMBOLS = {'£': 'GBP', '$': 'USD', '€': 'EUR'}
+_NOT_AMOUNT = re.compile(r'[^\d.\-]')
+_EPOCH = date(1970, 1, 1)
+
+
+def to_pence(value: Any) -> Optional[int]:
+    """Integer minor units from a number or a string like '£1,234.50'."""
+    if value is None:
+        return None
+    try:
+        if isinstance(value, (int, float, Decimal)):
+            amount = Decimal(str(value))
+        else:
+            amount = Decimal(_NOT_AMOUNT.sub('', str(value).replace(',', '')))
+    except InvalidOperation:
+        return None
+    return int((amount * 100).to_integral_value())
+
+
+def normalize_currency(value: Any) -> str:
+    """ISO code for a currency code or symbol; '' when unknown."""
+    text = str(value or '').strip().upper()
+    if text in _CURRENCY_SYMBOLS:
+        return _CURRENCY_SYMBOLS[text]
+    return text if len(text) == 3 and text.isalpha() else ''
+
+
+@lru_cache(maxsize=4096)
+def _parse_day(value: str) -> float:
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        # UK invoices write dates day first; dayfirst would misread ISO dates, hence the order
+        try:
+            parsed = date_parser.parse(value, dayfirst=True, default=datetime(2000, 1, 1))
+        except (ValueError, OverflowError):
+            return np.nan
+    return float((parsed.date() - _EPOCH).days)
+
+
+def to_day(value: Any) -> float:
+    """Days since 1970-01-01 for a date, datetime or date string; NaN when unparseable."""
+    if isinstance(value, datetime):
+        value = value.date()
+    if isinstance(value, date):
+        return float((value - _EPOCH).days)
+    if not value:
+        return np.nan
+    return _parse_day(str(value))
+
+
+class InvoiceIndex:
+    """
+    Open invoices in NumPy arrays sorted by amount in pence.
+
+    Each transaction's candidates are the invoices whose amount falls in its
+    tolerance window, found for every transaction at once with searchsorted.
+    Candidate pairs are then filtered by currency and date window and scored
+    in vectorised passes; only counterparty similarity needs string work, and
+    that is computed once per distinct pair of names.
+    """
+
+    def __init__(self, invoices: Sequence[Dict[str, Any]]):
+        rows = []
+        for invoice in invoices:
+            results = invoice.get('results') or {}
+            amount = results.get('amount') or {}
+            pence = to_pence(amount.get('total'))
+            if pence is None:
+                continue
+            dates = results.get('date') or {}
+            due = to_day(dates.get('due_date') or dates.get('payment_due_by'))
+            rows.append((
+                abs(pence),
+                normalize_currency(amount.get('currency')),
+                due if not np.isnan(due) else to_day(dates.get('issue_date')),
+                normalize_counterparty((results.get('invoice_from') or {}).get('name') or ''),
+                normalize_counterparty((results.get('invoice_to') or {}).get('name') or ''),
+                invoice,
+            ))
+        rows.sort(key=lambda row: row[0])
+
+        self.invoices = [row[5] for row in rows]
+        self.amounts = np.array([row[0] for row in rows], dtype=np.int64)
+        # Currencies as small integers; -1 (unknown) matches any currency
+        self._currency_codes: Dict[str, int] = {}
+        self.currencies = np.array(
+            [self._currency_codes.setdefault(row[1], len(self._currency_codes)) if row[1] else -1 for row in rows],
+            dtype=np.int64,
+        )
+        self.due_days = np.array([row[2] for row in rows], dtype=np.float64)
+        # Party names as ids into self.names; suppliers recur, so there are few distinct names
+        name_ids: Dict[str, int] = {}
+        self.from_names = np.array([name_ids.setdefault(row[3], len(name_ids)) for row in rows], dtype=np.int64)
+        self.to_names = np.array([name_ids.setdefault(row[4], len(name_ids)) for row in rows], dtype=np.int64)
+        self.names = list(name_ids)
+
+    def __len__(self) -> int:
+        return len(self.invoices)
+
+    def _score_pairs(self, transactions: Sequence[Dict[str, Any]], min_score: float = 0.0) -> Dict[str, np.ndarray]:
+        """Every (transaction, invoice) pair that passes the amount, currency and date filters, with scores."""
+        t_amounts = np.array([abs(to_pence(t.get('amount')) or 0) for t in transactions], dtype=np.int64)
+        # Currencies no invoice uses get -2, which only unknown-currency invoices accept
+        t_currencies = np.array(
+            [self._currency_codes.get(normalize_currency(t.get('currency')), -2) for t in transactions],
+            dtype=np.int64,
+        )
+        t_days = np.array([to_day(t.get('booking_date')) for t in transactions], dtype=np.float64)
+        tolerance = np.maximum(AMOUNT_TOLERANCE_PENCE, np.rint(t_amounts * AMOUNT_TOLERANCE_RATIO)).astype(np.int64)
+
+        # Pass 1: amount windows on the sorted index, expanded to flat pair arrays
+        lo = np.searchsorted(self.amounts, t_amounts - tolerance, side='left')
+        hi = np.searchsorted(self.amounts, t_amounts + tolerance, side='right')
+        counts = hi - lo
+        t_idx = np.repeat(np.arange(len(transactions)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        i_idx = np.repeat(lo, counts) + offsets
+
+        # Pass 2: currency and payment-date window
+        invoice_currencies = self.currencies[i_idx]
+        keep = (invoice_currencies == -1) | (invoice_currencies == t_currencies[t_idx])
+        delta = t_days[t_idx] - self.due_days[i_idx]
+        dated = ~np.isnan(delta)
+        keep &= ~dated | ((delta >= -MAX_DAYS_EARLY) & (delta <= MAX_DAYS_LATE))
+        t_idx, i_idx, delta, dated = t_idx[keep], i_idx[keep], delta[keep], dated[keep]
+
+        # Pass 3: amount and date scores, dropping pairs that could not reach
+        # min_score even with identical names
+        difference = self.amounts[i_idx] - t_amounts[t_idx]
+        amount_score = np.where(
+            difference == 0, 1.0, INEXACT_AMOUNT_SCORE * (1.0 - np.abs(difference) / (tolerance[t_idx] + 1))
+        )
+        lateness = np.where(delta < 0, -delta / MAX_DAYS_EARLY, delta / MAX_DAYS_LATE)
+        date_score = np.where(dated, 1.0 - np.nan_to_num(lateness), UNDATED_SCORE)
+        score = AMOUNT_WEIGHT * amount_score + DATE_WEIGHT * date_score
+        keep = score + NAME_WEIGHT >= min_score
+        t_idx, i_idx, difference = t_idx[keep], i_idx[keep], difference[keep]
+        amount_score, date_score, score = amount_score[keep], date_score[keep], score[keep]
+
+        # Pass 4: counterparty similarity
+        name_score = self._name_scores(transactions, t_idx, i_idx)
+        score = score + NAME_WEIGHT * name_score
+
+        return {
+            'transaction': t_idx,
+            'invoice': i_idx,
+            'score': score,
+            'amount_score': amount_score,
+            'name_score': name_score,
+            'date_score': date_score,
+            'amount_difference': difference,
+        }
+
+    def _name_scores(self, transactions: Sequence[Dict[str, Any]], t_idx: np.ndarray, i_idx: np.ndarray) -> np.ndarray:
+        """Best fuzzy similarity (0-1) of each pair's transaction counterparty to the invoice's parties."""
+        if not len(t_idx):
+            return np.zeros(0)
+        name_ids: Dict[str, int] = {}
+        t_names = np.array([
+            name_ids.setdefault(
+                normalize_counterparty(
+                    t.get('creditor_name') or t.get('debtor_name') or t.get('remittance_info') or '', statement=True
+                ),
+                len(name_ids),
+            )
+            for t in transactions
+        ], dtype=np.int64)
+        queries = list(name_ids)
+
+        scores = np.zeros(len(t_idx))
+        for party_names in (self.from_names, self.to_names):
+            # Score each distinct pair of names once; statements and suppliers repeat
+            keys = t_names[t_idx] * len(self.names) + party_names[i_idx]
+            unique_keys, inverse = np.unique(keys, return_inverse=True)
+            similarity = process.cpdist(
+                [queries[k] for k in (unique_keys // len(self.names)).tolist()],
+                [self.names[k] for k in (unique_keys % len(self.names)).tolist()],
+                scorer=fuzz.token_set_ratio,
+                workers=-1,
+            )
+            np.maximum(scores, similarity[inverse.reshape(-1)] / 100.0, out=scores)
+        return scores
+
+    def candidates(
+        self,
+        transactions: Sequence[Dict[str, Any]],
+        per_transaction: int = 3,
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Best-scoring invoices for each transaction, for review.
+
+        Returns:
+            One list per transaction, best first, of the invoice row with
+            'score', 'amount_score', 'name_score', 'date_score' and
+            'amount_difference' (pence, invoice minus transaction)
+        """
+        results: List[List[Dict[str, Any]]] = [[] for _ in transactions]
+        if not len(self) or not transactions:
+            return results
+        pairs = self._score_pairs(transactions)
+        order = np.lexsort((-pairs['score'], pairs['transaction']))
+        for p in order.tolist():
+            matches = results[int(pairs['transaction'][p])]
+            if len(matches) < per_transaction:
+                matches.append(self._describe(pairs, p))
+        return results
+
+    def match(
+        self,
+        transactions: Sequence[Dict[str, Any]],
+        min_score: float = MIN_MATCH_SCORE,
+    ) -> List[Dict[str, Any]]:
+        """
+        One-to-one matches between transactions and invoices.
+
+        Pairs scoring at least min_score, with names at least MIN_NAME_SCORE
+        alike, are assigned best first, so each invoice and each transaction
+        is used at most once.
+
+        Returns:
+            Matches with 'transaction_id', 'invoice_id', the scores and 'amount_difference'
+        """
+        if not len(self) or not transactions:
+            return []
+        pairs = self._score_pairs(transactions, min_score)
+        strong = np.flatnonzero((pairs['score'] >= min_score) & (pairs['name_score'] >= MIN_NAME_SCORE))
+        order = strong[np.argsort(-pairs['score'][strong], kind='stable')]
+
+        used_transactions, used_invoices, matches = set(), set(), []
+        for p in order.tolist():
+            t, i = int(pairs['transaction'][p]), int(pairs['invoice'][p])
+            if t in used_transactions or i in used_invoices:
+                continue
+            used_transactions.add(t)
+            used_invoices.add(i)
+            match = self._describe(pairs, p)
+            matches.append({
+                'transaction_id': transactions[t]['id'],
+                'invoice_id': match['id'],
+                **{key: match[key] for key in ('score', 'amount_score', 'name_score', 'date_score', 'amount_difference')},
+            })
+        return matches
+
+    def _describe(self, pairs: Dict[str, np.ndarray], p: int) -> Dict[str, Any]:
+        return {
+            **self.invoices[int(pairs['invoice'][p])],
+            'score': float(pairs['score'][p]),
+            'amount_score': float(pairs['amount_score'][p]),
+            'name_score': float(pairs['name_score'][p]),
+            'date_score': float(pairs['date_score'][p]),
+            'amount_difference': int(pairs['amount_difference'][p]),
+        }
+
+
+async def select_all(build_query: Callable[[], Any], key: str, page_size: int = LOAD_PAGE_SIZE) -> List[Dict[str, Any]]:
+    """
+    Every row of a query, fetched in keyset pages on a unique column.
+
+    A single select is silently capped at PostgREST's max-rows, so large
+    invoice books and statements are read page by page instead. build_query
+    returns a fresh filtered query builder for each page.
+    """
+    rows: List[Dict[str, Any]] = []
+    last = None
+    while True:
+        query = build_query()
+        if last is not None:
+            query = query.gt(key, last)
+        result = await query.order(key).limit(page_size).execute()
+        rows.extend(result.data)
+        if len(result.data) < page_size:
+            return rows
+        last = result.data[-1][key]
+
+
+async def load_open_invoices(client_id: str) -> List[Dict[str, Any]]:
+    """A client's invoices not yet linked to a transaction."""
+    supabase = await get_supabase()
+    invoices, matched = await asyncio.gather(
+        select_all(lambda: supabase.table('invoices').select('id, client_id, results').eq('client_id', client_id), 'id'),
+        select_all(
+            lambda: supabase.table(INVOICE_MATCH_TABLE).select('invoice_id').eq('client_id', client_id),
+            'invoice_id',
+        ),
+    )
+    matched_ids = {row['invoice_id'] for row in matched}
+    return [invoice for invoice in invoices if invoice['id'] not in matched_ids]
+
+
+async def load_unmatched_transactions(user_id: str, since: Optional[str] = None) -> List[Dict[str, Any]]:
+    """A user's transactions, booked on or after `since`, not yet linked to an invoice."""
+    supabase = await get_supabase()
+
+    def transactions_query():
+        query = supabase.table('gocardless_transactions') \
+            .select(TRANSACTION_MATCH_COLUMNS) \
+            .eq('user_id', user_id)
+        return query.gte('booking_date', since) if since else query
+
+    transactions, matched = await asyncio.gather(
+        select_all(transactions_query, 'id'),
+        select_all(
+            lambda: supabase.table(INVOICE_MATCH_TABLE).select('transaction_id').eq('user_id', user_id),
+            'transaction_id',
+        ),
+    )
+    matched_ids = {row['transaction_id'] for row in matched}
+    return [transaction for transaction in transactions if transaction['id'] not in matched_ids]
+
+
+async def match_open_invoices(
+    user_id: str,
+    client_id: str,
+    since: Optional[str] = None,
+    min_score: float = MIN_MATCH_SCORE,
+    save: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Match a user's unlinked transactions to open invoices and store the links.
+
+    Args:
+        user_id: Owner of the bank transactions
+        client_id: Client whose invoices the transactions are matched against
+        since: Only consider transactions booked on or after this ISO date
+        min_score: Minimum combined score for a match
+        save: Write the matches to the invoice_transaction_matches table
+
+    Returns:
+        The matches, best first
+    """
+    invoices, transactions = await asyncio.gather(
+        load_open_invoices(client_id),
+        load_unmatched_transactions(user_id, since),
+    )
+    index = InvoiceIndex(invoices)
+    matches = index.match(transactions, min_score)
+    logger.info(
+        f"Matched {len(matches)} of {len(transactions)} transactions to {len(index)} open invoices for user {user_id}"
+    )
+
+    if save and matches:
+        client_by_invoice = {invoice['id']: invoice.get('client_id') for invoice in invoices}
+        supabase = await get_supabase()
+        await supabase.table(INVOICE_MATCH_TABLE).upsert([
+            {**match, 'user_id': user_id, 'client_id': client_by_invoice.get(match['invoice_id'])}
+            for match in matches
+        ]).execute()
+    return matches
@@ -5,7 +5,10 @@ from datetime import datetime
 import json
 
 from ntropy_sdk import SDK
+from pydantic import TypeAdapter
+from app.core.cache import invalidate_user
 from app.core.supabase_client import get_supabase
+from app.services.transactions import TRANSACTION_COLUMNS, invalidate_transaction_count
 
 from app.schemas.transactions import TransactionsTable
 from app.schemas.ntropy import EnrichedTransactionRequest
@@ -14,6 +17,12 @@ from app.schemas.ntropy import BatchCreateResponse
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Validates a whole result set in one call instead of one model per row
+_transactions_adapter = TypeAdapter(List[TransactionsTable])
+
+# Transaction ids per owner lookup when invalidating caches after a batch
+INVALIDATION_LOOKUP_BATCH_SIZE = 200
+
 def transform_transactions_for_ntropy(
         transactions: List[TransactionsTable]) -> List[EnrichedTransactionRequest]:
     """
@@ -103,7 +112,7 @@ class NtropyService:
         logger.info(f"Fetching non-enriched transactions for user {user_id}")
         supabase = await self.get_supabase()
         query = (supabase.table('gocardless_transactions')
-                .select('*')
+                .select(TRANSACTION_COLUMNS)
                 .eq('user_id', user_id)
                 .or_('ntropy_enrich.is.null,ntropy_enrich.eq.false'))
 
@@ -113,7 +122,7 @@ class NtropyService:
             logger.info(f"No non-enriched transactions found for user {user_id}")
             return []
         
-        transactions = [TransactionsTable(**tx) for tx in result.data]
+        transactions = _transactions_adapter.validate_python(result.data)
         logger.info(f"Found {len(transactions)} non-enriched transactions for user {user_id}")
         return transactions
 
@@ -230,6 +239,26 @@ class NtropyService:
             logger.error(f"Failed to store Ntropy transaction: {str(e)}", exc_info=True)
             raise ValueError(f"Failed to store Ntropy transaction: {str(e)}")
 
+    async def invalidate_enriched_users(self, transaction_ids: List[str]) -> None:
+        """
+        Drop cached responses and counts for the owners of newly enriched transactions,
+        once per batch rather than once per transaction
+        """
+        supabase = await self.get_supabase()
+        user_ids = set()
+        for start in range(0, len(transaction_ids), INVALIDATION_LOOKUP_BATCH_SIZE):
+            chunk = transaction_ids[start:start + INVALIDATION_LOOKUP_BATCH_SIZE]
+            result = await supabase.table('gocardless_transactions') \
+                .select('user_id') \
+                .in_('id', chunk) \
+                .execute()
+            user_ids.update(row['user_id'] for row in result.data if row.get('user_id'))
+        
+        for user_id in user_ids:
+            invalidate_transaction_count(user_id)
+            await invalidate_user(user_id)
+        logger.info(f"Invalidated cached transactions for {len(user_ids)} users after enrichment")
+
     async def get_batch_status(self, batch_id: str) -> dict:
         """
         Get the current status of a batch
@@ -253,10 +282,14 @@ class NtropyService:
             transactions = batch_result.results
             logger.info(f"Processing {len(transactions)} enriched transactions from batch {batch_id}")
             
+            stored_ids = []
             for transaction in transactions:
                 # Convert to dict if it's not already
                 tx_data = transaction.model_dump() if hasattr(transaction, 'model_dump') else transaction
                 await self.store_ntropy_transaction(batch_id, tx_data)
+                stored_ids.append(tx_data['id'])
+            
+            await self.invalidate_enriched_users(stored_ids)
             
             return {
                 "status": "complete",
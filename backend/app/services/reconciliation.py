@@ -5,7 +5,7 @@ from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
 from dotenv import load_dotenv
 import time
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, Optional
 import logging
 import json
 
@@ -14,7 +14,10 @@ from pydantic import BaseModel
 import pandas as pd
 
 
+from app.core.cache import invalidate_user
 from app.core.supabase_client import get_supabase
+from app.services.coa_index import get_coa_index
+from app.services.etl.vectorise_data import get_voyage_embeddings
 
 # Configure logging
 logging.basicConfig(
@@ -29,6 +32,19 @@ load_dotenv()
 groq_model = ChatGroq(model_name="Llama-3.3-70b-Specdec")
 openai_model = ChatOpenAI(model="gpt-4o")
 
+# Candidate accounts retrieved per transaction group in retrieval-augmented mode
+CANDIDATE_ACCOUNT_COUNT = 8
+CANDIDATE_EMBEDDING_COLUMN = 'voyage_embeddings'
+# Classifications below this confidence are retried against the full chart of accounts
+ESCALATION_CONFIDENCE = 0.5
+
+RECONCILIATION_COLUMNS = (
+    'id, creditor_name, debtor_name, amount, remittance_info, '
+    'ntropy_transactions(counterparty:enriched_data->entities->counterparty->>name, '
+    'general_category:enriched_data->categories->>general)'
+)
+COA_PROMPT_COLUMNS = 'account_id, code, name, account_type, description, account_class'
+
 class TransactionToLLM(BaseModel):
     id: str
     entity_name : str
@@ -134,7 +150,8 @@ class TransactionClassifier:
 
         Transactions: {transactions}
         
-        chart of accounts: {chart_of_accounts}
+        chart of accounts (code | name | type | class | description):
+        {format_accounts_for_prompt(chart_of_accounts)}
         """
         logger.debug(f"Generated prompt: {transactions_prompt}")
 
@@ -177,8 +194,100 @@ class TransactionClassifier:
             return [(f"ERROR: {str(e)}", "", 0.0)] * len(transactions)
 
 
-def process_transactions(df: pd.DataFrame, chart_of_accounts: list) -> pd.DataFrame:
-    """Process transactions grouped by remittance_info in batches of 3 groups"""
+def format_accounts_for_prompt(accounts: list) -> str:
+    """Render accounts one per line, which is far more compact than the list's repr"""
+    return "\n        ".join(
+        " | ".join(str(account.get(field) or '') for field in ('code', 'name', 'type', 'class', 'description'))
+        for account in accounts
+    )
+
+def _needs_escalation(account: str, confidence: float, offered_codes: set) -> bool:
+    """A pruned-prompt answer is retried if it is an error, off-list or low confidence"""
+    try:
+        confidence = float(confidence)
+    except (TypeError, ValueError):
+        return True
+    return (
+        str(account).startswith("ERROR")
+        or account not in offered_codes
+        or confidence < ESCALATION_CONFIDENCE
+    )
+
+def _merge_candidates(candidate_lists: List[Optional[list]]) -> Optional[list]:
+    """Union of candidate accounts for a batch, or None if any group has no candidates"""
+    merged = {}
+    for candidates in candidate_lists:
+        if not candidates:
+            return None
+        for account in candidates:
+            merged.setdefault(account['code'], account)
+    return list(merged.values())
+
+async def select_candidate_accounts(
+    df: pd.DataFrame,
+    chart_of_accounts: list,
+    top_k: int = CANDIDATE_ACCOUNT_COUNT
+) -> Dict[str, list]:
+    """
+    Pre-select the most relevant accounts for each remittance_info group
+    
+    Each group's representative transaction is embedded and ranked against the
+    chart of accounts index (vector similarity fused with keyword matching).
+    
+    Args:
+        df (pd.DataFrame): Prepared transactions, as from fetch_and_prepare_transactions
+        chart_of_accounts (list): Parsed accounts, as from fetch_chart_of_accounts
+        top_k (int): Number of candidate accounts per group
+    
+    Returns:
+        Dict[str, list]: remittance_info -> candidate accounts (same shape as chart_of_accounts).
+        Groups without usable candidates are omitted and classified against the full list.
+    """
+    accounts_by_code = {account['code']: account for account in chart_of_accounts}
+    
+    query_by_group = {}
+    for remittance_info, group_df in df.groupby('remittance_info'):
+        representative = group_df.iloc[0]
+        parts = [
+            representative.get('entity_name'),
+            representative.get('ntropy_entity'),
+            representative.get('ntropy_category'),
+            remittance_info,
+        ]
+        query_by_group[remittance_info] = " ".join(str(part) for part in parts if part and not pd.isna(part))
+    
+    queries = list(dict.fromkeys(query for query in query_by_group.values() if query))
+    if not queries:
+        return {}
+    
+    logger.info(f"Selecting candidate accounts for {len(query_by_group)} groups ({len(queries)} distinct queries)")
+    embeddings = await get_voyage_embeddings(queries, input_type="query")
+    index = await get_coa_index('ALL', CANDIDATE_EMBEDDING_COLUMN)
+    ranked = dict(zip(queries, index.hybrid_search_many(queries, embeddings, top_k)))
+    
+    candidates_by_group = {}
+    for remittance_info, query in query_by_group.items():
+        candidates = [
+            accounts_by_code[match['account_code']]
+            for match in ranked.get(query, [])
+            if match['account_code'] in accounts_by_code
+        ]
+        if candidates:
+            candidates_by_group[remittance_info] = candidates
+    return candidates_by_group
+
+def process_transactions(
+    df: pd.DataFrame,
+    chart_of_accounts: list,
+    candidates_by_group: Optional[Dict[str, list]] = None
+) -> pd.DataFrame:
+    """
+    Process transactions grouped by remittance_info in batches of 3 groups
+    
+    When candidates_by_group is given, each batch prompt only lists the union of
+    its groups' candidate accounts; answers that are off-list or low confidence
+    are retried once with the full chart of accounts.
+    """
     logger.info(f"Starting to process {len(df)} transactions")
     logger.debug(f"Input DataFrame shape: {df.shape}")
     
@@ -219,8 +328,32 @@ def process_transactions(df: pd.DataFrame, chart_of_accounts: list) -> pd.DataFr
             })
             group_indices.append(remittance_info)
         
-        # Get classifications for the batch
-        classifications = classifier.classify_transactions_batch(batch_transactions, chart_of_accounts)
+        # Get classifications for the batch, offering only candidate accounts when available
+        offered_accounts = None
+        if candidates_by_group:
+            offered_accounts = _merge_candidates([candidates_by_group.get(g) for g in group_indices])
+        classifications = classifier.classify_transactions_batch(
+            batch_transactions, offered_accounts or chart_of_accounts
+        )
+        
+        if offered_accounts:
+            # Pad in case the LLM skipped a transaction, so every group can be escalated
+            classifications = list(classifications) + [("ERROR: missing classification", "", 0.0)] * (
+                len(batch_transactions) - len(classifications)
+            )
+            offered_codes = {account['code'] for account in offered_accounts}
+            escalate = [
+                idx for idx, (account, _, confidence) in enumerate(classifications)
+                if _needs_escalation(account, confidence, offered_codes)
+            ]
+            logger.info(f"Pruned prompt offered {len(offered_accounts)}/{len(chart_of_accounts)} accounts; "
+                        f"escalating {len(escalate)} of {len(batch_transactions)} groups")
+            if escalate:
+                retried = classifier.classify_transactions_batch(
+                    [batch_transactions[idx] for idx in escalate], chart_of_accounts
+                )
+                for idx, result in zip(escalate, retried):
+                    classifications[idx] = result
         
         # Apply classifications to all transactions in each group
         for remittance_info, (account, reasoning, confidence) in zip(group_indices, classifications):
@@ -260,16 +393,15 @@ async def fetch_and_prepare_transactions(user_id: str) -> pd.DataFrame:
         supabase = await get_supabase()
         logger.info("Successfully connected to Supabase")
         
-        # Query both tables asynchronously with user_id filter
+        # One query: the user's unreconciled transactions with the two Ntropy fields
+        # we use, extracted server-side instead of pulling every enriched_data document
         logger.info("Querying Supabase tables...")
-        ntropy_response = await supabase.table('ntropy_transactions').select('*').execute()
         gocardless_response = await supabase.table('gocardless_transactions')\
-            .select('*')\
+            .select(RECONCILIATION_COLUMNS)\
             .eq('user_id', user_id)\
             .or_('coa_set_by.is.null, coa_set_by.neq.AI')\
             .execute()
         
-        logger.info(f"Retrieved {len(ntropy_response.data)} ntropy transactions")
         logger.info(f"Retrieved {len(gocardless_response.data)} gocardless transactions")
 
         # Handle empty gocardless transactions case
@@ -277,57 +409,24 @@ async def fetch_and_prepare_transactions(user_id: str) -> pd.DataFrame:
             logger.info("No gocardless transactions to process")
             return pd.DataFrame()  # Return empty DataFrame
         
-        # Convert to DataFrames
-        ntropy_df = pd.DataFrame(ntropy_response.data)
         gocardless_df = pd.DataFrame(gocardless_response.data)
+        enrichment = gocardless_df['ntropy_transactions'].map(
+            lambda x: (x[0] if x else None) if isinstance(x, list) else x
+        )
 
-        # Create base result DataFrame from gocardless data
+        # Create result DataFrame from gocardless data and its Ntropy enrichment
         result_df = pd.DataFrame({
             'id': gocardless_df['id'],
-            'entity_name': gocardless_df.apply(
-                lambda row: row['creditor_name'] if pd.notnull(row['creditor_name'])
-                else row['debtor_name'],
-                axis=1
+            'entity_name': gocardless_df['creditor_name'].where(
+                gocardless_df['creditor_name'].notna(), gocardless_df['debtor_name']
             ),
             'amount': gocardless_df['amount']/100,
             'remittance_info': gocardless_df['remittance_info'],
-            'ntropy_enrich': False,  # Default to False
-            'ntropy_entity': None,
-            'ntropy_category': None
+            'ntropy_enrich': enrichment.notna(),
+            'ntropy_entity': enrichment.map(lambda x: x.get('counterparty') if x else None),
+            'ntropy_category': enrichment.map(lambda x: x.get('general_category') if x else None)
         })
 
-        # Only attempt merge if ntropy data exists
-        if not ntropy_df.empty:
-            try:
-                # Ensure ntropy_id column exists
-                if 'ntropy_id' not in ntropy_df.columns:
-                    logger.warning("ntropy_id column missing in ntropy transactions")
-                    return result_df
-
-                # Merge with ntropy data where available
-                ntropy_enriched = pd.merge(
-                    result_df,
-                    ntropy_df,
-                    how='left',
-                    left_on='id',
-                    right_on='ntropy_id'
-                )
-
-                # Update enrichment fields where ntropy data exists
-                mask = ntropy_enriched['enriched_data'].notna()
-                result_df.loc[mask, 'ntropy_enrich'] = True
-                result_df.loc[mask, 'ntropy_entity'] = ntropy_enriched.loc[mask, 'enriched_data'].apply(
-                    lambda x: x['entities']['counterparty']['name'] if x and 'entities' in x else None
-                )
-                result_df.loc[mask, 'ntropy_category'] = ntropy_enriched.loc[mask, 'enriched_data'].apply(
-                    lambda x: x['categories']['general'] if x and 'categories' in x else None
-                )
-
-            except Exception as e:
-                logger.error(f"Error merging with ntropy data: {e}")
-                # Continue with base gocardless data
-                pass
-
         logger.info(f"Final prepared DataFrame contains {len(result_df)} rows")
         logger.debug(f"DataFrame columns: {result_df.columns.tolist()}")
         
@@ -346,7 +445,7 @@ async def fetch_chart_of_accounts(supabase) -> list:
     """
     logger.info("Fetching chart of accounts from Supabase")
     try:
-        response = await supabase.table('chart_of_accounts').select('*').eq('status', 'ACTIVE').execute()
+        response = await supabase.table('chart_of_accounts').select(COA_PROMPT_COLUMNS).eq('status', 'ACTIVE').execute()
         accounts = response.data
         
         # Extract only the required fields and format for LLM
@@ -390,9 +489,17 @@ def map_coa_codes_to_ids(df: pd.DataFrame, code_to_id_map: dict) -> pd.DataFrame
     return df
 
 """ entry point """
-async def reconcile_transactions(user_id: str) -> pd.DataFrame:
+async def reconcile_transactions(
+    user_id: str,
+    candidate_count: Optional[int] = CANDIDATE_ACCOUNT_COUNT
+) -> pd.DataFrame:
     """
     Main function to reconcile transactions for a specific user and save results to database
+    
+    Args:
+        user_id (str): The ID of the user whose transactions to reconcile
+        candidate_count (Optional[int]): Accounts pre-selected per transaction group for the
+            LLM prompt. None sends the full chart of accounts with every batch.
     """
     logger.info(f"Starting reconciliation process for user {user_id}")
     
@@ -414,9 +521,17 @@ async def reconcile_transactions(user_id: str) -> pd.DataFrame:
         
         logger.info(f"Retrieved {len(result_df)} transactions to process")
         
+        # Pre-select candidate accounts so prompts carry a shortlist, not the whole chart
+        candidates_by_group = None
+        if candidate_count:
+            try:
+                candidates_by_group = await select_candidate_accounts(result_df, parsed_accounts, candidate_count)
+            except Exception as e:
+                logger.warning(f"Candidate selection failed, using full chart of accounts: {str(e)}")
+        
         # Process transactions (LLM only sees codes, not UUIDs)
         logger.info("Starting transaction processing")
-        df_reconciled = process_transactions(result_df, parsed_accounts)
+        df_reconciled = process_transactions(result_df, parsed_accounts, candidates_by_group)
         
         # Map the COA codes to account IDs
         logger.info("Mapping COA codes to account IDs")
@@ -461,6 +576,8 @@ async def reconcile_transactions(user_id: str) -> pd.DataFrame:
                 updates.append(False)
 
         logger.info(f"Successfully updated {sum(updates)} out of {len(updates)} transactions")
+        if any(updates):
+            await invalidate_user(user_id)
         
         return df_reconciled
         
@@ -1,12 +1,86 @@
-from typing import Dict
+from typing import AsyncIterator, Dict, List, Literal, Optional, Tuple
+import asyncio
+import base64
+import json
 import logging
-import csv
-from io import StringIO
+import re
+import time
+from datetime import datetime
 
-from app.core.supabase_client import get_supabase
-from app.schemas.transactions import Insights
+from app.core.supabase_client import get_pg_pool, get_supabase
+from app.schemas.transactions import AnalyticsInsights, Insights, TransactionsTable
+from app.services.analytics import ANALYTICS_COLUMNS, ANALYTICS_SQL, compute_analytics
+from app.services.export import (
+    ENCODERS,
+    EXPORT_BATCH_SIZE,
+    EXPORT_FIELDS,
+    ExportFormat,
+    gzip_chunks,
+)
+from app.services.insights import get_user_insights
 logger = logging.getLogger(__name__)
 
+# Only the columns the response model serialises, plus the Ntropy general category
+# extracted server-side rather than the whole enriched_data document
+TRANSACTION_COLUMNS = ', '.join(TransactionsTable.model_fields)
+TRANSACTIONS_SELECT = (
+    f'{TRANSACTION_COLUMNS}, '
+    'ntropy_transactions!inner(general_category:enriched_data->categories->>general)'
+)
+# Counting only needs the join that filters rows, not the enriched payload
+TRANSACTIONS_COUNT_SELECT = 'id, ntropy_transactions!inner(ntropy_id)'
+
+CountMode = Literal['none', 'estimated', 'exact']
+
+# Exact counts are cached per user; write paths call invalidate_transaction_count
+COUNT_CACHE_TTL_SECONDS = 60
+_count_cache: Dict[str, Tuple[float, int]] = {}
+
+def invalidate_transaction_count(user_id: str) -> None:
+    """Drop the cached transaction count for a user after their transactions change"""
+    _count_cache.pop(user_id, None)
+
+# Transaction ids are generated UUID pairs; anything else in a cursor is rejected
+_CURSOR_ID = re.compile(r'[A-Za-z0-9_-]{1,100}')
+
+def encode_cursor(created_at: str, transaction_id: str) -> str:
+    """Opaque cursor for the (created_at, id) position of the last row on a page"""
+    payload = json.dumps([created_at, transaction_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """
+    The (created_at, id) position in a cursor from encode_cursor
+
+    Both values end up quoted inside a PostgREST filter, so created_at must
+    parse as an ISO timestamp and the id must look like a transaction id.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, transaction_id = json.loads(base64.urlsafe_b64decode(padded))
+        created_at = datetime.fromisoformat(created_at).isoformat()
+    except Exception:
+        raise ValueError("Invalid pagination cursor")
+    if not isinstance(transaction_id, str) or not _CURSOR_ID.fullmatch(transaction_id):
+        raise ValueError("Invalid pagination cursor")
+    return created_at, transaction_id
+
+def rows_after(created_at: str, transaction_id: str) -> str:
+    """PostgREST or-filter for rows strictly after (created_at, id) in descending order"""
+    return (
+        f'created_at.lt."{created_at}",'
+        f'and(created_at.eq."{created_at}",id.lt."{transaction_id}")'
+    )
+
+def flatten_enriched_data(tx: Dict) -> Dict:
+    """Lift the general category from the joined ntropy enrichment onto the transaction"""
+    ntropy_data = tx.pop('ntropy_transactions', None)
+    # PostgREST embeds a list or a single object depending on the detected relationship
+    if isinstance(ntropy_data, list):
+        ntropy_data = ntropy_data[0] if ntropy_data else None
+    tx['category'] = ntropy_data.get('general_category') if isinstance(ntropy_data, dict) else None
+    return tx
+
 class TransactionService:
     def __init__(self):
         self._supabase = None
@@ -32,7 +106,7 @@ class TransactionService:
             
         Returns:
             Dict containing:
-                - transactions: List of transaction objects with enriched entities and categories
+                - transactions: List of transaction objects with the Ntropy general category
                 - total_count: Total number of transactions
                 - page: Current page number
                 - page_size: Number of items per page
@@ -44,37 +118,21 @@ class TransactionService:
         offset = (page - 1) * page_size
         logger.debug(f"Calculated offset={offset} for pagination")
 
-        # Get transactions with count and proper join on ntropy_id
+        # Get transactions with proper join on ntropy_id; the total comes from the count cache
         logger.debug("Executing Supabase query to fetch transactions")
         result = await (supabase.table('gocardless_transactions')
-            .select('*, ntropy_transactions!inner(enriched_data)', count='exact')
+            .select(TRANSACTIONS_SELECT)
             .eq('user_id', user_id)
             .order('created_at', desc=True)
+            .order('id', desc=True)
             .range(offset, offset + page_size - 1)
             .execute())
 
-        total_count = result.count
+        total_count = await self.get_transaction_count(user_id, 'exact')
         logger.info(f"Found {total_count} total transactions for user")
-        transactions = []
-
-        # Process the results to extract only entities and categories
-        logger.debug("Processing transaction results to extract enriched data")
-        for tx in result.data:
-            ntropy_data = tx.get('ntropy_transactions')
-            if ntropy_data and isinstance(ntropy_data, list) and len(ntropy_data) > 0:
-                logger.debug(f"Found enriched data for transaction {tx.get('id')}")
-                enriched_data = ntropy_data[0].get('enriched_data', {})
-                tx['entities'] = enriched_data.get('entities', {})
-                # Transform category from dict to string using the 'general' category
-                categories = enriched_data.get('categories', {})
-                tx['categories'] = categories  # Keep the full category data
-                tx['category'] = categories.get('general') if isinstance(categories, dict) else None
-            else:
-                logger.debug(f"No enriched data found for transaction {tx.get('id')}")
-                tx['entities'] = None
-                tx['categories'] = None
-                tx['category'] = None
-            transactions.append(tx)
+
+        # Process the results to lift the Ntropy category onto each row
+        transactions = [flatten_enriched_data(tx) for tx in result.data]
 
         logger.info(f"Returning {len(transactions)} processed transactions")
         return {
@@ -85,90 +143,271 @@ class TransactionService:
             "total_pages": -(-total_count // page_size)  # Ceiling division
         }
 
-    async def export_transactions_to_csv(self, user_id: str) -> str:
+    async def get_transaction_count(self, user_id: str, mode: CountMode = 'exact') -> Optional[int]:
         """
-        Export all transactions for a user to CSV format
+        Count a user's transactions
         
         Args:
             user_id (str): The ID of the user
+            mode (CountMode): 'exact' (cached for COUNT_CACHE_TTL_SECONDS), 'estimated'
+                (planner statistics for large tables, cheap) or 'none'
             
         Returns:
-            str: CSV formatted string containing all transactions
+            Optional[int]: The count, or None when mode is 'none'
         """
-        logger.info(f"Starting CSV export for user {user_id}")
+        if mode == 'none':
+            return None
+        
+        if mode == 'exact':
+            cached = _count_cache.get(user_id)
+            if cached and time.monotonic() - cached[0] < COUNT_CACHE_TTL_SECONDS:
+                return cached[1]
         
         supabase = await self.get_supabase()
-        result = await supabase.table("gocardless_transactions").select("*").eq("user_id", user_id).execute()
+        result = await (supabase.table('gocardless_transactions')
+            .select(TRANSACTIONS_COUNT_SELECT, count=mode, head=True)
+            .eq('user_id', user_id)
+            .execute())
+        count = result.count or 0
         
-        if not result.data:
-            logger.warning(f"No transactions found for user {user_id}")
-            raise ValueError("No transactions found")
+        if mode == 'exact':
+            _count_cache[user_id] = (time.monotonic(), count)
+        return count
+
+    async def get_user_transactions_after(
+        self,
+        user_id: str,
+        page_size: int,
+        cursor: Optional[str] = None,
+        count: CountMode = 'none'
+    ) -> Dict:
+        """
+        Get a page of transactions using keyset pagination on (created_at, id)
+        
+        Each page seeks directly past the previous page's last row instead of
+        scanning and discarding an offset, so deep pages cost the same as the first.
+        
+        Args:
+            user_id (str): The ID of the user
+            page_size (int): Number of items per page
+            cursor (Optional[str]): next_cursor from the previous page; None for the first page
+            count (CountMode): Whether and how to include total_count
+            
+        Returns:
+            Dict containing:
+                - transactions: List of transaction objects with the Ntropy general category
+                - next_cursor: Cursor for the following page, or None on the last page
+                - has_more: Whether another page exists
+                - page_size: Number of items per page
+                - total_count: Total number of transactions, if requested
+        """
+        logger.info(f"Fetching transactions for user_id={user_id} after cursor={cursor}, page_size={page_size}")
+        
+        supabase = await self.get_supabase()
+        query = (supabase.table('gocardless_transactions')
+            .select(TRANSACTIONS_SELECT)
+            .eq('user_id', user_id))
+        
+        if cursor:
+            created_at, last_id = decode_cursor(cursor)
+            query = query.or_(rows_after(created_at, last_id))
+        
+        # One extra row tells us whether there is a next page without counting
+        result = await (query
+            .order('created_at', desc=True)
+            .order('id', desc=True)
+            .limit(page_size + 1)
+            .execute())
+        
+        rows = result.data
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        transactions = [flatten_enriched_data(tx) for tx in rows]
+        
+        next_cursor = None
+        if has_more and rows:
+            next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+        
+        total_count = await self.get_transaction_count(user_id, count)
+        
+        logger.info(f"Returning {len(transactions)} processed transactions (has_more={has_more})")
+        return {
+            "transactions": transactions,
+            "next_cursor": next_cursor,
+            "has_more": has_more,
+            "page_size": page_size,
+            "total_count": total_count
+        }
 
-        output = StringIO()
-        writer = csv.DictWriter(
-            output,
-            fieldnames=[
-                "id",
-                "user_id",
-                "creditor_name",
-                "debtor_name",
-                "amount",
-                "currency",
-                "remittance_info",
-                "code",
-                "created_at",
-                "institution_id",
-                "iban",
-                "bban",
-                "transaction_id",
-                "internal_transaction_id",
-                "logo",
-                "category",
-                "chart_of_accounts",
-                "agreement_id",
-                "ntropy_enrich",
-                "coa_reason",
-                "coa_confidence",
-                "coa_set_by"
-            ]
+    async def update_transactions_batch(
+        self,
+        user_id: str,
+        updates: List[Tuple[str, Dict]]
+    ) -> Dict:
+        """
+        Apply per-transaction updates with one query per distinct payload
+        
+        Bulk edits from the UI usually set the same value on many rows, so
+        updates are grouped by identical payload and each group is applied with
+        a single in_('id', ...) update. Groups run concurrently.
+        
+        Args:
+            user_id (str): The ID of the user; only their rows are updated
+            updates (List[Tuple[str, Dict]]): (transaction id, fields to set) pairs
+            
+        Returns:
+            Dict containing:
+                - results: One {id, status, error} per requested id, where status is
+                  'updated', 'unchanged' (empty payload), 'not_found' or 'failed'
+                - updated_count: Number of rows updated
+                - transactions: The updated rows
+        """
+        # Later entries for the same id win, as they did when applied in order
+        latest = dict(updates)
+        
+        groups: Dict[Tuple, List[str]] = {}
+        statuses: Dict[str, Dict] = {}
+        for transaction_id, fields in latest.items():
+            if not fields:
+                statuses[transaction_id] = {"id": transaction_id, "status": "unchanged", "error": None}
+                continue
+            groups.setdefault(tuple(sorted(fields.items())), []).append(transaction_id)
+        
+        logger.info(f"Updating {sum(len(ids) for ids in groups.values())} transactions for user {user_id} "
+                    f"in {len(groups)} queries")
+        
+        supabase = await self.get_supabase()
+        
+        async def apply(payload: Tuple, ids: List[str]):
+            return await (supabase.table('gocardless_transactions')
+                .update(dict(payload))
+                .in_('id', ids)
+                .eq('user_id', user_id)
+                .execute())
+        
+        outcomes = await asyncio.gather(
+            *(apply(payload, ids) for payload, ids in groups.items()),
+            return_exceptions=True
         )
         
-        writer.writeheader()
-        
-        for transaction in result.data:
-            writer.writerow({
-                "id": transaction.get("id"),
-                "user_id": transaction.get("user_id"),
-                "creditor_name": transaction.get("creditor_name"),
-                "debtor_name": transaction.get("debtor_name"),
-                "amount": transaction.get("amount"),
-                "currency": transaction.get("currency"),
-                "remittance_info": transaction.get("remittance_info"),
-                "code": transaction.get("code"),
-                "created_at": transaction.get("created_at"),
-                "institution_id": transaction.get("institution_id"),
-                "iban": transaction.get("iban"),
-                "bban": transaction.get("bban"),
-                "transaction_id": transaction.get("transaction_id"),
-                "internal_transaction_id": transaction.get("internal_transaction_id"),
-                "logo": transaction.get("logo"),
-                "category": transaction.get("category"),
-                "chart_of_accounts": transaction.get("chart_of_accounts"),
-                "agreement_id": transaction.get("agreement_id"),
-                "ntropy_enrich": transaction.get("ntropy_enrich"),
-                "coa_reason": transaction.get("coa_reason"),
-                "coa_confidence": transaction.get("coa_confidence"),
-                "coa_set_by": transaction.get("coa_set_by")
-            })
-            logger.debug(f"Transaction {transaction.get('id')} written to CSV")
-
-        output.seek(0)
-        logger.info("CSV export completed successfully")
-        return output.getvalue() 
+        updated_rows = []
+        for (payload, ids), outcome in zip(groups.items(), outcomes):
+            if isinstance(outcome, Exception):
+                logger.error(f"Failed to update {len(ids)} transactions with {dict(payload)}: {str(outcome)}")
+                for transaction_id in ids:
+                    statuses[transaction_id] = {"id": transaction_id, "status": "failed", "error": str(outcome)}
+                continue
+            updated_ids = {row['id'] for row in outcome.data}
+            updated_rows.extend(outcome.data)
+            for transaction_id in ids:
+                status = "updated" if transaction_id in updated_ids else "not_found"
+                statuses[transaction_id] = {"id": transaction_id, "status": status, "error": None}
+        
+        return {
+            "results": [statuses[transaction_id] for transaction_id in latest],
+            "updated_count": len(updated_rows),
+            "transactions": updated_rows
+        }
+
+    async def _fetch_export_batch(
+        self,
+        user_id: str,
+        after: Optional[Tuple[str, str]],
+        batch_size: int,
+        columns: List[str] = EXPORT_FIELDS
+    ) -> List[Dict]:
+        supabase = await self.get_supabase()
+        query = (supabase.table('gocardless_transactions')
+            .select(','.join(columns))
+            .eq('user_id', user_id))
+        if after:
+            query = query.or_(rows_after(*after))
+        result = await (query
+            .order('created_at', desc=True)
+            .order('id', desc=True)
+            .limit(batch_size)
+            .execute())
+        return result.data
+
+    async def iter_transaction_batches(
+        self,
+        user_id: str,
+        batch_size: int = EXPORT_BATCH_SIZE,
+        columns: List[str] = EXPORT_FIELDS
+    ) -> AsyncIterator[List[Dict]]:
+        """
+        Yield all of a user's transactions in keyset-paginated batches, newest first
+        
+        The next batch is requested as soon as the current one arrives, so the
+        database round trip overlaps with encoding the batch being yielded.
+        
+        Args:
+            user_id (str): The ID of the user
+            batch_size (int): Rows per database request
+            columns (List[str]): Columns to select; must include id and created_at
+            
+        Yields:
+            List[Dict]: Non-empty batches of transaction rows
+        """
+        pending = asyncio.ensure_future(self._fetch_export_batch(user_id, None, batch_size, columns))
+        try:
+            while pending is not None:
+                rows = await pending
+                pending = None
+                if not rows:
+                    return
+                if len(rows) == batch_size:
+                    after = (rows[-1]['created_at'], rows[-1]['id'])
+                    pending = asyncio.ensure_future(self._fetch_export_batch(user_id, after, batch_size, columns))
+                yield rows
+        finally:
+            # The client may disconnect mid-export
+            if pending is not None:
+                pending.cancel()
+
+    async def export_transactions(
+        self,
+        user_id: str,
+        export_format: ExportFormat = 'csv',
+        gzip: bool = False
+    ) -> AsyncIterator[bytes]:
+        """
+        Export all transactions for a user as a byte stream
+        
+        The first batch is fetched before returning so that a user with no
+        transactions gets an error rather than an empty file.
+        
+        Args:
+            user_id (str): The ID of the user
+            export_format (ExportFormat): 'csv', 'parquet' or 'xlsx'
+            gzip (bool): Whether to gzip the output
+            
+        Returns:
+            AsyncIterator[bytes]: Encoded file contents, suitable for a StreamingResponse
+        """
+        logger.info(f"Starting {export_format} export for user {user_id} (gzip={gzip})")
+        
+        batches = self.iter_transaction_batches(user_id)
+        first_batch = await anext(batches, None)
+        if first_batch is None:
+            logger.warning(f"No transactions found for user {user_id}")
+            raise ValueError("No transactions found")
+        
+        async def all_batches():
+            yield first_batch
+            async for batch in batches:
+                yield batch
+        
+        chunks = ENCODERS[export_format](all_batches())
+        return gzip_chunks(chunks) if gzip else chunks
     
     async def get_insights(self, user_id: str) -> Insights:
         """
-        Get insights for a user by calculating spending by category and entity
+        Get insights for a user: spending by category and entity
+        
+        Totals come from the per-month insight_rollups maintained by a trigger on
+        gocardless_transactions (see sql/insight_rollups.sql), so this reads a few
+        hundred pre-summed rows rather than every transaction.
         
         Args:
             user_id (str): The ID of the user
@@ -179,63 +418,34 @@ class TransactionService:
         logger.info(f"Calculating insights for user {user_id}")
         
         try:
-            # Get transactions with enriched data
-            supabase = await self.get_supabase()
-            result = await supabase.table("gocardless_transactions")\
-                .select("*, ntropy_transactions!inner(enriched_data)")\
-                .eq("user_id", user_id)\
-                .execute()
-
-            transactions = result.data
-            logger.info(f"Found {len(transactions)} transactions to analyze")
-
-            # Initialize dictionaries to store category and entity totals
-            category_totals = {}
-            entity_totals = {}
-
-            # Process each transaction
-            for tx in transactions:
-                amount = float(tx.get('amount', 0))
-                amount = amount / 100  # Convert to dollars
-                
-                # Process category spending
-                categories = tx.get('llm_category', {})
-                category = categories.get('category') if isinstance(categories, dict) else categories
-                
-                if category:
-                    logger.debug(f"Adding amount {amount} to category {category}")
-                    category_totals[category] = category_totals.get(category, 0) + amount
-
-                # Process entity spending
-                entity_name = tx.get('ntropy_entity')
-                if entity_name:
-                    logger.debug(f"Adding amount {amount} to entity {entity_name}")
-                    entity_totals[entity_name] = entity_totals.get(entity_name, 0) + amount
-
-            # Convert dictionaries to lists of dictionaries as per the model
-            spending_by_category = [
-                {"category": str(cat), "amount": round(float(amount), 2)}  # Ensure types match schema
-                for cat, amount in category_totals.items()
-                if cat is not None  # Skip None categories
-            ]
-            
-            spending_by_entity = [
-                {"entity": str(ent), "amount": round(float(amount), 2)}  # Ensure types match schema
-                for ent, amount in entity_totals.items()
-                if ent is not None  # Skip None entities
-            ]
-
-            # Sort both lists by amount in descending order
-            spending_by_category.sort(key=lambda x: x["amount"], reverse=True)
-            spending_by_entity.sort(key=lambda x: x["amount"], reverse=True)
-
-            logger.info(f"Successfully calculated insights: {len(spending_by_category)} categories, {len(spending_by_entity)} entities")
-            
-            return Insights(
-                spending_by_category=spending_by_category,
-                spending_by_entity=spending_by_entity
-            )
-
+            return await get_user_insights(user_id)
         except Exception as e:
             logger.error(f"Error calculating insights: {str(e)}", exc_info=True)
-            raise
\ No newline at end of file
+            raise
+
+    async def get_analytics(self, user_id: str, currency: Optional[str] = None) -> AnalyticsInsights:
+        """
+        Get cash flow, burn, recurring vendor and category trend analytics for a user
+        
+        Args:
+            user_id (str): The ID of the user
+            currency (Optional[str]): Currency to analyse; defaults to the user's most used currency
+            
+        Returns:
+            AnalyticsInsights: Monthly cash flow with burn, recurring vendors and category trends
+        """
+        logger.info(f"Computing analytics for user {user_id}")
+        
+        pool = await get_pg_pool()
+        if pool is not None:
+            # One query over the direct connection instead of paging through PostgREST
+            rows = [dict(record) for record in await pool.fetch(ANALYTICS_SQL, user_id)]
+        else:
+            rows = []
+            async for batch in self.iter_transaction_batches(user_id, columns=ANALYTICS_COLUMNS):
+                rows.extend(batch)
+        
+        started = time.perf_counter()
+        analytics = compute_analytics(rows, currency)
+        logger.info(f"Computed analytics over {len(rows)} transactions in {(time.perf_counter() - started) * 1000:.1f}ms")
+        return AnalyticsInsights(**analytics)
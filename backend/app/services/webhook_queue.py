@@ -0,0 +1,263 @@
+"""In-process queue that lets webhook endpoints acknowledge before doing the work"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from postgrest.exceptions import APIError
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+# Events waiting for a worker; beyond this the endpoint answers 503 so the
+# sender retries later instead of the process buffering without bound
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "3"))
+WEBHOOK_RETRY_BASE_SECONDS = float(os.getenv("WEBHOOK_RETRY_BASE_SECONDS", "2"))
+# Event keys remembered in memory to drop redeliveries without a database call
+RECENT_EVENT_CACHE_SIZE = 10_000
+RECENT_EVENT_TTL_SECONDS = 60 * 60
+# How long shutdown waits for queued and running events
+WEBHOOK_DRAIN_SECONDS = 10
+# A claim still 'processing' after this long belongs to a worker that was
+# cancelled or died, and a redelivery may take it over. Covers the handler
+# and its retries with room to spare
+WEBHOOK_CLAIM_LEASE_SECONDS = int(os.getenv("WEBHOOK_CLAIM_LEASE_SECONDS", "600"))
+
+# Durable record of events, so redeliveries after a restart or to another
+# process are skipped too (sql/webhook_events.sql)
+WEBHOOK_EVENTS_TABLE = "webhook_events"
+# PostgREST / Postgres codes for a table that does not exist (not yet migrated)
+MISSING_TABLE_CODES = ("42P01", "PGRST205")
+
+
+class RecentKeys:
+    """Bounded LRU of event keys seen within the TTL."""
+
+    def __init__(self, max_size: int = RECENT_EVENT_CACHE_SIZE, ttl_seconds: float = RECENT_EVENT_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, float]" = OrderedDict()
+
+    def add(self, key: str) -> bool:
+        """Remember a key; False if it was already seen within the TTL."""
+        now = time.monotonic()
+        seen_at = self._entries.get(key)
+        if seen_at is not None and now - seen_at < self.ttl_seconds:
+            return False
+        self._entries[key] = now
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return True
+
+    def discard(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+
+class WebhookQueue:
+    """
+    Deduplicating work queue for webhook events.
+
+    submit() only checks the key against recently seen events and puts the
+    event on an asyncio queue, so the endpoint can respond in milliseconds.
+    A fixed pool of workers then claims each event in the webhook_events
+    table (a second delivery to any process loses the claim), runs the
+    handler, and retries failures with exponential backoff and jitter.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        handler: Callable[[Dict[str, Any]], Awaitable[Any]],
+        workers: int = WEBHOOK_WORKERS,
+        max_size: int = WEBHOOK_QUEUE_SIZE,
+        max_attempts: int = WEBHOOK_MAX_ATTEMPTS,
+        get_client: Optional[Callable[[], Awaitable[Any]]] = None,
+    ):
+        self.source = source
+        self.handler = handler
+        self.workers = workers
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self._get_client = get_client
+        self._recent = RecentKeys()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._retries: Set[asyncio.Task] = set()
+        # Keys this queue holds the webhook_events claim for
+        self._claimed: Set[str] = set()
+        self._in_flight = 0
+        # Cleared when the webhook_events table is missing
+        self._durable = get_client is not None
+        self.stats = {"accepted": 0, "duplicates": 0, "rejected": 0, "processed": 0, "retried": 0, "failed": 0}
+
+    def _start(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_size)
+        self._tasks = {task for task in self._tasks if not task.done()}
+        while len(self._tasks) < self.workers:
+            self._tasks.add(asyncio.create_task(self._work()))
+
+    def submit(self, key: str, event: Dict[str, Any]) -> str:
+        """
+        Queue an event unless its key was seen recently.
+
+        Returns:
+            str: 'queued', 'duplicate', or 'full' when the queue is at capacity
+        """
+        self._start()
+        if not self._recent.add(key):
+            self.stats["duplicates"] += 1
+            return "duplicate"
+        try:
+            self._queue.put_nowait((key, event, 1))
+        except asyncio.QueueFull:
+            # Forget the key so the sender's retry is accepted
+            self._recent.discard(key)
+            self.stats["rejected"] += 1
+            return "full"
+        self.stats["accepted"] += 1
+        return "queued"
+
+    async def _work(self) -> None:
+        while True:
+            key, event, attempt = await self._queue.get()
+            self._in_flight += 1
+            try:
+                await self._process(key, event, attempt)
+            except Exception as e:
+                logger.error(f"Unexpected error handling {self.source} event {key}: {str(e)}")
+            finally:
+                self._in_flight -= 1
+                self._queue.task_done()
+
+    async def _process(self, key: str, event: Dict[str, Any], attempt: int) -> None:
+        try:
+            if key not in self._claimed:
+                # A claim that errored is retried with the event, so a
+                # transient database failure neither drops nor duplicates it
+                if not await self._claim(key, event):
+                    self.stats["duplicates"] += 1
+                    logger.info(f"Skipping {self.source} event {key}: already handled")
+                    return
+                self._claimed.add(key)
+            elif attempt > 1:
+                # Renews the claim's lease for the retry
+                await self._record(key, "processing", attempt)
+            await self.handler(event)
+        except Exception as e:
+            if attempt < self.max_attempts:
+                delay = WEBHOOK_RETRY_BASE_SECONDS * 2 ** (attempt - 1) * (1 + random.random())
+                logger.warning(
+                    f"{self.source} event {key} failed (attempt {attempt}/{self.max_attempts}), "
+                    f"retrying in {delay:.1f}s: {str(e)}"
+                )
+                self.stats["retried"] += 1
+                retry = asyncio.create_task(self._retry_later(key, event, attempt + 1, delay))
+                self._retries.add(retry)
+                retry.add_done_callback(self._retries.discard)
+                return
+            logger.error(f"{self.source} event {key} failed after {attempt} attempts: {str(e)}")
+            self.stats["failed"] += 1
+            await self._finish(key, "failed", attempt, str(e))
+            return
+        self.stats["processed"] += 1
+        await self._finish(key, "done", attempt)
+
+    async def _finish(self, key: str, status: str, attempts: int, error: Optional[str] = None) -> None:
+        if key in self._claimed:
+            self._claimed.discard(key)
+            await self._record(key, status, attempts, error)
+
+    async def _retry_later(self, key: str, event: Dict[str, Any], attempt: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self._queue.put((key, event, attempt))
+
+    async def _claim(self, key: str, event: Dict[str, Any]) -> bool:
+        """
+        Insert the event's row, or take over a stale one.
+
+        False if another delivery holds a live claim or already finished the
+        event. A 'processing' row older than WEBHOOK_CLAIM_LEASE_SECONDS was left
+        by a worker that never recorded an outcome, and is claimed again.
+        """
+        if not self._durable:
+            return True
+        try:
+            client = await self._get_client()
+            now = datetime.now(timezone.utc)
+            response = await client.table(WEBHOOK_EVENTS_TABLE).upsert(
+                {
+                    "event_key": key,
+                    "source": self.source,
+                    "event_type": event.get("type"),
+                    "status": "processing",
+                    "received_at": now.isoformat(),
+                    "updated_at": now.isoformat(),
+                },
+                on_conflict="event_key",
+                ignore_duplicates=True,
+            ).execute()
+            if response.data:
+                return True
+            # The conditional update only matches a stale claim, so of two
+            # concurrent redeliveries at most one gets the row back
+            stale_before = now - timedelta(seconds=WEBHOOK_CLAIM_LEASE_SECONDS)
+            response = await client.table(WEBHOOK_EVENTS_TABLE) \
+                .update({"updated_at": now.isoformat()}) \
+                .eq("event_key", key) \
+                .eq("status", "processing") \
+                .lt("updated_at", stale_before.isoformat()) \
+                .execute()
+            if response.data:
+                logger.warning(f"Reclaimed stale {self.source} event {key}")
+            return bool(response.data)
+        except APIError as e:
+            if e.code not in MISSING_TABLE_CODES:
+                raise
+            # Without the table, in-memory deduplication still applies
+            logger.warning(f"Durable webhook deduplication unavailable, continuing without it: {str(e)}")
+            self._durable = False
+            return True
+
+    async def _record(self, key: str, status: str, attempts: int, error: Optional[str] = None) -> None:
+        if not self._durable:
+            return
+        try:
+            client = await self._get_client()
+            await client.table(WEBHOOK_EVENTS_TABLE).update({
+                "status": status,
+                "attempts": attempts,
+                "error": error,
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            }).eq("event_key", key).execute()
+        except Exception as e:
+            logger.warning(f"Failed to record status of {self.source} event {key}: {str(e)}")
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "in_flight": self._in_flight,
+            "waiting_retry": len(self._retries),
+            "workers": len(self._tasks),
+        }
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_SECONDS) -> None:
+        """Wait up to timeout for queued events to finish, then cancel the workers."""
+        if self._queue is not None and self._tasks:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Stopping {self.source} webhook workers with {self._queue.qsize()} events queued")
+        for task in [*self._tasks, *self._retries]:
+            task.cancel()
+        self._tasks.clear()
+        self._retries.clear()
+        self._queue = None
@@ -60,7 +60,9 @@ async def vectorise_coa(user_id: str):
 
     try:
         # Query existing chart of accounts for the user
-        result = await supabase.table("chart_of_accounts").select("*").eq("user_id", user_id).execute()
+        result = await supabase.table("chart_of_accounts").select(
+            "id, account_id, name, account_type, description, account_class"
+        ).eq("user_id", user_id).execute()
         
         if hasattr(result, 'error') and result.error is not None:
             raise Exception(f"Failed to fetch chart of accounts: {result.error}")
@@ -2,11 +2,17 @@ import asyncio
 import aiohttp
 import os
 import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 from typing import Dict, Any, Optional, List, Tuple
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 import logging
-from bs4 import BeautifulSoup
+from context_packing import Source, pack_context
+from page_content import extract_page, page_cache, read_capped
+from rate_limit import TokenBucket
 
 # Configure logging
 logging.basicConfig(
@@ -17,6 +23,119 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+BRAVE_SEARCH_URL = "https://api.search.brave.com/res/v1/web/search"
+# Brave's plan quota; the free tier allows one query per second
+BRAVE_REQUESTS_PER_SECOND = float(os.getenv("BRAVE_REQUESTS_PER_SECOND", "1"))
+
+# Connection pool shared by every search and page fetch
+MAX_CONNECTIONS = 20
+# Pages fetched from one site at once
+PER_HOST_CONCURRENCY = 2
+REQUEST_TIMEOUT_SECONDS = 10
+# Upper bound on how long a Retry-After header can make us wait
+MAX_RETRY_AFTER_SECONDS = 60
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+def retry_after_seconds(headers, default: float) -> float:
+    """
+    How long a 429/503 response asks us to wait.
+
+    Reads Retry-After (seconds or an HTTP date), then Brave's X-RateLimit-Reset
+    (seconds until the per-second window resets), falling back to default.
+    """
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            return min(max(float(value), 0.0), MAX_RETRY_AFTER_SECONDS)
+        except ValueError:
+            try:
+                wait = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+                return min(max(wait, 0.0), MAX_RETRY_AFTER_SECONDS)
+            except (TypeError, ValueError):
+                pass
+    reset = headers.get("X-RateLimit-Reset")
+    if reset:
+        try:
+            return min(max(float(reset.split(",")[0]), 0.0), MAX_RETRY_AFTER_SECONDS)
+        except ValueError:
+            pass
+    return default
+
+class SearchClient:
+    """
+    Long-lived HTTP client for Brave searches and page fetches.
+
+    Holds one pooled aiohttp session (connections and DNS lookups are reused
+    across calls), a token bucket for the Brave API quota, and a concurrency
+    limit per crawled host. Everything is rebuilt if used from a new event
+    loop, e.g. across separate asyncio.run calls.
+    """
+
+    def __init__(self, brave_rate: float = BRAVE_REQUESTS_PER_SECOND):
+        self.brave_rate = brave_rate
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.brave_limiter = TokenBucket(brave_rate)
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        # Monotonic time before which a host should not be requested again
+        self._host_ready: Dict[str, float] = {}
+
+    def _bind_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._session = None
+            self.brave_limiter = TokenBucket(self.brave_rate)
+            self._host_slots.clear()
+            self._host_ready.clear()
+
+    async def session(self) -> aiohttp.ClientSession:
+        self._bind_loop()
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS),
+                headers={"User-Agent": USER_AGENT},
+            )
+        return self._session
+
+    @asynccontextmanager
+    async def host_slot(self, url: str, min_interval: float = 0.0):
+        """
+        Hold one of the host's concurrent request slots.
+
+        Args:
+            url (str): The URL about to be requested
+            min_interval (float): Minimum gap between requests to this host
+        """
+        self._bind_loop()
+        host = urlsplit(url).netloc
+        slot = self._host_slots.setdefault(host, asyncio.Semaphore(PER_HOST_CONCURRENCY))
+        async with slot:
+            wait = self._host_ready.get(host, 0.0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._host_ready[host] = max(self._host_ready.get(host, 0.0), time.monotonic() + min_interval)
+            yield
+
+    def pause_host(self, url: str, seconds: float) -> None:
+        """Hold back requests to a host, e.g. after it answered 429 with Retry-After."""
+        host = urlsplit(url).netloc
+        self._host_ready[host] = max(self._host_ready.get(host, 0.0), time.monotonic() + seconds)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+search_client = SearchClient()
+
+async def close_search_client() -> None:
+    """Close the shared session and prune the page cache; call before the event loop shuts down."""
+    await search_client.close()
+    await page_cache.prune()
+
 # Pydantic models to structure the response
 class QueryInfo(BaseModel):
     original: str
@@ -103,64 +222,88 @@ async def format_search_results(response: Dict[Any, Any], include_content: bool
         logger.error(f"Error formatting results: {str(e)}")
         return ""
 
-async def fetch_url_content(url: str, session: aiohttp.ClientSession, retry_count: int = 2, delay: float = 1.0) -> Optional[str]:
+async def fetch_url_content(
+    url: str,
+    session: Optional[aiohttp.ClientSession] = None,
+    retry_count: int = 2,
+    delay: float = 1.0,
+    min_host_interval: float = 0.0
+) -> Optional[str]:
     """
     Fetch content from a URL and extract the main text.
     
+    Extracted text is kept in the page cache: fresh entries are returned without
+    a request, stale ones are revalidated with their ETag/Last-Modified.
+    
     Args:
         url (str): The URL to fetch content from
-        session (aiohttp.ClientSession): The aiohttp session to use for the request
+        session (Optional[aiohttp.ClientSession]): Session to use; defaults to the shared pooled session
         retry_count (int): Number of retries if request fails
-        delay (float): Delay between retries in seconds
+        delay (float): Delay between retries in seconds, unless the host sends Retry-After
+        min_host_interval (float): Minimum gap between requests to the same host
         
     Returns:
         Optional[str]: The extracted text content or None if request fails
     """
+    cached = await page_cache.get(url)
+    if cached is not None and page_cache.is_fresh(cached):
+        page_cache.hits += 1
+        logger.info(f"Using cached content for {url}")
+        return cached["text"]
+
+    conditional_headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            conditional_headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            conditional_headers["If-Modified-Since"] = cached["last_modified"]
+
+    session = session or await search_client.session()
     for attempt in range(retry_count + 1):
         try:
             logger.info(f"Fetching content from URL: {url} (attempt {attempt + 1}/{retry_count + 1})")
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-            }
             
-            async with session.get(url, headers=headers, timeout=10) as response:
-                if not response.ok:
-                    logger.warning(f"Failed to fetch URL {url}: Status {response.status}")
-                    if attempt < retry_count:
-                        logger.info(f"Retrying in {delay} seconds...")
-                        await asyncio.sleep(delay)
-                        continue
-                    return None
-                
-                content_type = response.headers.get('Content-Type', '')
-                if 'text/html' not in content_type and 'application/xhtml+xml' not in content_type:
-                    logger.warning(f"Skipping non-HTML content from {url}: {content_type}")
-                    return None
-                
-                html = await response.text()
-                
-                # Parse HTML and extract text
-                soup = BeautifulSoup(html, 'html.parser')
-                
-                # Get title
-                title = soup.title.string if soup.title else "No title"
-                
-                # Remove script and style elements
-                for script in soup(["script", "style"]):
-                    script.extract()
-                
-                # Get text
-                text = soup.get_text(separator='\n')
-                
-                # Break into lines and remove leading and trailing space on each
-                lines = (line.strip() for line in text.splitlines())
-                # Break multi-headlines into a line each
-                chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-                # Remove blank lines
-                text = '\n'.join(chunk for chunk in chunks if chunk)
-                
-                logger.info(f"Successfully extracted {len(text)} characters from {url}")
-                return text
+            async with search_client.host_slot(url, min_host_interval):
+                async with session.get(url, headers=conditional_headers) as response:
+                    if response.status == 304 and cached is not None:
+                        page_cache.revalidated += 1
+                        await page_cache.touch(cached)
+                        logger.info(f"Cached content for {url} is still current")
+                        return cached["text"]
+
+                    if not response.ok:
+                        logger.warning(f"Failed to fetch URL {url}: Status {response.status}")
+                        if attempt < retry_count:
+                            wait = delay
+                            if response.status in (429, 503):
+                                wait = retry_after_seconds(response.headers, delay)
+                                search_client.pause_host(url, wait)
+                            logger.info(f"Retrying in {wait} seconds...")
+                            await asyncio.sleep(wait)
+                            continue
+                        return None
+                    
+                    content_type = response.headers.get('Content-Type', '')
+                    if 'text/html' not in content_type and 'application/xhtml+xml' not in content_type:
+                        logger.warning(f"Skipping non-HTML content from {url}: {content_type}")
+                        return None
+                    
+                    body = await read_capped(response)
+                    try:
+                        html = body.decode(response.charset or 'utf-8', errors='replace')
+                    except LookupError:
+                        # Unknown charset label
+                        html = body.decode('utf-8', errors='replace')
+                    etag = response.headers.get('ETag')
+                    last_modified = response.headers.get('Last-Modified')
+            
+            # Parsing is CPU-bound; keep it off the event loop
+            page = await asyncio.to_thread(extract_page, html)
+            page_cache.misses += 1
+            await page_cache.put(url, page, etag, last_modified)
+            
+            logger.info(f"Successfully extracted {len(page.text)} characters from {url}")
+            return page.text
                 
         except Exception as e:
             logger.error(f"Error fetching content from {url}: {str(e)}")
@@ -170,15 +313,23 @@ async def fetch_url_content(url: str, session: aiohttp.ClientSession, retry_coun
             else:
                 return None
 
-async def fetch_all_url_contents(urls: List[str], session: aiohttp.ClientSession, concurrency_limit: int = 3, delay_between_requests: float = 1.0) -> Dict[str, str]:
+async def fetch_all_url_contents(
+    urls: List[str],
+    session: Optional[aiohttp.ClientSession] = None,
+    concurrency_limit: int = 3,
+    delay_between_requests: float = 0.0
+) -> Dict[str, str]:
     """
-    Fetch content from multiple URLs with rate limiting.
+    Fetch content from multiple URLs concurrently.
+    
+    Requests to different hosts run in parallel; each host is limited to
+    PER_HOST_CONCURRENCY requests at a time and delay_between_requests apart.
     
     Args:
         urls (List[str]): List of URLs to fetch content from
-        session (aiohttp.ClientSession): The aiohttp session to use for requests
+        session (Optional[aiohttp.ClientSession]): Session to use; defaults to the shared pooled session
         concurrency_limit (int): Maximum number of concurrent requests
-        delay_between_requests (float): Delay between requests in seconds
+        delay_between_requests (float): Minimum delay between requests to the same host in seconds
         
     Returns:
         Dict[str, str]: Dictionary mapping URLs to their content
@@ -188,16 +339,11 @@ async def fetch_all_url_contents(urls: List[str], session: aiohttp.ClientSession
     
     async def fetch_with_semaphore(url):
         async with semaphore:
-            content = await fetch_url_content(url, session)
+            content = await fetch_url_content(url, session, min_host_interval=delay_between_requests)
             if content:
                 url_contents[url] = content
-            await asyncio.sleep(delay_between_requests)  # Add delay between requests
     
-    # Create tasks for fetching content from each URL
-    tasks = [fetch_with_semaphore(url) for url in urls]
-    
-    # Wait for all tasks to complete
-    await asyncio.gather(*tasks)
+    await asyncio.gather(*(fetch_with_semaphore(url) for url in urls))
     
     return url_contents
 
@@ -209,21 +355,25 @@ async def brave_search_with_content(
     retry_count: int = 2,
     retry_delay: float = 2.0,
     concurrency_limit: int = 3,
-    delay_between_requests: float = 1.0
+    delay_between_requests: float = 0.0
 ) -> Tuple[Optional[str], Optional[Dict[str, str]]]:
     """
     Perform an asynchronous search query using the Brave Search API, 
     fetch content from the URLs in the results, and return both.
     
+    Searches share the client's token bucket, so concurrent callers run at the
+    Brave quota; a 429 pauses every caller for as long as Retry-After asks.
+    
     Args:
         query (str): The search query
         count (int): Number of results to return (max 20) (default: 5)
         offset (int): Number of results to skip for pagination (default: 0)
         fetch_content (bool): Whether to fetch content from the URLs (default: True)
         retry_count (int): Number of retries if request fails (default: 2)
-        retry_delay (float): Delay between retries in seconds (default: 2.0)
-        concurrency_limit (int): Maximum number of concurrent requests (default: 3)
-        delay_between_requests (float): Delay between requests in seconds (default: 1.0)
+        retry_delay (float): Base delay between retries in seconds, doubled each attempt,
+            when the API gives no Retry-After (default: 2.0)
+        concurrency_limit (int): Maximum number of concurrent page fetches (default: 3)
+        delay_between_requests (float): Minimum delay between page fetches from the same host in seconds (default: 0.0)
         
     Returns:
         Tuple[Optional[str], Optional[Dict[str, str]]]: 
@@ -234,8 +384,6 @@ async def brave_search_with_content(
     if not api_key:
         raise ValueError("BRAVE_SEARCH_API_KEY environment variable is not set")
 
-    base_url = "https://api.search.brave.com/res/v1/web/search"
-    
     headers = {
         "Accept": "application/json",
         "Accept-Encoding": "gzip",
@@ -252,69 +400,71 @@ async def brave_search_with_content(
     if offset > 0:
         params["offset"] = offset
 
+    session = await search_client.session()
+    data = None
     for attempt in range(retry_count + 1):
         try:
-            async with aiohttp.ClientSession() as session:
-                # Fetch search results
-                logger.info(f"Performing Brave search for query: {query} (attempt {attempt + 1}/{retry_count + 1})")
-                async with session.get(base_url, headers=headers, params=params) as response:
+            logger.info(f"Performing Brave search for query: {query} (attempt {attempt + 1}/{retry_count + 1})")
+            async with search_client.brave_limiter:
+                async with session.get(BRAVE_SEARCH_URL, headers=headers, params=params) as response:
                     if not response.ok:
                         error_text = await response.text()
                         logger.error(f"Error response from Brave Search API: {error_text}")
                         
                         # Check if rate limited
                         if response.status == 429:
+                            wait_time = retry_after_seconds(response.headers, retry_delay * 2 ** attempt)
+                            # Hold back every caller, not just this one
+                            search_client.brave_limiter.pause(wait_time)
                             if attempt < retry_count:
-                                wait_time = retry_delay * (attempt + 1)  # Exponential backoff
                                 logger.info(f"Rate limited. Retrying in {wait_time} seconds...")
-                                await asyncio.sleep(wait_time)
                                 continue
                         
                         return None, None
                     
                     try:
                         data = await response.json()
-                        
-                        # If we don't need to fetch content, just return the formatted results
-                        if not fetch_content:
-                            return await format_search_results(data), None
-                        
-                        # Extract URLs from search results
-                        urls = [result["url"] for result in data["web"]["results"]]
-                        logger.info(f"Found {len(urls)} URLs in search results")
-                        
-                        # Fetch content from each URL with rate limiting
-                        url_to_content = await fetch_all_url_contents(
-                            urls, 
-                            session, 
-                            concurrency_limit=concurrency_limit,
-                            delay_between_requests=delay_between_requests
-                        )
-                        
-                        logger.info(f"Successfully fetched content from {len(url_to_content)} URLs")
-                        
-                        # Add content to search results
-                        for result in data["web"]["results"]:
-                            result["content"] = url_to_content.get(result["url"])
-                        
-                        return await format_search_results(data, include_content=True), url_to_content
-                        
                     except ValueError as e:
                         logger.error(f"Failed to decode JSON response: {str(e)}")
                         raw_response = await response.text()
                         logger.error(f"Raw response: {raw_response[:200]}...")
                         return None, None
+            break
                     
         except aiohttp.ClientError as e:
             logger.error(f"Error making request to Brave Search API: {str(e)}")
             if attempt < retry_count:
-                wait_time = retry_delay * (attempt + 1)
+                wait_time = retry_delay * 2 ** attempt
                 logger.info(f"Retrying in {wait_time} seconds...")
                 await asyncio.sleep(wait_time)
             else:
                 return None, None
+
+    if data is None:
+        return None, None
+
+    # If we don't need to fetch content, just return the formatted results
+    if not fetch_content:
+        return await format_search_results(data), None
     
-    return None, None
+    # Extract URLs from search results
+    urls = [result["url"] for result in data.get("web", {}).get("results", [])]
+    logger.info(f"Found {len(urls)} URLs in search results")
+    
+    url_to_content = await fetch_all_url_contents(
+        urls, 
+        session, 
+        concurrency_limit=concurrency_limit,
+        delay_between_requests=delay_between_requests
+    )
+    
+    logger.info(f"Successfully fetched content from {len(url_to_content)} URLs")
+    
+    # Add content to search results
+    for result in data.get("web", {}).get("results", []):
+        result["content"] = url_to_content.get(result["url"])
+    
+    return await format_search_results(data, include_content=True), url_to_content
 
 async def brave_search(
     query: str,
@@ -351,7 +501,7 @@ async def get_content_for_llm(
     count: int = 5,
     max_content_length: int = 10000,
     concurrency_limit: int = 3,
-    delay_between_requests: float = 1.0
+    delay_between_requests: float = 0.0
 ) -> Optional[str]:
     """
     Perform a search and fetch content from URLs, formatting it for LLM consumption.
@@ -361,7 +511,7 @@ async def get_content_for_llm(
         count (int): Number of results to return (max 20) (default: 5)
         max_content_length (int): Maximum length of content to return per URL (default: 10000)
         concurrency_limit (int): Maximum number of concurrent requests (default: 3)
-        delay_between_requests (float): Delay between requests in seconds (default: 1.0)
+        delay_between_requests (float): Minimum delay between requests to the same host in seconds (default: 0.0)
         
     Returns:
         Optional[str]: Formatted content for LLM consumption or None if request fails
@@ -395,10 +545,10 @@ async def get_content_for_llm(
 async def fetch_documentation_for_llm(
     query: str,
     count: int = 5,
-    max_content_length: int = 10000,
-    max_total_length: int = 50000,
+    max_tokens: int = 12000,
+    max_source_tokens: Optional[int] = 4000,
     concurrency_limit: int = 2,
-    delay_between_requests: float = 1.5,
+    delay_between_requests: float = 0.0,
     retry_count: int = 2,
     retry_delay: float = 2.0
 ) -> Dict[str, Any]:
@@ -406,13 +556,17 @@ async def fetch_documentation_for_llm(
     Fetch documentation content from search results and format it for LLM consumption.
     This function is specifically designed for retrieving documentation and API references.
     
+    Pages are packed by context_packing.pack_context: the passages most relevant
+    to the query are kept, up to an exact token budget, rather than each page's
+    first characters.
+    
     Args:
         query (str): The search query, preferably specific to documentation or API references
         count (int): Number of search results to process (max 20) (default: 5)
-        max_content_length (int): Maximum length of content to return per URL (default: 10000)
-        max_total_length (int): Maximum total length of all content combined (default: 50000)
+        max_tokens (int): Token budget of formatted_content (default: 12000)
+        max_source_tokens (Optional[int]): Most content tokens taken from one URL (default: 4000)
         concurrency_limit (int): Maximum number of concurrent requests (default: 2)
-        delay_between_requests (float): Delay between requests in seconds (default: 1.5)
+        delay_between_requests (float): Minimum delay between requests to the same host in seconds (default: 0.0)
         retry_count (int): Number of retries if request fails (default: 2)
         retry_delay (float): Delay between retries in seconds (default: 2.0)
         
@@ -422,8 +576,10 @@ async def fetch_documentation_for_llm(
             - 'search_results': List of search result objects with title, url, and description
             - 'content': Dictionary mapping URLs to their extracted content
             - 'formatted_content': Formatted content ready for LLM consumption
-            - 'total_content_length': Total length of all content combined
+            - 'total_content_length': Length in characters of the content included
+            - 'token_count': Tokens in formatted_content
             - 'sources': List of sources with metadata
+            - 'source_metadata': Dictionary mapping URLs to title, description and token usage
     """
     logger.info(f"Fetching documentation for query: {query}")
     
@@ -446,7 +602,9 @@ async def fetch_documentation_for_llm(
             'content': {},
             'formatted_content': "",
             'total_content_length': 0,
-            'sources': []
+            'token_count': 0,
+            'sources': [],
+            'source_metadata': {}
         }
     
     # Extract search results from markdown
@@ -470,113 +628,50 @@ async def fetch_documentation_for_llm(
                 # This must be a title
                 current_result = {'title': line.strip()}
     
-    # Format content for LLM consumption with better structure
-    formatted_content = []
-    formatted_content.append(f"# Documentation Results for: {query}\n")
-    
-    sources = []
-    total_content_length = 0
-    truncated_content = {}
-    
-    # Sort URLs by content length (descending) to prioritize more comprehensive documentation
-    sorted_urls = sorted(url_content.items(), key=lambda x: len(x[1]), reverse=True)
+    results_by_url = {result['url']: result for result in search_result_objects if result.get('url')}
     
-    for url, content in sorted_urls:
-        # Find the title from search results
-        title = next((result['title'] for result in search_result_objects if result.get('url') == url), "Unknown Title")
-        
-        # Clean and format the content
-        content = content.strip()
-        content_length = len(content)
-        
-        # Truncate content if too long
-        if content_length > max_content_length:
-            truncated_content[url] = content[:max_content_length] + "... [content truncated]"
-        else:
-            truncated_content[url] = content
-        
-        # Add to total length
-        total_content_length += len(truncated_content[url])
-        
-        # Add source metadata
-        sources.append({
-            'url': url,
-            'title': title,
-            'content_length': content_length,
-            'truncated': content_length > max_content_length
-        })
-    
-    # Check if total content exceeds maximum and truncate if necessary
-    if total_content_length > max_total_length:
-        logger.warning(f"Total content length ({total_content_length}) exceeds maximum ({max_total_length}). Truncating...")
-        
-        # Reset and recalculate
-        total_content_length = 0
-        new_truncated_content = {}
-        
-        # Allocate content proportionally to each source
-        for url, content in sorted_urls:
-            # Calculate proportion of max_total_length this source should get
-            original_length = len(url_content[url])
-            proportion = original_length / sum(len(content) for _, content in sorted_urls)
-            allocated_length = int(proportion * max_total_length)
-            
-            # Ensure minimum content is preserved
-            allocated_length = max(allocated_length, 1000)  # At least 1000 chars per source
-            allocated_length = min(allocated_length, original_length)  # But not more than original
-            
-            # Truncate content
-            if original_length > allocated_length:
-                new_truncated_content[url] = url_content[url][:allocated_length] + "... [content truncated]"
-            else:
-                new_truncated_content[url] = url_content[url]
-            
-            # Update source metadata
-            for source in sources:
-                if source['url'] == url:
-                    source['truncated'] = original_length > allocated_length
-                    break
-            
-            # Add to total length
-            total_content_length += len(new_truncated_content[url])
-            
-            # Stop if we've exceeded max_total_length
-            if total_content_length >= max_total_length:
-                break
-        
-        truncated_content = new_truncated_content
+    # Keep search rank order; pages that failed to fetch are skipped
+    ranked_urls = [url for url in results_by_url if url in url_content]
+    ranked_urls += [url for url in url_content if url not in results_by_url]
+    sources = [
+        Source(
+            url=url,
+            title=results_by_url.get(url, {}).get('title', "Unknown Title"),
+            text=url_content[url].strip(),
+            description=results_by_url.get(url, {}).get('description', "")
+        )
+        for url in ranked_urls
+    ]
     
-    # Format the content for LLM consumption
-    for url, content in truncated_content.items():
-        # Find the title from search results
-        title = next((result['title'] for result in search_result_objects if result.get('url') == url), "Unknown Title")
-        
-        formatted_content.append(f"## {title}")
-        formatted_content.append(f"Source: {url}")
-        formatted_content.append(f"```")
-        formatted_content.append(content)
-        formatted_content.append(f"```")
-        formatted_content.append("\n---\n")
-    
-    # Add a summary of sources at the end
-    formatted_content.append("## Sources Summary")
-    for i, source in enumerate(sources, 1):
-        if source['url'] in truncated_content:
-            formatted_content.append(f"{i}. [{source['title']}]({source['url']}) - {source['content_length']} chars" + 
-                                    (" (truncated)" if source['truncated'] else ""))
+    # Tokenizing and scoring is CPU-bound; keep it off the event loop
+    # The sources summary is rendered inside the budget, so token_count is exact
+    packed = await asyncio.to_thread(
+        pack_context, query, sources, max_tokens, max_source_tokens, summary=True
+    )
     
     return {
         'query': query,
         'search_results': search_result_objects,
         'content': url_content,
-        'formatted_content': "\n".join(formatted_content),
-        'total_content_length': total_content_length,
-        'sources': sources
+        'formatted_content': packed.text,
+        'total_content_length': len(packed.text),
+        'token_count': packed.token_count,
+        'sources': [
+            {
+                'url': url,
+                'title': meta['title'],
+                'content_length': len(url_content[url]),
+                'truncated': meta['truncated']
+            }
+            for url, meta in packed.sources.items()
+        ],
+        'source_metadata': packed.sources
     }
 
 if __name__ == "__main__":
     # Example usage
     async def main():
+        # The shared client spaces searches to the Brave quota, so no sleeps are needed
         # Example 1: Just search results
         logger.info("Running example 1: Just search results")
         results = await brave_search("NYLAS API WEBHOOK REGISTRATION", count=2)
@@ -584,46 +679,34 @@ if __name__ == "__main__":
             print(results)
             print("\n" + "="*50 + "\n")
         
-        # Add delay to avoid rate limiting
-        await asyncio.sleep(3)
-        
         # Example 2: Search results with content
         logger.info("Running example 2: Search results with content")
         results, url_content = await brave_search_with_content(
             "NYLAS API WEBHOOK REGISTRATION", 
             count=2,
-            concurrency_limit=1,  # Limit concurrency to avoid rate limiting
-            delay_between_requests=2.0  # Add delay between requests
+            concurrency_limit=1
         )
         if results:
             print(results)
             print("\n" + "="*50 + "\n")
         
-        # Add delay to avoid rate limiting
-        await asyncio.sleep(3)
-        
         # Example 3: Get content for LLM processing
         logger.info("Running example 3: Get content for LLM processing")
         llm_content = await get_content_for_llm(
             "NYLAS API WEBHOOK REGISTRATION", 
             count=2,
-            concurrency_limit=1,  # Limit concurrency to avoid rate limiting
-            delay_between_requests=2.0  # Add delay between requests
+            concurrency_limit=1
         )
         if llm_content:
             print(f"Content for LLM processing (preview):")
             print(llm_content[:500] + "...\n")
         
-        # Add delay to avoid rate limiting
-        await asyncio.sleep(3)
-        
         # Example 4: Fetch documentation for LLM with advanced formatting
         logger.info("Running example 4: Fetch documentation for LLM with advanced formatting")
         doc_results = await fetch_documentation_for_llm(
             "NYLAS API WEBHOOK REGISTRATION", 
             count=2,
-            concurrency_limit=1,
-            delay_between_requests=2.0
+            concurrency_limit=1
         )
         if doc_results['formatted_content']:
             print(f"Documentation for LLM (preview):")
@@ -634,4 +717,10 @@ if __name__ == "__main__":
                 print(f"  {i}. {source['title']} - {source['content_length']} chars" + 
                       (" (truncated)" if source['truncated'] else ""))
 
-    asyncio.run(main())
+    async def run_examples():
+        try:
+            await main()
+        finally:
+            await close_search_client()
+
+    asyncio.run(run_examples())
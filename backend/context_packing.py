@@ -0,0 +1,209 @@
+"""
+Pack fetched web pages into an LLM prompt under an exact token budget.
+
+Each source is tokenized once (with the cached encoder from
+app.services.etl.chunking) and cut into passages. Passages are scored for
+relevance to the query with BM25, plus a small bonus for appearing early in
+the page and for higher-ranked search results. The best ones are packed
+greedily until the budget is spent, and then emitted in page order under
+their source's heading.
+"""
+
+import logging
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.services.etl.chunking import DEFAULT_MODEL, chunk_by_pages, get_encoder
+from app.services.hybrid_search import BM25Index
+
+logger = logging.getLogger(__name__)
+
+# Target passage size; passages are whole lines of the extracted text
+PASSAGE_TOKENS = 120
+# Weight of a passage's position in its page and of its source's search rank,
+# relative to a BM25 score normalised to [0, 1]
+POSITION_WEIGHT = 0.15
+RANK_WEIGHT = 0.1
+
+OMISSION_MARKER = "[...]"
+
+
+class Source(NamedTuple):
+    url: str
+    title: str
+    text: str
+    description: str = ""
+
+
+class Passage(NamedTuple):
+    source: int
+    position: int
+    text: str
+    token_count: int
+
+
+class PackedContext(NamedTuple):
+    text: str
+    token_count: int
+    # URL -> title, description, content_tokens, included_tokens, passages, truncated
+    sources: Dict[str, Dict[str, Any]]
+
+
+def split_passages(sources: Sequence[Source], model: str = DEFAULT_MODEL) -> List[Passage]:
+    """Cut every source into passages of about PASSAGE_TOKENS, keeping lines whole."""
+    passages = []
+    for index, source in enumerate(sources):
+        lines = [line for line in source.text.splitlines() if line.strip()]
+        chunks = chunk_by_pages(lines, max_window_size=PASSAGE_TOKENS, overlap=0, model=model)
+        passages.extend(
+            Passage(index, position, chunk.text, chunk.token_count)
+            for position, chunk in enumerate(chunks)
+        )
+    return passages
+
+
+def score_passages(query: str, passages: Sequence[Passage], n_sources: int) -> np.ndarray:
+    """Relevance of each passage to the query; higher is better."""
+    if not passages:
+        return np.zeros(0)
+    relevance = BM25Index([passage.text for passage in passages]).scores(query).astype(float)
+    if relevance.max() > 0:
+        relevance /= relevance.max()
+
+    positions = np.array([passage.position for passage in passages], dtype=float)
+    source_ranks = np.array([passage.source for passage in passages], dtype=float)
+    # Intros and top-ranked results tend to carry the definitions
+    position_prior = 1.0 / (1.0 + positions)
+    rank_prior = 1.0 - source_ranks / max(n_sources, 1)
+    return relevance + POSITION_WEIGHT * position_prior + RANK_WEIGHT * rank_prior
+
+
+SUMMARY_HEADING = "## Sources Summary"
+
+
+def _summary_line(number: int, source: Source, content_tokens: int, truncated: bool) -> str:
+    return f"{number}. [{source.title}]({source.url}) - {content_tokens} tokens" + (" (truncated)" if truncated else "")
+
+
+def _render(
+    query: str,
+    sources: Sequence[Source],
+    selected: Dict[int, List[Passage]],
+    summary: Optional[Sequence[Tuple[int, int]]] = None,
+) -> str:
+    """summary holds (content tokens, passage count) per source when a sources summary is wanted."""
+    parts = [f"# Documentation Results for: {query}\n"]
+    for index in sorted(selected):
+        source = sources[index]
+        passages = sorted(selected[index], key=lambda p: p.position)
+        body = []
+        previous = -1
+        for passage in passages:
+            if passage.position != previous + 1:
+                body.append(OMISSION_MARKER)
+            body.append(passage.text)
+            previous = passage.position
+        parts.append(f"## {source.title}")
+        parts.append(f"Source: {source.url}")
+        parts.append("```")
+        parts.append("\n".join(body))
+        parts.append("```")
+        parts.append("\n---\n")
+    if summary is not None:
+        parts.append(SUMMARY_HEADING)
+        for number, index in enumerate(sorted(selected), 1):
+            content_tokens, passage_count = summary[index]
+            parts.append(_summary_line(number, sources[index], content_tokens, len(selected[index]) < passage_count))
+    return "\n".join(parts)
+
+
+def pack_context(
+    query: str,
+    sources: Sequence[Source],
+    max_tokens: int,
+    max_source_tokens: Optional[int] = None,
+    model: str = DEFAULT_MODEL,
+    summary: bool = False,
+) -> PackedContext:
+    """
+    Select the passages most relevant to the query that fit in max_tokens.
+
+    Args:
+        query (str): What the context is for; passages are ranked against it
+        sources (Sequence[Source]): Pages in search-rank order
+        max_tokens (int): Hard limit on the tokens of the returned text
+        max_source_tokens (Optional[int]): Limit on content tokens taken from any one source
+        model (str): Model whose tokenizer measures the budget
+        summary (bool): End the text with a numbered summary of the included
+            sources, counted against max_tokens like everything else
+
+    Returns:
+        PackedContext: The rendered context, its exact token count and per-URL metadata
+    """
+    encoder = get_encoder(model)
+    passages = split_passages(sources, model)
+    scores = score_passages(query, passages, len(sources))
+    order = np.argsort(-scores, kind="stable")
+
+    content_tokens = [0] * len(sources)
+    passage_counts = [0] * len(sources)
+    for passage in passages:
+        content_tokens[passage.source] += passage.token_count
+        passage_counts[passage.source] += 1
+    source_totals = list(zip(content_tokens, passage_counts)) if summary else None
+
+    # Per-source cost of the heading, URL and code fence around its passages,
+    # and of its summary line
+    overhead = [
+        len(encoder.encode_ordinary(f"## {s.title}\nSource: {s.url}\n```\n\n```\n\n---\n\n"))
+        + (len(encoder.encode_ordinary(_summary_line(index + 1, s, content_tokens[index], True) + "\n")) if summary else 0)
+        for index, s in enumerate(sources)
+    ]
+    used = len(encoder.encode_ordinary(f"# Documentation Results for: {query}\n\n"))
+    if summary:
+        used += len(encoder.encode_ordinary(SUMMARY_HEADING + "\n"))
+    source_used = [0] * len(sources)
+    selected: Dict[int, List[Passage]] = {}
+    for i in order.tolist():
+        passage = passages[i]
+        # +2 covers the joining newline and a possible omission marker
+        cost = passage.token_count + 2 + (0 if passage.source in selected else overhead[passage.source])
+        if used + cost > max_tokens:
+            continue
+        if max_source_tokens is not None and source_used[passage.source] + passage.token_count > max_source_tokens:
+            continue
+        selected.setdefault(passage.source, []).append(passage)
+        source_used[passage.source] += passage.token_count
+        used += cost
+
+    # The running total is an estimate (tokens can merge across joins), so
+    # measure the rendered text and drop the weakest passages if it is over
+    text = _render(query, sources, selected, source_totals)
+    token_count = len(encoder.encode_ordinary(text))
+    score_of = dict(zip(passages, scores.tolist()))
+    while token_count > max_tokens and selected:
+        weakest = min((p for ps in selected.values() for p in ps), key=score_of.__getitem__)
+        selected[weakest.source].remove(weakest)
+        source_used[weakest.source] -= weakest.token_count
+        if not selected[weakest.source]:
+            del selected[weakest.source]
+        text = _render(query, sources, selected, source_totals)
+        token_count = len(encoder.encode_ordinary(text))
+
+    metadata = {
+        source.url: {
+            "title": source.title,
+            "description": source.description,
+            "content_tokens": content_tokens[index],
+            "included_tokens": source_used[index],
+            "passages": len(selected.get(index, [])),
+            "truncated": len(selected.get(index, [])) < passage_counts[index],
+        }
+        for index, source in enumerate(sources)
+    }
+    logger.info(
+        f"Packed {sum(len(ps) for ps in selected.values())}/{len(passages)} passages from "
+        f"{len(selected)}/{len(sources)} sources into {token_count}/{max_tokens} tokens"
+    )
+    return PackedContext(text, token_count, metadata)
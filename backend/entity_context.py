@@ -0,0 +1,226 @@
+"""
+Persistent cache of web-search context about transaction counterparties.
+
+Contexts are stored in the shared entity_contexts table (sql/entity_contexts.sql)
+under a normalised entity key, so every user's statements reuse the same
+lookups and only vendors nobody has seen recently go to Brave Search.
+"""
+
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from app.services.counterparty import normalize_counterparty
+
+logger = logging.getLogger(__name__)
+
+ENTITY_CONTEXT_TABLE = "entity_contexts"
+ENTITY_CONTEXT_TTL_DAYS = int(os.getenv("ENTITY_CONTEXT_TTL_DAYS", "30"))
+# Empty results are cached too, but retried sooner in case the search improves
+ENTITY_CONTEXT_NEGATIVE_TTL_DAYS = int(os.getenv("ENTITY_CONTEXT_NEGATIVE_TTL_DAYS", "7"))
+ENTITY_CONTEXT_MAX_CHARS = 1500
+
+# Keys per in_() query when prefetching
+PREFETCH_BATCH_SIZE = 200
+
+_HTML_TAG = re.compile(r"<[^>]+>")
+
+
+def normalize_entity(name: str) -> str:
+    """
+    Cache key for a counterparty name as it appears on bank statements.
+
+    "DIGITALOCEAN.COM" and "DigitalOcean LLC" share the key "digitalocean";
+    see app.services.counterparty.normalize_counterparty.
+    """
+    return normalize_counterparty(name)
+
+
+def summarize_search_results(markdown: str, max_chars: int = ENTITY_CONTEXT_MAX_CHARS) -> str:
+    """
+    Condense brave_search's markdown into one line per result.
+
+    Keeps each result's title, host and description and drops the heading,
+    separators and markup, so the stored context is a few hundred characters
+    of prompt rather than the full listing.
+    """
+    lines = []
+    title, host = None, None
+    for line in markdown.splitlines():
+        line = line.strip()
+        if not line or line.startswith("# Search Results for:") or line.startswith("---"):
+            continue
+        if line.startswith("URL:"):
+            url = line[len("URL:"):].strip()
+            host = url.split("//", 1)[-1].split("/", 1)[0]
+        elif line.startswith("Description:"):
+            description = _HTML_TAG.sub("", line[len("Description:"):]).strip()
+            label = f"{title} ({host})" if host else title
+            lines.append(f"- {label}: {description}" if label else f"- {description}")
+            title, host = None, None
+        elif not line.startswith("Age:"):
+            # "1. Title" starts a result
+            title = _HTML_TAG.sub("", line.split(". ", 1)[-1]).strip()
+
+    summary = "\n".join(lines)
+    return summary if len(summary) <= max_chars else summary[:max_chars].rsplit("\n", 1)[0]
+
+
+class EntityContextCache:
+    """
+    Read-through cache of entity contexts backed by Supabase.
+
+    An in-process layer avoids repeat queries within a run, and concurrent
+    lookups of the same entity share a single search.
+    """
+
+    def __init__(
+        self,
+        client,
+        table: str = ENTITY_CONTEXT_TABLE,
+        ttl: timedelta = timedelta(days=ENTITY_CONTEXT_TTL_DAYS),
+        negative_ttl: timedelta = timedelta(days=ENTITY_CONTEXT_NEGATIVE_TTL_DAYS),
+    ):
+        self._client = client
+        self.table = table
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._memory: Dict[str, Tuple[str, datetime]] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, key: str) -> Optional[str]:
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        context, expires_at = entry
+        if expires_at <= datetime.now(timezone.utc):
+            del self._memory[key]
+            return None
+        return context
+
+    def _remember(self, row: Dict) -> None:
+        expires_at = datetime.fromisoformat(row["expires_at"].replace("Z", "+00:00"))
+        self._memory[row["entity_key"]] = (row["context"] or "", expires_at)
+
+    async def prefetch(self, entity_names: Iterable[str]) -> int:
+        """
+        Load every unexpired context for these entities in a few queries.
+
+        Returns:
+            int: Number of entities found in the cache
+        """
+        keys = sorted({normalize_entity(name) for name in entity_names} - set(self._memory))
+        now = datetime.now(timezone.utc).isoformat()
+        found = 0
+        for start in range(0, len(keys), PREFETCH_BATCH_SIZE):
+            batch = keys[start:start + PREFETCH_BATCH_SIZE]
+            try:
+                response = await asyncio.to_thread(
+                    lambda: self._client.table(self.table)
+                    .select("entity_key, context, expires_at")
+                    .in_("entity_key", batch)
+                    .gt("expires_at", now)
+                    .execute()
+                )
+            except Exception as e:
+                logger.warning(f"Failed to prefetch entity contexts: {str(e)}")
+                return found
+            for row in response.data:
+                self._remember(row)
+            found += len(response.data)
+        logger.info(f"Prefetched cached context for {found}/{len(keys)} entities")
+        return found
+
+    async def get(self, entity_name: str) -> Optional[str]:
+        """Cached context ('' for a cached empty result), or None on a miss."""
+        key = normalize_entity(entity_name)
+        context = self._cached(key)
+        if context is not None:
+            return context
+
+        try:
+            response = await asyncio.to_thread(
+                lambda: self._client.table(self.table)
+                .select("entity_key, context, expires_at")
+                .eq("entity_key", key)
+                .gt("expires_at", datetime.now(timezone.utc).isoformat())
+                .execute()
+            )
+        except Exception as e:
+            logger.warning(f"Failed to read cached context for {entity_name}: {str(e)}")
+            return None
+        if not response.data:
+            return None
+        self._remember(response.data[0])
+        return self._cached(key)
+
+    async def set(self, entity_name: str, context: str) -> None:
+        key = normalize_entity(entity_name)
+        now = datetime.now(timezone.utc)
+        expires_at = now + (self.ttl if context else self.negative_ttl)
+        self._memory[key] = (context, expires_at)
+        row = {
+            "entity_key": key,
+            "entity_name": entity_name,
+            "context": context,
+            "is_empty": not context,
+            "fetched_at": now.isoformat(),
+            "expires_at": expires_at.isoformat(),
+        }
+        try:
+            await asyncio.to_thread(
+                lambda: self._client.table(self.table).upsert(row).execute()
+            )
+        except Exception as e:
+            # The context is still used for this run; it is just not shared
+            logger.warning(f"Failed to store context for {entity_name}: {str(e)}")
+
+    async def get_or_fetch(
+        self,
+        entity_name: str,
+        fetch: Callable[[str], Awaitable[Optional[str]]]
+    ) -> str:
+        """
+        Cached context for an entity, searching and storing it on a miss.
+
+        Args:
+            entity_name (str): Counterparty name as it appears on the statement
+            fetch (Callable[[str], Awaitable[Optional[str]]]): Searches for the entity
+                and returns brave_search markdown, or None when the search failed
+
+        Returns:
+            str: Summarised context, or '' when nothing useful was found
+        """
+        key = normalize_entity(entity_name)
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            context = await self.get(entity_name)
+            if context is not None:
+                self.hits += 1
+                logger.info(f"Using cached context for {entity_name}" + ("" if context else " (no results)"))
+            else:
+                self.misses += 1
+                results = await fetch(entity_name)
+                context = summarize_search_results(results) if results else ""
+                # A failed search (None) is not cached, so the next run retries it
+                if results is not None:
+                    await self.set(entity_name, context)
+            future.set_result(context)
+            return context
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so an unawaited future does not log a warning
+            future.exception()
+            raise
+        finally:
+            del self._pending[key]
@@ -1,7 +1,9 @@
 from pydantic import BaseModel
-from typing import List, Union, Literal
-from datetime import datetime
+from typing import AsyncIterator, Dict, List, Literal, Optional, Set, Tuple, Union
+from datetime import datetime, timezone
 from pathlib import Path
+import argparse
+import hashlib
 import json
 import uuid
 import base64
@@ -12,10 +14,19 @@ import logging
 import os
 from tqdm import tqdm
 import asyncio
-from itertools import islice
+
+from invoice_text import (
+    check_extraction,
+    describe_anchors,
+    find_anchors,
+    has_text_layer,
+    is_confident,
+    read_text_layer,
+)
+from rate_limit import TokenBucket
 
 
-from app.core.supabase_client import get_supabase
+from app.core.supabase_client import close_connections, get_supabase
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -50,294 +61,678 @@ class InvoiceTable(BaseModel):
 
 
 """ EXTRACTING INVOICE DATA FROM PDF """
-async def invoke_llm(base64_image: str, json_schema: dict) -> str:
+
+# Pages are rendered at this resolution; 150 DPI keeps invoice text legible to
+# the vision model at a fraction of pdf2image's default 200 DPI colour pixels
+RASTER_DPI = int(os.getenv("INVOICE_RASTER_DPI", "150"))
+RASTER_GRAYSCALE = os.getenv("INVOICE_RASTER_GRAYSCALE", "true").lower() == "true"
+JPEG_QUALITY = int(os.getenv("INVOICE_JPEG_QUALITY", "80"))
+
+# Send byte-identical rendered pages to the model once. Off by default: only
+# exact copies are skipped, since invoices sharing a template look alike
+DEDUP_IDENTICAL_PAGES = os.getenv("INVOICE_DEDUP_IDENTICAL_PAGES", "false").lower() == "true"
+
+# Limits shared by every vision call in the process
+VISION_MAX_CONCURRENCY = int(os.getenv("INVOICE_VISION_MAX_CONCURRENCY", "4"))
+VISION_REQUESTS_PER_MINUTE = float(os.getenv("INVOICE_VISION_REQUESTS_PER_MINUTE", "60"))
+# Rendered pages waiting for the model; rasterization pauses beyond this
+MAX_PENDING_PAGES = VISION_MAX_CONCURRENCY * 2
+
+# Pages with a text layer are first extracted from their text by a cheaper
+# text-only model; only scanned pages and doubtful results go to vision
+TEXT_MODEL = os.getenv("INVOICE_TEXT_MODEL", "gpt-4o-mini")
+TEXT_MAX_CONCURRENCY = int(os.getenv("INVOICE_TEXT_MAX_CONCURRENCY", "8"))
+TEXT_REQUESTS_PER_MINUTE = float(os.getenv("INVOICE_TEXT_REQUESTS_PER_MINUTE", "300"))
+# Page text beyond this many characters is left out of the prompt
+MAX_PAGE_TEXT_CHARS = 12000
+
+INVOICE_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "invoice_from": {
+            "type": "object",
+            "properties": {
+                "name": {"type": "string"},
+                "address": {"type": "string"},
+                "tax_id": {"type": "string"},
+                # Additional optional fields
+                "email": {"type": "string"},
+                "phone": {"type": "string"},
+                "website": {"type": "string"},
+                "registration_number": {"type": "string"},
+                "vat_number": {"type": "string"}
+            },
+            "required": ["name", "address"]  # Only these are required
+        },
+        "invoice_to": {
+            "type": "object",
+            "properties": {
+                "name": {"type": "string"},
+                "address": {"type": "string"},
+                "tax_id": {"type": "string"},
+                # Additional optional fields
+                "email": {"type": "string"},
+                "phone": {"type": "string"},
+                "reference": {"type": "string"},
+                "department": {"type": "string"}
+            },
+            "required": ["name", "address"]
+        },
+        "date": {
+            "type": "object",
+            "properties": {
+                "issue_date": {"type": "string"},
+                "due_date": {"type": "string"},
+                "payment_due_by": {"type": "string"},  # Explicit field for AP tracking
+                # Additional optional fields
+                "delivery_date": {"type": "string"},
+                "service_period_start": {"type": "string"},
+                "service_period_end": {"type": "string"},
+                "payment_status": {  # Additional metadata for AP
+                    "type": "string",
+                    "enum": ["pending", "overdue", "paid", "partially_paid"]
+                },
+            },
+            "required": ["issue_date"]
+        },
+        "amount": {
+            "type": "object",
+            "properties": {
+                "subtotal": {"type": "string"},
+                "tax": {
+                    "type": "object",
+                    "properties": {
+                        "rate": {"type": "string"},
+                        "amount": {"type": "string"}
+                    }
+                },
+                "shipping": {"type": "string"},
+                "discounts": {"type": "string"},
+                "total": {"type": "string"},
+                "currency": {"type": "string"}
+            }
+        },
+        "line_items": {
+            "type": "object",
+            "properties": {
+                "items": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "description": {"type": "string"},
+                            "quantity": {"type": "number"},
+                            "unit_price": {"type": "string"},
+                            "vat_rate": {"type": "string"},
+                            "total": {"type": "string"},
+                            # Additional optional fields
+                            "sku": {"type": "string"},
+                            "unit": {"type": "string"},
+                            "discount": {"type": "string"},
+                            "category": {"type": "string"}
+                        },
+                        "required": ["description", "quantity", "total"]
+                    }
+                }
+            }
+        },
+        "payment_terms": {"type": "string"},
+        "notes": {"type": "string"},
+        "ai_description": {"type": "string"}
+    },
+    "required": ["invoice_from", "invoice_to", "date", "amount", "line_items", "ai_description"]
+}
+
+_openai_client: Optional[AsyncOpenAI] = None
+
+vision_limiter = TokenBucket(
+    VISION_REQUESTS_PER_MINUTE / 60,
+    capacity=VISION_MAX_CONCURRENCY,
+    max_concurrency=VISION_MAX_CONCURRENCY
+)
+
+text_limiter = TokenBucket(
+    TEXT_REQUESTS_PER_MINUTE / 60,
+    capacity=TEXT_MAX_CONCURRENCY,
+    max_concurrency=TEXT_MAX_CONCURRENCY
+)
+
+def get_openai_client() -> AsyncOpenAI:
+    """One OpenAI client per process, so its connection pool is reused."""
+    global _openai_client
+    if _openai_client is None:
+        logger.debug("Initializing OpenAI client")
+        _openai_client = AsyncOpenAI()
+    return _openai_client
+
+def page_count(pdf_path: str) -> int:
+    return pdf2image.pdfinfo_from_path(pdf_path)["Pages"]
+
+def render_page(pdf_path: str, page_number: int) -> Tuple[bytes, str]:
+    """Rasterize one page (1-based) to JPEG bytes at RASTER_DPI, with their SHA-256."""
+    image = pdf2image.convert_from_path(
+        pdf_path,
+        dpi=RASTER_DPI,
+        first_page=page_number,
+        last_page=page_number,
+        grayscale=RASTER_GRAYSCALE
+    )[0]
+    try:
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        jpeg = buffer.getvalue()
+        return jpeg, hashlib.sha256(jpeg).hexdigest()
+    finally:
+        image.close()
+
+async def iter_page_images(pdf_path: str, page_numbers: Optional[List[int]] = None) -> AsyncIterator[Tuple[int, bytes, str]]:
+    """
+    Yield (page number, JPEG bytes, JPEG SHA-256) one page at a time.
+
+    Only the page being rendered is held as a bitmap, instead of every page of
+    the document at full resolution. page_numbers (1-based) limits rendering to
+    those pages; by default every page is rendered.
+    """
+    if page_numbers is None:
+        page_numbers = list(range(1, await asyncio.to_thread(page_count, pdf_path) + 1))
+    logger.info(f"Rasterizing {len(page_numbers)} pages of {pdf_path} at {RASTER_DPI} DPI")
+    for page_number in page_numbers:
+        jpeg, page_hash = await asyncio.to_thread(render_page, pdf_path, page_number)
+        yield page_number, jpeg, page_hash
+
+async def invoke_llm(base64_image: str, json_schema: dict = INVOICE_JSON_SCHEMA, media_type: str = "image/jpeg") -> str:
     """
     Invoke OpenAI's vision model to extract information from an invoice image.
     
     Args:
         base64_image: Base64 encoded image string
         json_schema: JSON schema defining the expected response structure
+        media_type: MIME type of the encoded image
     
     Returns:
         str: The extracted data as a JSON string
     """
-    logger.debug("Initializing OpenAI client")
-    client = AsyncOpenAI()
+    client = get_openai_client()
 
     # Call OpenAI API with function calling
     logger.info("Sending request to OpenAI API")
-    response = await client.chat.completions.create(
-        model="gpt-4o",  # Updated to correct model name
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a precise invoice data extraction assistant. You will first review the content of the invoice and internally understand it, then you will extract the information exactly according to the specified schema."
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Extract the invoice information in JSON format."
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/png;base64,{base64_image}"
+    async with vision_limiter:
+        response = await client.chat.completions.create(
+            model="gpt-4o",  # Updated to correct model name
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You are a precise invoice data extraction assistant. You will first review the content of the invoice and internally understand it, then you will extract the information exactly according to the specified schema."
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": "Extract the invoice information in JSON format."
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{media_type};base64,{base64_image}"
+                            }
                         }
-                    }
-                ]
-            }
-        ],
-        functions=[
-            {
-                "name": "extract_invoice_data",
-                "description": "Extract structured data from invoice",
-                "parameters": json_schema
-            }
-        ],
-        function_call={"name": "extract_invoice_data"},
-        max_tokens=1500
-    )
+                    ]
+                }
+            ],
+            functions=[
+                {
+                    "name": "extract_invoice_data",
+                    "description": "Extract structured data from invoice",
+                    "parameters": json_schema
+                }
+            ],
+            function_call={"name": "extract_invoice_data"},
+            max_tokens=1500
+        )
     logger.info("Received response from OpenAI")
     
     return response.choices[0].message.function_call.arguments
 
+async def invoke_text_llm(page_text: str, hints: str = "", json_schema: dict = INVOICE_JSON_SCHEMA) -> str:
+    """
+    Invoke a text-only model to extract information from an invoice page's text layer.
+
+    Args:
+        page_text: Text of the page as read from the PDF
+        hints: Values already found in the text by pattern matching
+        json_schema: JSON schema defining the expected response structure
+
+    Returns:
+        str: The extracted data as a JSON string
+    """
+    client = get_openai_client()
+
+    content = f"Extract the invoice information in JSON format from this invoice text:\n\n{page_text[:MAX_PAGE_TEXT_CHARS]}"
+    if hints:
+        content += f"\n\nValues found in the text (use them where they fit):\n{hints}"
+
+    async with text_limiter:
+        response = await client.chat.completions.create(
+            model=TEXT_MODEL,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You are a precise invoice data extraction assistant. You will first review the content of the invoice and internally understand it, then you will extract the information exactly according to the specified schema. Copy names, amounts and dates as they appear in the text."
+                },
+                {"role": "user", "content": content}
+            ],
+            functions=[
+                {
+                    "name": "extract_invoice_data",
+                    "description": "Extract structured data from invoice",
+                    "parameters": json_schema
+                }
+            ],
+            function_call={"name": "extract_invoice_data"},
+            max_tokens=1500
+        )
+
+    return response.choices[0].message.function_call.arguments
+
+async def extract_from_text(page_number: int, page_text: str) -> Optional[InvoiceResults]:
+    """
+    Extract one page from its text layer, or return None to send it to vision.
+
+    The result is checked against the supplier, totals, dates and currency that
+    pattern matching finds in the same text, and the page is escalated if the
+    supplier or total fail or too many checks do.
+    """
+    anchors = find_anchors(page_text)
+    try:
+        result = json.loads(await invoke_text_llm(page_text, describe_anchors(anchors)))
+        invoice = InvoiceResults(**result)
+    except Exception as e:
+        logger.warning(f"Text extraction failed for page {page_number}, escalating to vision: {str(e)}")
+        return None
+
+    confidence, failed = check_extraction(result, anchors, page_text)
+    if not is_confident(confidence, failed):
+        logger.info(f"Page {page_number}: text extraction unsure of {', '.join(failed)}, escalating to vision")
+        return None
+    return invoice
+
+async def extract_with_vision(
+    pdf_path: str,
+    page_numbers: Optional[List[int]] = None
+) -> Dict[int, Optional[InvoiceResults]]:
+    """
+    Extract pages of a PDF with OpenAI's vision model, keyed by page number.
+
+    Pages are rendered one at a time and sent to the model as they are ready,
+    within the shared vision limits. With DEDUP_IDENTICAL_PAGES, pages whose
+    rendering is byte-identical to an earlier one are skipped.
+    """
+    pending = asyncio.Semaphore(MAX_PENDING_PAGES)
+    seen_hashes: Set[str] = set()
+    tasks = {}
+
+    async def extract_page(page_number: int, jpeg: bytes) -> Optional[InvoiceResults]:
+        try:
+            result = await invoke_llm(base64.b64encode(jpeg).decode('utf-8'))
+            return InvoiceResults(**json.loads(result))
+        except Exception as e:
+            logger.error(f"Error processing page {page_number}: {str(e)}")
+            return None
+        finally:
+            pending.release()
+
+    try:
+        async for page_number, jpeg, page_hash in iter_page_images(pdf_path, page_numbers):
+            if DEDUP_IDENTICAL_PAGES:
+                if page_hash in seen_hashes:
+                    logger.info(f"Skipping page {page_number}: identical to an earlier page")
+                    continue
+                seen_hashes.add(page_hash)
+
+            # Wait for a slot before rendering further ahead of the model
+            await pending.acquire()
+            tasks[page_number] = asyncio.create_task(extract_page(page_number, jpeg))
+
+        results = await asyncio.gather(*tasks.values())
+        return dict(zip(tasks, results))
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+async def extract_invoice_data(pdf_path: str) -> List[Tuple[int, InvoiceResults]]:
+    """
+    Extract information from all pages of a PDF invoice.
+
+    Pages with a text layer are extracted from their text by a text-only model
+    and checked against the totals and dates found in it. Scanned pages, and
+    text pages whose extraction fails the check, go to the vision model. Pages
+    with the same text as an earlier page are skipped.
+
+    Returns (page number, invoice) pairs, in page order, for the pages that
+    extracted successfully.
+    """
+
+    logger.info(f"Starting to process PDF: {pdf_path}")
+
+    try:
+        texts = await asyncio.to_thread(read_text_layer, pdf_path)
+        text_pages: Dict[int, str] = {}
+        scanned_pages: List[int] = []
+        seen_texts = set()
+        for page_number, text in enumerate(texts, start=1):
+            if not has_text_layer(text):
+                scanned_pages.append(page_number)
+                continue
+            normalized = " ".join(text.split())
+            if normalized in seen_texts:
+                logger.info(f"Skipping page {page_number}: same text as an earlier page")
+                continue
+            seen_texts.add(normalized)
+            text_pages[page_number] = text
+
+        text_extraction = asyncio.gather(*(extract_from_text(n, text) for n, text in text_pages.items()))
+        if texts and not scanned_pages:
+            text_results, results = await text_extraction, {}
+        else:
+            # No text layer at all means every page is rendered
+            text_results, results = await asyncio.gather(
+                text_extraction,
+                extract_with_vision(pdf_path, scanned_pages if texts else None)
+            )
+        from_text = {n: result for n, result in zip(text_pages, text_results) if result is not None}
+        escalated = [n for n in text_pages if n not in from_text]
+        if escalated:
+            # Already distinct by text, so never skipped as duplicates
+            results.update(await extract_with_vision(pdf_path, escalated))
+        results.update(from_text)
+
+        extracted = [(n, results[n]) for n in sorted(results) if results[n] is not None]
+        logger.info(
+            f"Extracted {len(extracted)}/{len(results)} unique pages of {pdf_path}: "
+            f"{len(from_text)} from text, {len(extracted) - len(from_text)} with vision "
+            f"({len(escalated)} escalated from text)"
+        )
+        return extracted
+
+    except Exception as e:
+        logger.error(f"Error processing PDF {pdf_path}: {str(e)}")
+        raise
+
+""" SAVING INVOICES """
+
+# Files extracted at once; their pages share the model limits above
+FILE_WORKERS = int(os.getenv("INVOICE_FILE_WORKERS", "4"))
+INSERT_BATCH_SIZE = int(os.getenv("INVOICE_INSERT_BATCH_SIZE", "100"))
+# A partial batch is written once no file has finished for this long
+INSERT_FLUSH_SECONDS = 2.0
+# Failed files are retried by later runs until they have failed this many times
+MAX_FILE_ATTEMPTS = int(os.getenv("INVOICE_MAX_FILE_ATTEMPTS", "3"))
+STATUS_LOOKUP_BATCH_SIZE = 200
+# Per-file ingestion status (sql/invoice_ingestion_files.sql)
+INGESTION_STATUS_TABLE = "invoice_ingestion_files"
+DEFAULT_CLIENT_ID = os.getenv("INVOICE_CLIENT_ID", "b917c3db-759c-4e8f-80b6-9131298e0f37")
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def invoice_id_for(client_id: str, file_hash: str, page_number: int) -> str:
+    """
+    Stable id of the invoice on a page of a file for a client, so re-running a
+    file overwrites rather than duplicates (even when a different page fails
+    this time), and clients ingesting the same attachment get separate rows.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"invoice:{client_id}:{file_hash}:page:{page_number}"))
+
+def build_invoice_record(
+    invoice_data: InvoiceResults,
+    client_id: str = DEFAULT_CLIENT_ID,
+    invoice_id: Optional[str] = None,
+    source_file: str = "email"
+) -> dict:
+    return {
+        "id": invoice_id or str(uuid.uuid4()),
+        "client_id": client_id,
+        "results": invoice_data.model_dump(),
+        "status": "processed",
+        "source_file": source_file
+    }
+
+async def save_invoices(invoice_records: List[dict]) -> List[str]:
+    """Upsert invoice records in one request and return their ids."""
+    if not invoice_records:
+        return []
+    supabase = await get_supabase()
+    await supabase.table("invoices").upsert(invoice_records).execute()
+    logger.info(f"Saved {len(invoice_records)} invoices to Supabase")
+    return [record["id"] for record in invoice_records]
+
 async def save_to_supabase(invoice_data: InvoiceResults, pdf_path: str) -> str:
     """Save the extracted invoice data to Supabase."""
     
     logger.info("Preparing to save invoice data to Supabase")
     
-    # Initialize Supabase client
-    supabase = await get_supabase()
-    
-    # Prepare invoice record
-    invoice_record = {
-        "id": str(uuid.uuid4()),
-        "client_id": "b917c3db-759c-4e8f-80b6-9131298e0f37", 
-        "results": invoice_data.model_dump(),
-        "status": "processed",
-        "source_file": "email"
-    }
+    invoice_record = build_invoice_record(invoice_data)
     
     try:
-        # Insert into Supabase
-        response = supabase.table("invoices").insert(invoice_record).execute()
+        await save_invoices([invoice_record])
         logger.info(f"Successfully saved invoice to Supabase with ID: {invoice_record['id']}")
         return invoice_record['id']
     except Exception as e:
         logger.error(f"Failed to save invoice to Supabase: {str(e)}")
         raise
 
-async def process_image_batch(images_batch, json_schema):
-    """Process a batch of images concurrently"""
-    tasks = []
-    for img in images_batch:
-        # Convert image to base64
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
-        base64_image = base64.b64encode(img_byte_arr).decode('utf-8')
-        
-        # Create task for each image
-        tasks.append(invoke_llm(base64_image, json_schema))
-    
-    # Run all tasks concurrently and return results
-    return await asyncio.gather(*tasks, return_exceptions=True)
+async def load_file_statuses(file_hashes: List[str], client_id: str) -> Dict[str, dict]:
+    """Status rows of files ingested by earlier runs, keyed by file hash."""
+    supabase = await get_supabase()
+    statuses = {}
+    for start in range(0, len(file_hashes), STATUS_LOOKUP_BATCH_SIZE):
+        batch = file_hashes[start:start + STATUS_LOOKUP_BATCH_SIZE]
+        response = await supabase.table(INGESTION_STATUS_TABLE)\
+            .select("file_hash, status, attempts")\
+            .eq("client_id", client_id)\
+            .in_("file_hash", batch)\
+            .execute()
+        statuses.update({row["file_hash"]: row for row in response.data})
+    return statuses
 
-async def extract_invoice_data(pdf_path: str) -> List[InvoiceResults]:
-    """Extract information from all pages of a PDF invoice using OpenAI's vision model."""
-    
-    logger.info(f"Starting to process PDF: {pdf_path}")
-    
-    try:
-        # Convert PDF to images
-        logger.debug(f"Converting PDF to images: {pdf_path}")
-        images = pdf2image.convert_from_path(pdf_path)
-        logger.info(f"Successfully converted PDF to {len(images)} images")
-        
-        # Process images in batches of 10
-        BATCH_SIZE = 10
-        results = []
-        
-        for i in range(0, len(images), BATCH_SIZE):
-            batch = images[i:i + BATCH_SIZE]
-            logger.info(f"Processing batch {i//BATCH_SIZE + 1} of {(len(images) + BATCH_SIZE - 1)//BATCH_SIZE}")
-            
-            # Define the JSON schema
-            json_schema = {
-                "type": "object",
-                "properties": {
-                    "invoice_from": {
-                        "type": "object",
-                        "properties": {
-                            "name": {"type": "string"},
-                            "address": {"type": "string"},
-                            "tax_id": {"type": "string"},
-                            # Additional optional fields
-                            "email": {"type": "string"},
-                            "phone": {"type": "string"},
-                            "website": {"type": "string"},
-                            "registration_number": {"type": "string"},
-                            "vat_number": {"type": "string"}
-                        },
-                        "required": ["name", "address"]  # Only these are required
-                    },
-                    "invoice_to": {
-                        "type": "object",
-                        "properties": {
-                            "name": {"type": "string"},
-                            "address": {"type": "string"},
-                            "tax_id": {"type": "string"},
-                            # Additional optional fields
-                            "email": {"type": "string"},
-                            "phone": {"type": "string"},
-                            "reference": {"type": "string"},
-                            "department": {"type": "string"}
-                        },
-                        "required": ["name", "address"]
-                    },
-                    "date": {
-                        "type": "object",
-                        "properties": {
-                            "issue_date": {"type": "string"},
-                            "due_date": {"type": "string"},
-                            "payment_due_by": {"type": "string"},  # Explicit field for AP tracking
-                            # Additional optional fields
-                            "delivery_date": {"type": "string"},
-                            "service_period_start": {"type": "string"},
-                            "service_period_end": {"type": "string"},
-                            "payment_status": {  # Additional metadata for AP
-                                "type": "string",
-                                "enum": ["pending", "overdue", "paid", "partially_paid"]
-                            },
-                        },
-                        "required": ["issue_date"]
-                    },
-                    "amount": {
-                        "type": "object",
-                        "properties": {
-                            "subtotal": {"type": "string"},
-                            "tax": {
-                                "type": "object",
-                                "properties": {
-                                    "rate": {"type": "string"},
-                                    "amount": {"type": "string"}
-                                }
-                            },
-                            "shipping": {"type": "string"},
-                            "discounts": {"type": "string"},
-                            "total": {"type": "string"},
-                            "currency": {"type": "string"}
-                        }
-                    },
-                    "line_items": {
-                        "type": "object",
-                        "properties": {
-                            "items": {
-                                "type": "array",
-                                "items": {
-                                    "type": "object",
-                                    "properties": {
-                                        "description": {"type": "string"},
-                                        "quantity": {"type": "number"},
-                                        "unit_price": {"type": "string"},
-                                        "vat_rate": {"type": "string"},
-                                        "total": {"type": "string"},
-                                        # Additional optional fields
-                                        "sku": {"type": "string"},
-                                        "unit": {"type": "string"},
-                                        "discount": {"type": "string"},
-                                        "category": {"type": "string"}
-                                    },
-                                    "required": ["description", "quantity", "total"]
-                                }
-                            }
-                        }
-                    },
-                    "payment_terms": {"type": "string"},
-                    "notes": {"type": "string"},
-                    "ai_description": {"type": "string"}
-                },
-                "required": ["invoice_from", "invoice_to", "date", "amount", "line_items", "ai_description"]
-            }
-            
-            # Process batch
-            batch_results = await process_image_batch(batch, json_schema)
-            
-            # Parse results
-            for result in batch_results:
-                if isinstance(result, Exception):
-                    logger.error(f"Error processing page: {str(result)}")
-                    continue
+async def save_file_statuses(status_rows: List[dict]) -> None:
+    supabase = await get_supabase()
+    await supabase.table(INGESTION_STATUS_TABLE)\
+        .upsert(status_rows, on_conflict="client_id,file_hash")\
+        .execute()
+
+""" INGESTING A SET OF INVOICES """
+
+def should_ingest(status: Optional[dict], retry_failed: bool = True) -> bool:
+    """Whether a file needs (re)processing given its status row from earlier runs."""
+    if status is None:
+        return True
+    if status["status"] == "failed":
+        return retry_failed and status["attempts"] < MAX_FILE_ATTEMPTS
+    return False
+
+async def write_ingested(results: asyncio.Queue, counts: Dict[str, int], progress: tqdm) -> None:
+    """
+    Save extracted invoices and file statuses in batches until a None arrives.
+
+    A file's status is written after its invoices, so a file is only marked
+    done once its invoices are stored. If a batch insert fails, its files are
+    saved one by one so a single bad file does not fail the rest.
+    """
+    pending: List[Tuple[dict, List[dict]]] = []
+
+    async def flush():
+        records = [record for _, file_records in pending for record in file_records]
+        try:
+            await save_invoices(records)
+        except Exception as e:
+            logger.warning(f"Batch insert of {len(records)} invoices failed, saving files one by one: {str(e)}")
+            for status, file_records in pending:
                 try:
-                    parsed_result = InvoiceResults(**json.loads(result))
-                    results.append(parsed_result)
-                except Exception as e:
-                    logger.error(f"Error parsing result: {str(e)}")
-        
-        return results
-            
-    except Exception as e:
-        logger.error(f"Error processing PDF {pdf_path}")
-        raise
+                    await save_invoices(file_records)
+                except Exception as file_error:
+                    status.update(status="failed", error=f"Failed to save invoices: {str(file_error)}")
+        try:
+            await save_file_statuses([status for status, _ in pending])
+        except Exception as e:
+            # Their invoices have stable ids, so redoing these files next run is harmless
+            logger.error(f"Failed to record status of {len(pending)} files: {str(e)}")
+        for status, _ in pending:
+            counts[status["status"]] += 1
+        progress.update(len(pending))
+        pending.clear()
+
+    while True:
+        try:
+            timeout = INSERT_FLUSH_SECONDS if pending else None
+            item = await asyncio.wait_for(results.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            item = ()
+        if item is None:
+            break
+        if item:
+            pending.append(item)
+        if pending and (not item or sum(len(records) for _, records in pending) >= INSERT_BATCH_SIZE
+                        or len(pending) >= INSERT_BATCH_SIZE):
+            await flush()
+    if pending:
+        await flush()
+
+async def ingest_invoices(
+    pdf_paths: List[Path],
+    client_id: str = DEFAULT_CLIENT_ID,
+    workers: int = FILE_WORKERS,
+    retry_failed: bool = True
+) -> Dict[str, int]:
+    """
+    Extract and save a set of PDF invoices, resuming where earlier runs stopped.
+
+    Files are identified by content hash and skipped if an earlier run for the
+    client finished them (or failed them MAX_FILE_ATTEMPTS times). Up to
+    `workers` files are extracted at once, and their invoices and statuses are
+    written in batches.
+
+    Args:
+        pdf_paths: PDF files, e.g. a folder's contents or saved email attachments
+        client_id: Client the invoices belong to
+        workers: Number of files extracted concurrently
+        retry_failed: Retry files that failed in earlier runs
+
+    Returns:
+        Dict[str, int]: Number of files done, failed and skipped
+    """
+    file_hashes = await asyncio.gather(*(asyncio.to_thread(file_sha256, str(path)) for path in pdf_paths))
+    files: Dict[str, Path] = {}
+    for path, file_hash in zip(pdf_paths, file_hashes):
+        files.setdefault(file_hash, path)
+
+    statuses = await load_file_statuses(list(files), client_id)
+    todo = [(file_hash, path) for file_hash, path in files.items() if should_ingest(statuses.get(file_hash), retry_failed)]
+    counts = {"done": 0, "failed": 0, "skipped": len(pdf_paths) - len(todo)}
+    logger.info(f"Ingesting {len(todo)} of {len(pdf_paths)} files ({counts['skipped']} duplicates or done earlier)")
+    if not todo:
+        return counts
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in todo:
+        queue.put_nowait(item)
+    results: asyncio.Queue = asyncio.Queue(workers * 2)
+
+    async def file_worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            file_hash, path = item
+            status = {
+                "client_id": client_id,
+                "file_hash": file_hash,
+                "file_name": path.name,
+                "attempts": (statuses.get(file_hash) or {}).get("attempts", 0) + 1,
+                "invoice_count": 0,
+                "invoice_ids": [],
+                "error": None,
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            }
+            records = []
+            try:
+                invoices = await extract_invoice_data(str(path))
+                records = [
+                    build_invoice_record(invoice, client_id, invoice_id_for(client_id, file_hash, page_number))
+                    for page_number, invoice in invoices
+                ]
+                if records:
+                    status.update(
+                        status="done",
+                        invoice_count=len(records),
+                        invoice_ids=[record["id"] for record in records]
+                    )
+                else:
+                    status.update(status="failed", error="No invoice data extracted")
+            except Exception as e:
+                logger.error(f"Error processing {path.name}: {str(e)}")
+                status.update(status="failed", error=str(e))
+            await results.put((status, records))
+
+    with tqdm(total=len(todo), desc="Processing PDFs") as progress:
+        writer = asyncio.create_task(write_ingested(results, counts, progress))
+        extractors = [asyncio.create_task(file_worker()) for _ in range(min(workers, len(todo)))]
+        try:
+            for _ in extractors:
+                queue.put_nowait(None)
+            await asyncio.gather(*extractors)
+            await results.put(None)
+            await writer
+        finally:
+            for task in [*extractors, writer]:
+                task.cancel()
+
+    return counts
 
 async def main():
-    """Process invoices from the invoices folder, starting after the first three."""
+    """Ingest the PDF invoices in a folder, skipping files finished by earlier runs."""
+    parser = argparse.ArgumentParser(description="Extract and save PDF invoices")
+    parser.add_argument("folder", nargs="?", default="invoices", help="Folder of PDF invoices")
+    parser.add_argument("--client-id", default=DEFAULT_CLIENT_ID)
+    parser.add_argument("--workers", type=int, default=FILE_WORKERS, help="Files extracted concurrently")
+    parser.add_argument("--no-retry-failed", action="store_true", help="Skip files that failed in earlier runs")
+    args = parser.parse_args()
     
     logger.info("Starting invoice processing")
     
-    # Get the path to the invoices folder
-    invoice_folder = Path("invoices")
+    invoice_folder = Path(args.folder)
     
     if not invoice_folder.exists():
         logger.error("Invoices folder not found")
         raise FileNotFoundError("Invoices folder not found")
     
-    # Get list of PDF files, starting after the first three
-    pdf_files = sorted(list(invoice_folder.glob("*.pdf")))
-    start_index = 3  # Skip the first three files
-    pdf_files = pdf_files[start_index:]
-    
-    total_pdfs = len(pdf_files)
-    logger.info(f"Found {total_pdfs} PDF files to process")
+    pdf_files = sorted(invoice_folder.glob("*.pdf"))
+    logger.info(f"Found {len(pdf_files)} PDF files in {invoice_folder}")
     
     if not pdf_files:
-        logger.warning("No PDF files found to process after the first three")
+        logger.warning("No PDF files found to process")
         return
     
-    processed_invoices = []
-    
-    # Create progress bar
-    with tqdm(total=total_pdfs, desc="Processing PDFs") as pbar:
-        # Process each PDF file
-        for pdf_file in pdf_files:
-            try:
-                logger.info(f"Processing file: {pdf_file.name}")
-                invoice_data_list = await extract_invoice_data(str(pdf_file))
-                
-                # Save each page result to Supabase
-                for invoice_data in invoice_data_list:
-                    invoice_id = await save_to_supabase(invoice_data, str(pdf_file))
-                    processed_invoices.append((pdf_file.name, invoice_data, invoice_id))
-                
-                logger.info(f"Successfully processed: {pdf_file.name}")
-            except Exception as e:
-                logger.error(f"Error processing {pdf_file.name}: {str(e)}")
-            finally:
-                pbar.update(1)
+    try:
+        counts = await ingest_invoices(
+            pdf_files,
+            client_id=args.client_id,
+            workers=args.workers,
+            retry_failed=not args.no_retry_failed
+        )
+    finally:
+        await close_connections()
     
-    # Output results with detailed summaries
-    logger.info(f"\nProcessed {len(processed_invoices)} pages successfully")
     print("\n=== Invoice Processing Results ===")
-    for filename, invoice, invoice_id in processed_invoices:
-        print(f"File: {filename}")
-        print(f"Invoice ID: {invoice_id}")
-        print(f"From: {invoice.invoice_from.get('name', 'N/A')}")
-        print(f"Amount: {invoice.amount.get('total', 'N/A')} {invoice.amount.get('currency', '')}")
-        print("\nAI Description:")
-        print(invoice.ai_description)
-        print("-" * 50)
+    print(f"Done: {counts['done']}")
+    print(f"Failed: {counts['failed']}")
+    print(f"Skipped: {counts['skipped']}")
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,182 @@
+"""
+Text-layer parsing for invoice PDFs.
+
+Machine-generated invoices carry their content as text, which can be read
+directly instead of rendered and sent to a vision model. This module reads
+the text layer, finds deterministic anchors (totals, amounts, dates, currency,
+invoice number) with regular expressions, and checks an extraction against
+them so doubtful pages can be escalated to vision.
+"""
+
+import logging
+import re
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from rapidfuzz import fuzz
+
+logger = logging.getLogger(__name__)
+
+# Pages with fewer letters and digits than this are treated as scanned
+MIN_TEXT_CHARS = 100
+# Share of checks an extraction must pass to be accepted without vision
+MIN_TEXT_CONFIDENCE = 0.75
+# Fields that escalate the page on their own when they fail their check
+CRITICAL_FIELDS = ("invoice_from.name", "amount.total")
+# Fuzzy match score the extracted supplier name needs against the page text
+MIN_NAME_SCORE = 90
+
+_AMOUNT = re.compile(r"(?<![\d.,])(\d{1,3}(?:[,\s]\d{3})+|\d+)[.](\d{2})(?![\d])")
+_TOTAL = re.compile(
+    r"(?i)\b(?:grand\s+total|total\s+(?:due|payable|amount)|amount\s+(?:due|payable)|balance\s+due|total)\b"
+    r"[^\d\n]{0,40}?(\d{1,3}(?:[,\s]\d{3})+[.]\d{2}|\d+[.]\d{2})"
+)
+_INVOICE_NUMBER = re.compile(r"(?i)\binvoice\s*(?:no\.?|number|num|#)\s*[:#]?\s*([A-Z0-9][A-Z0-9\-/]{2,})")
+_DATES = [
+    re.compile(r"\b\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}\b"),
+    re.compile(r"\b\d{4}-\d{2}-\d{2}\b"),
+    re.compile(
+        r"(?i)\b\d{1,2}(?:st|nd|rd|th)?\s+(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?,?\s+\d{4}\b"
+    ),
+    re.compile(
+        r"(?i)\b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?\s+\d{1,2}(?:st|nd|rd|th)?,?\s+\d{4}\b"
+    ),
+]
+_CURRENCY_SYMBOLS = {"£": "GBP", "$": "USD", "€": "EUR"}
+_CURRENCY_CODES = re.compile(r"\b(GBP|USD|EUR|CAD|AUD|CHF|SEK|NOK|DKK|PLN|JPY)\b")
+
+
+class InvoiceAnchors(NamedTuple):
+    totals: List[Decimal]
+    amounts: Set[Decimal]
+    dates: List[str]
+    currency: Optional[str]
+    invoice_number: Optional[str]
+
+
+def read_text_layer(pdf_path: str) -> List[str]:
+    """
+    Text of every page, in order.
+
+    Returns an empty list when the PDF cannot be read as text (no pypdf,
+    encrypted or malformed files), so the caller falls back to vision.
+    """
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        logger.warning("pypdf is not installed; invoice pages will all go to the vision model")
+        return []
+    try:
+        reader = PdfReader(pdf_path)
+        return [page.extract_text() or "" for page in reader.pages]
+    except Exception as e:
+        logger.warning(f"Could not read the text layer of {pdf_path}: {str(e)}")
+        return []
+
+
+def has_text_layer(text: str) -> bool:
+    return sum(ch.isalnum() for ch in text) >= MIN_TEXT_CHARS
+
+
+def parse_amount(value: Any) -> Optional[Decimal]:
+    """Decimal from strings like '£1,234.50', '1 234.50' or '1234.5 GBP'."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        return Decimal(str(value))
+    cleaned = re.sub(r"[^\d.\-]", "", str(value).replace(",", ""))
+    try:
+        return Decimal(cleaned) if cleaned not in ("", ".", "-") else None
+    except InvalidOperation:
+        return None
+
+
+def find_anchors(text: str) -> InvoiceAnchors:
+    amounts = {Decimal(re.sub(r"[,\s]", "", whole) + "." + cents) for whole, cents in _AMOUNT.findall(text)}
+    totals = [parse_amount(match) for match in _TOTAL.findall(text)]
+    dates = [match for pattern in _DATES for match in pattern.findall(text)]
+
+    currency = None
+    code = _CURRENCY_CODES.search(text)
+    if code:
+        currency = code.group(1)
+    else:
+        for symbol, iso in _CURRENCY_SYMBOLS.items():
+            if symbol in text:
+                currency = iso
+                break
+
+    number = _INVOICE_NUMBER.search(text)
+    return InvoiceAnchors(
+        totals=[total for total in totals if total is not None],
+        amounts=amounts,
+        dates=dates,
+        currency=currency,
+        invoice_number=number.group(1) if number else None,
+    )
+
+
+def check_extraction(result: Dict[str, Any], anchors: InvoiceAnchors, text: str) -> Tuple[float, List[str]]:
+    """
+    How well an extraction agrees with the page text.
+
+    Checks that the supplier name appears in the text, that the total is an
+    amount printed on the page (the labelled total when there is one), that an
+    issue date was extracted from a page that has dates, and that the currency
+    agrees with the one on the page.
+
+    Args:
+        result (Dict[str, Any]): Extraction following INVOICE_JSON_SCHEMA
+        anchors (InvoiceAnchors): Anchors found in the same page's text
+        text (str): The page text
+
+    Returns:
+        Tuple[float, List[str]]: Share of checks passed, and the fields that failed
+    """
+    failed = []
+    lowered = " ".join(text.lower().split())
+
+    supplier = " ".join(((result.get("invoice_from") or {}).get("name") or "").lower().split())
+    if not supplier or fuzz.partial_ratio(supplier, lowered) < MIN_NAME_SCORE:
+        failed.append("invoice_from.name")
+
+    amount = result.get("amount") or {}
+    total = parse_amount(amount.get("total"))
+    if total is None or (anchors.amounts and total not in anchors.amounts):
+        failed.append("amount.total")
+    elif anchors.totals and total not in anchors.totals:
+        # A labelled total exists and the model picked a different figure
+        failed.append("amount.total")
+
+    if not ((result.get("date") or {}).get("issue_date") or "").strip() or not anchors.dates:
+        failed.append("date.issue_date")
+
+    currency = (amount.get("currency") or "").strip().upper()
+    if anchors.currency and currency and currency not in (anchors.currency, *_symbols_for(anchors.currency)):
+        failed.append("amount.currency")
+
+    checks = 4
+    return (checks - len(failed)) / checks, failed
+
+
+def _symbols_for(iso: str) -> List[str]:
+    return [symbol for symbol, code in _CURRENCY_SYMBOLS.items() if code == iso]
+
+
+def is_confident(confidence: float, failed: List[str]) -> bool:
+    """Whether a text extraction can be kept without asking the vision model."""
+    return confidence >= MIN_TEXT_CONFIDENCE and not any(field in CRITICAL_FIELDS for field in failed)
+
+
+def describe_anchors(anchors: InvoiceAnchors) -> str:
+    """Anchors as hints for the text-only model prompt."""
+    hints = []
+    if anchors.invoice_number:
+        hints.append(f"Invoice number: {anchors.invoice_number}")
+    if anchors.totals:
+        hints.append("Labelled totals: " + ", ".join(str(total) for total in anchors.totals))
+    if anchors.currency:
+        hints.append(f"Currency: {anchors.currency}")
+    if anchors.dates:
+        hints.append("Dates: " + ", ".join(dict.fromkeys(anchors.dates)))
+    return "\n".join(hints)
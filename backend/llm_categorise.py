@@ -3,9 +3,11 @@ import os
 import logging
 from supabase import create_client
 from openai import AsyncOpenAI
-from typing import List, Dict
+from typing import List, Dict, Optional
 from collections import defaultdict
-from brave_search import brave_search
+from brave_search import brave_search, close_search_client
+from entity_context import EntityContextCache
+from rate_limit import TokenBucket
 import json
 
 # Configure logging
@@ -20,6 +22,28 @@ async_openai_client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
 BATCH_SIZE = 10
 
+# Provider quotas; throughput is bounded by these rather than by fixed sleeps.
+# Brave's (BRAVE_REQUESTS_PER_SECOND) is enforced by the shared search client.
+OPENAI_REQUESTS_PER_MINUTE = float(os.environ.get("OPENAI_REQUESTS_PER_MINUTE", "300"))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "8"))
+
+# Entities looked up at once; most are cache hits that never reach Brave
+CONTEXT_WORKERS = 4
+# Bounded queues between stages, so a slow stage holds back the one feeding it
+STAGE_QUEUE_SIZE = 50
+# Categorised rows are written in batches, or after this long without a full batch
+WRITE_BATCH_SIZE = 100
+WRITE_FLUSH_SECONDS = 2.0
+
+UNKNOWN_ENTITY = "UNKNOWN_ENTITY"
+UNKNOWN_ENTITY_CONTEXT = "No entity information available for this transaction."
+
+openai_limiter = TokenBucket(
+    OPENAI_REQUESTS_PER_MINUTE / 60,
+    capacity=OPENAI_MAX_CONCURRENCY,
+    max_concurrency=OPENAI_MAX_CONCURRENCY
+)
+
 def init_supabase():
     """Initialize Supabase client with error checking"""
     url = os.environ.get("SUPABASE_URL")
@@ -38,35 +62,38 @@ except Exception as e:
     logger.error(f"Failed to initialize Supabase client: {str(e)}")
     raise
 
+# Context about counterparties, shared across users and runs
+entity_cache = EntityContextCache(supabase)
+
 """
 AFTER RUNNING THIS, then run CoA assignment. 
 sun simi search for transactions of similar categories 
 """
 
-async def get_entity_context(entity_name: str) -> str:
-    """Get additional context about an entity using Brave Search."""
-    logger.info(f"Fetching context for entity: {entity_name}")
+async def search_entity(entity_name: str) -> Optional[str]:
+    """Search Brave for an entity; None when the search failed rather than found nothing."""
     try:
-        # Add delay to respect rate limits
-        await asyncio.sleep(1)
         search_results = await brave_search(entity_name, count=3)
         if search_results:
             logger.info(f"Successfully retrieved context for {entity_name}")
-            return search_results
         else:
             logger.warning(f"Empty search results for {entity_name}")
-            return ""
+        return search_results
     except Exception as e:
         logger.error(f"Brave Search error for {entity_name}: {str(e)}")
         if "RATE_LIMITED" in str(e):
             logger.error("Hit Brave Search rate limit - waiting before retry")
             await asyncio.sleep(2)  # Wait longer on rate limit
             try:
-                search_results = await brave_search(entity_name, count=3)
-                return search_results
+                return await brave_search(entity_name, count=3)
             except Exception as retry_e:
                 logger.error(f"Retry failed: {str(retry_e)}")
-        return ""
+        return None
+
+async def get_entity_context(entity_name: str) -> str:
+    """Get additional context about an entity, from the shared cache or Brave Search."""
+    logger.info(f"Fetching context for entity: {entity_name}")
+    return await entity_cache.get_or_fetch(entity_name, search_entity)
 
 async def get_uk_gaap_category(transactions: List[Dict], entity_context: str) -> List[Dict]:
     """Get UK GAAP categories for a batch of transactions from the same entity."""
@@ -196,41 +223,81 @@ Reasoning: {tx['category']['reasoning']}
         logger.error(f"OpenAI API error: {str(e)}")
         return []
 
-async def process_entity_transactions(entity: str, transactions: List[Dict]):
-    """Process all transactions for a single entity in batches."""
-    logger.info(f"\n=== Processing transactions for entity: {entity} ===")
-    logger.info(f"Total transactions: {len(transactions)}")
-    
-    entity_context = await get_entity_context(entity)
-    if not entity_context:
-        logger.warning(f"No context found for entity {entity}, proceeding with empty context")
-    else:
-        logger.info(f"Entity context: {entity_context[:200]}...")  # Show first 200 chars of context
-    
-    for i in range(0, len(transactions), BATCH_SIZE):
-        batch = transactions[i:i + BATCH_SIZE]
-        logger.info(f"\nProcessing batch {i//BATCH_SIZE + 1} for {entity} ({len(batch)} transactions)")
-        
-        updates = await get_uk_gaap_category(batch, entity_context)
-        
+async def context_worker(entities: asyncio.Queue, batches: asyncio.Queue, failed: set):
+    """Stage 1: look up each entity's context and queue its transactions in LLM-sized batches."""
+    while (item := await entities.get()) is not None:
+        entity, transactions = item
+        try:
+            if entity == UNKNOWN_ENTITY:
+                entity_context = UNKNOWN_ENTITY_CONTEXT
+            else:
+                entity_context = await get_entity_context(entity)
+                if not entity_context:
+                    logger.warning(f"No context found for entity {entity}, proceeding with empty context")
+        except Exception as e:
+            logger.error(f"Failed to fetch context for entity {entity}: {str(e)}")
+            failed.add(entity)
+            continue
+
+        logger.info(f"Queueing {len(transactions)} transactions for {entity}")
+        for i in range(0, len(transactions), BATCH_SIZE):
+            await batches.put((entity, transactions[i:i + BATCH_SIZE], entity_context))
+
+async def categorise_worker(batches: asyncio.Queue, writes: asyncio.Queue, failed: set):
+    """Stage 2: categorise batches within the OpenAI quota and queue the results for writing."""
+    while (item := await batches.get()) is not None:
+        entity, batch, entity_context = item
+        try:
+            async with openai_limiter:
+                updates = await get_uk_gaap_category(batch, entity_context)
+        except Exception as e:
+            logger.error(f"Failed to categorise batch for entity {entity}: {str(e)}")
+            failed.add(entity)
+            continue
+
         if updates:
-            logger.info(f"Found {len(updates)} valid categories to update")
-            await update_transactions(updates)
+            logger.info(f"Found {len(updates)} valid categories to update for {entity}")
+            await writes.put(updates)
         else:
-            logger.warning(f"No valid categories found for batch")
-            print("updates", updates)
-        
-        await asyncio.sleep(1)
+            logger.warning(f"No valid categories found for batch of {entity}")
+
+async def write_worker(writes: asyncio.Queue) -> int:
+    """Stage 3: write categorised rows in batches; returns the number of rows updated."""
+    pending: List[Dict] = []
+    updated = 0
+    while True:
+        try:
+            # Flush a partial batch if the categorisers go quiet
+            timeout = WRITE_FLUSH_SECONDS if pending else None
+            updates = await asyncio.wait_for(writes.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            updates = []
+        if updates is None:
+            break
+        pending.extend(updates)
+        if pending and (len(pending) >= WRITE_BATCH_SIZE or not updates):
+            updated += await update_transactions(pending)
+            pending = []
+    if pending:
+        updated += await update_transactions(pending)
+    return updated
 
 async def process_transactions():
-    """Main processing function that groups transactions by entity."""
+    """
+    Main processing function that groups transactions by entity.
+
+    Entities flow through three concurrent stages connected by bounded queues:
+    context lookup (Brave quota), categorisation (OpenAI quota) and batched
+    writes, so run time is set by the provider quotas rather than the sum of
+    every request's latency.
+    """
     logger.info("Starting transaction processing")
     
     try:
         # Fetch unprocessed transactions
         logger.info("Fetching unprocessed transactions from database")
         response = supabase.table("gocardless_transactions")\
-            .select("*")\
+            .select("id, amount, remittance_info, creditor_name, debtor_name")\
             .is_("llm_category", "null") \
             .execute()
         
@@ -242,11 +309,10 @@ async def process_transactions():
         
         # Group transactions by entity (including null entities)
         entity_transactions = defaultdict(list)
-        processed_entities = set()
         
         for tx in response.data:
-            # Get entity name, use "UNKNOWN_ENTITY" for null cases
-            entity = tx.get('creditor_name') or tx.get('debtor_name') or "UNKNOWN_ENTITY"
+            # Get entity name, use UNKNOWN_ENTITY for null cases
+            entity = tx.get('creditor_name') or tx.get('debtor_name') or UNKNOWN_ENTITY
             
             tx_data = {
                 'id': tx['id'],
@@ -257,83 +323,106 @@ async def process_transactions():
             entity_transactions[entity].append(tx_data)
 
         logger.info(f"Grouped {len(response.data)} transactions into {len(entity_transactions)} entities")
-        logger.info(f"Number of transactions with unknown entity: {len(entity_transactions.get('UNKNOWN_ENTITY', []))}")
-        
-        # Process each entity's transactions
-        for entity, txs in entity_transactions.items():
-            try:
-                logger.info(f"\n=== Processing entity: {entity} ===")
-                logger.info(f"Processing {len(txs)} transactions for this entity")
-                
-                # Skip internet search for unknown entities
-                if entity == "UNKNOWN_ENTITY":
-                    logger.info("Processing transactions with no entity information")
-                    entity_context = "No entity information available for this transaction."
-                    
-                    # Process transactions directly in batches
-                    for i in range(0, len(txs), BATCH_SIZE):
-                        batch = txs[i:i + BATCH_SIZE]
-                        updates = await get_uk_gaap_category(batch, entity_context)
-                        if updates:
-                            await update_transactions(updates)
-                else:
-                    await process_entity_transactions(entity, txs)
-                
-                processed_entities.add(entity)
-                
-            except Exception as e:
-                logger.error(f"Failed to process entity {entity}: {str(e)}")
-                continue
-            
-            await asyncio.sleep(2)  # Rate limiting between entities
+        logger.info(f"Number of transactions with unknown entity: {len(entity_transactions.get(UNKNOWN_ENTITY, []))}")
+        await entity_cache.prefetch(entity for entity in entity_transactions if entity != UNKNOWN_ENTITY)
+
+        entities = asyncio.Queue(STAGE_QUEUE_SIZE)
+        batches = asyncio.Queue(STAGE_QUEUE_SIZE)
+        writes = asyncio.Queue(STAGE_QUEUE_SIZE)
+        failed_entities = set()
+
+        writer = asyncio.create_task(write_worker(writes))
+        categorisers = [
+            asyncio.create_task(categorise_worker(batches, writes, failed_entities))
+            for _ in range(OPENAI_MAX_CONCURRENCY)
+        ]
+        searchers = [
+            asyncio.create_task(context_worker(entities, batches, failed_entities))
+            for _ in range(CONTEXT_WORKERS)
+        ]
+        try:
+            for item in entity_transactions.items():
+                await entities.put(item)
+            # Each stage is closed with one None per worker once the stage before it is done
+            for _ in searchers:
+                await entities.put(None)
+            await asyncio.gather(*searchers)
+            for _ in categorisers:
+                await batches.put(None)
+            await asyncio.gather(*categorisers)
+            await writes.put(None)
+            updated = await writer
+        finally:
+            for task in [*searchers, *categorisers, writer]:
+                task.cancel()
         
         # Summary logging
         logger.info("\n=== Processing Summary ===")
-        logger.info(f"Total entities processed: {len(processed_entities)}/{len(entity_transactions)}")
-        if len(processed_entities) < len(entity_transactions):
-            failed_entities = set(entity_transactions.keys()) - processed_entities
+        logger.info(f"Total entities processed: {len(entity_transactions) - len(failed_entities)}/{len(entity_transactions)}")
+        logger.info(f"Transactions categorised: {updated}/{len(response.data)}")
+        logger.info(f"Entity context cache: {entity_cache.hits} hits, {entity_cache.misses} searches")
+        if failed_entities:
             logger.warning(f"Failed to process entities: {failed_entities}")
 
     except Exception as e:
         logger.error(f"Error in main process: {str(e)}")
         raise
+    finally:
+        await close_search_client()
+
+# Cleared when set_llm_categories (sql/set_llm_categories.sql) is not installed
+_bulk_update_available = True
 
-async def update_transactions(transaction_updates: List[Dict]):
-    """Update transaction categories in the database with JSON data."""
-    for update in transaction_updates:
+def _update_one(update: Dict) -> bool:
+    response = supabase.table("gocardless_transactions")\
+        .update({"llm_category": update['llm_category']})\
+        .eq("id", update['id'])\
+        .execute()
+    if not response.data:
+        logger.error(f"Transaction {update['id']} not found in database")
+        return False
+    return True
+
+async def update_transactions(transaction_updates: List[Dict]) -> int:
+    """
+    Update transaction categories in the database with JSON data.
+
+    Writes the whole batch with one set_llm_categories call, falling back to
+    one update per row when the function is not installed.
+
+    Returns:
+        int: Number of transactions updated
+    """
+    global _bulk_update_available
+    # Later results for the same transaction win
+    latest = {update['id']: update['llm_category'] for update in transaction_updates}
+    rows = [{"id": tx_id, "llm_category": category} for tx_id, category in latest.items()]
+    logger.info(f"Writing categories for {len(rows)} transactions")
+
+    if _bulk_update_available:
         try:
-            logger.info(f"""
-            Attempting to update transaction in Supabase:
-            - ID: {update['id']}
-            - Category Data: {json.dumps(update['llm_category'], indent=2)}""")  # JSON.dumps just for logging
-                        
-            # First verify the transaction exists
-            response = supabase.table("gocardless_transactions")\
-                .select("id")\
-                .eq("id", update['id'])\
-                .execute()
-            
-            if not response.data:
-                logger.error(f"Transaction {update['id']} not found in database")
-                continue
-                
-            # Perform the update - passing the JSON object directly
-            update_response = supabase.table("gocardless_transactions")\
-                .update({"llm_category": update['llm_category']})\
-                .eq("id", update['id'])\
-                .execute()
-            
-            if not update_response.data:
-                logger.error(f"Update failed for transaction {update['id']}: No data returned")
-                logger.error(f"Update response: {update_response}")
-                continue
-                
-            logger.info(f"Successfully updated transaction {update['id']}")
-            logger.debug(f"Update response: {update_response.data}")
-            
+            response = await asyncio.to_thread(
+                lambda: supabase.rpc("set_llm_categories", {"updates": rows}).execute()
+            )
+            updated = len(response.data or [])
+            if updated < len(rows):
+                logger.error(f"{len(rows) - updated} transactions not found in database")
+            logger.info(f"Successfully updated {updated} transactions")
+            return updated
+        except Exception as e:
+            logger.warning(f"Bulk category update unavailable, updating rows individually: {str(e)}")
+            _bulk_update_available = False
+
+    async def update_one(row: Dict) -> bool:
+        try:
+            return await asyncio.to_thread(_update_one, row)
         except Exception as e:
-            logger.error(f"Error updating transaction {update['id']}: {str(e)}")
-            logger.error(f"Full error details: {repr(e)}")
+            logger.error(f"Error updating transaction {row['id']}: {str(e)}")
+            return False
+
+    results = await asyncio.gather(*(update_one(row) for row in rows))
+    logger.info(f"Successfully updated {sum(results)} transactions")
+    return sum(results)
 
 if __name__ == "__main__":
     logger.info("Starting script execution")
@@ -0,0 +1,296 @@
+"""
+HTML-to-text extraction and a disk cache of extracted pages.
+
+Parsing uses the fastest installed backend: selectolax (lexbor), then lxml,
+then BeautifulSoup's html.parser. Extracted text is cached on disk by URL with
+the page's ETag/Last-Modified, so repeat fetches within the TTL skip the
+network and later ones revalidate with a conditional request.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Pages are truncated to this many bytes; the rest is never downloaded
+MAX_PAGE_BYTES = int(os.getenv("MAX_PAGE_BYTES", str(2 * 1024 * 1024)))
+READ_CHUNK_BYTES = 64 * 1024
+
+PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "page_content_cache"))
+PAGE_CACHE_TTL_HOURS = float(os.getenv("PAGE_CACHE_TTL_HOURS", "24"))
+# Entries unused for this long are deleted, and the oldest go first once the
+# directory is over the byte budget
+PAGE_CACHE_MAX_AGE_DAYS = float(os.getenv("PAGE_CACHE_MAX_AGE_DAYS", "7"))
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# put() prunes the directory after this many writes
+PRUNE_EVERY_WRITES = 200
+
+# Elements whose text is never content
+SKIPPED_TAGS = ["script", "style", "noscript", "template"]
+
+
+class ExtractedPage(NamedTuple):
+    title: str
+    text: str
+
+
+def clean_text(text: str) -> str:
+    """One phrase per line: strip lines, split on runs of double spaces, drop blanks."""
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return "\n".join(chunk for chunk in chunks if chunk)
+
+
+def _extract_selectolax(html: str) -> ExtractedPage:
+    from selectolax.lexbor import LexborHTMLParser
+
+    tree = LexborHTMLParser(html)
+    title_node = tree.css_first("title")
+    title = title_node.text(strip=True) if title_node is not None else ""
+    tree.strip_tags(SKIPPED_TAGS)
+    text = tree.root.text(separator="\n") if tree.root is not None else ""
+    return ExtractedPage(title, clean_text(text))
+
+
+def _extract_lxml(html: str) -> ExtractedPage:
+    import lxml.html
+
+    # Parsing bytes lets lxml accept pages that carry an XML encoding declaration
+    parser = lxml.html.HTMLParser(encoding="utf-8")
+    doc = lxml.html.document_fromstring(html.encode("utf-8", "replace"), parser=parser)
+    title = (doc.findtext(".//title") or "").strip()
+    for element in list(doc.iter(*SKIPPED_TAGS)):
+        element.drop_tree()
+    return ExtractedPage(title, clean_text("\n".join(doc.itertext())))
+
+
+def _extract_html_parser(html: str) -> ExtractedPage:
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    title = soup.title.get_text(strip=True) if soup.title else ""
+    for element in soup(SKIPPED_TAGS):
+        element.extract()
+    return ExtractedPage(title, clean_text(soup.get_text(separator="\n")))
+
+
+EXTRACTORS: Dict[str, Callable[[str], ExtractedPage]] = {
+    "selectolax": _extract_selectolax,
+    "lxml": _extract_lxml,
+    "html.parser": _extract_html_parser,
+}
+
+_BACKEND_MODULES = {"selectolax": "selectolax.lexbor", "lxml": "lxml.html", "html.parser": "bs4"}
+
+
+def available_backends() -> list:
+    """Installed parser backends, fastest first."""
+    import importlib.util
+
+    backends = []
+    for name, module in _BACKEND_MODULES.items():
+        try:
+            if importlib.util.find_spec(module) is not None:
+                backends.append(name)
+        except ModuleNotFoundError:
+            continue
+    return backends
+
+
+_default_backend: Optional[str] = None
+
+
+def extract_page(html: str, backend: Optional[str] = None) -> ExtractedPage:
+    """
+    Title and visible text of an HTML page.
+
+    Args:
+        html (str): The page markup
+        backend (Optional[str]): Parser to use; defaults to the fastest installed one
+
+    Returns:
+        ExtractedPage: The title and the text, one phrase per line
+    """
+    global _default_backend
+    if backend is None:
+        if _default_backend is None:
+            backends = available_backends()
+            if not backends:
+                raise ImportError("No HTML parser installed; install selectolax, lxml or beautifulsoup4")
+            _default_backend = backends[0]
+            logger.info(f"Extracting page text with {_default_backend}")
+        backend = _default_backend
+    return EXTRACTORS[backend](html)
+
+
+async def read_capped(response, limit: int = MAX_PAGE_BYTES) -> bytes:
+    """
+    Read an aiohttp response body up to limit bytes.
+
+    Stops downloading once the cap is reached instead of buffering the whole
+    body; the connection is then released by the response context.
+    """
+    chunks = []
+    size = 0
+    async for chunk in response.content.iter_chunked(READ_CHUNK_BYTES):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            logger.info(f"Truncated {response.url} at {limit} bytes")
+            break
+    return b"".join(chunks)[:limit]
+
+
+class PageCache:
+    """
+    Extracted page text on disk, one JSON file per URL.
+
+    Entries younger than the TTL are served as is. Older ones keep their
+    validators (ETag, Last-Modified) so the caller can revalidate and, on a
+    304, refresh the entry without downloading or parsing again. prune()
+    bounds the directory by entry age and total size.
+    """
+
+    def __init__(
+        self,
+        directory: str = PAGE_CACHE_DIR,
+        ttl_seconds: float = PAGE_CACHE_TTL_HOURS * 3600,
+        max_age_seconds: float = PAGE_CACHE_MAX_AGE_DAYS * 86400,
+        max_bytes: int = PAGE_CACHE_MAX_BYTES
+    ):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._writes_since_prune = 0
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    def is_fresh(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry.get("fetched_at", 0) < self.ttl_seconds
+
+    def _read(self, url: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(url), encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable page cache entry for {url}: {str(e)}")
+            return None
+        # Guard against hash collisions
+        return entry if entry.get("url") == url else None
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(entry["url"])
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            # Atomic, so concurrent readers never see a partial file
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _prune(self) -> int:
+        now = time.time()
+        entries, stale_temp = [], []
+        try:
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    if not item.is_file():
+                        continue
+                    try:
+                        stat = item.stat()
+                    except FileNotFoundError:
+                        continue
+                    if item.name.endswith(".json"):
+                        entries.append((stat.st_mtime, stat.st_size, item.path))
+                    elif now - stat.st_mtime > self.max_age_seconds:
+                        # Left behind by a write that was interrupted; live ones are young
+                        stale_temp.append(item.path)
+        except FileNotFoundError:
+            return 0
+
+        # Writes and 304 refreshes rewrite the file, so mtime is the last use
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for path in stale_temp:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        for mtime, size, path in entries:
+            if now - mtime <= self.max_age_seconds and total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed
+
+    async def prune(self) -> int:
+        """Delete entries older than max_age_seconds, then the oldest until under max_bytes."""
+        self._writes_since_prune = 0
+        try:
+            removed = await asyncio.to_thread(self._prune)
+        except OSError as e:
+            logger.warning(f"Failed to prune page cache: {str(e)}")
+            return 0
+        if removed:
+            logger.info(f"Pruned {removed} page cache entries")
+        return removed
+
+    async def get(self, url: str) -> Optional[Dict[str, Any]]:
+        """The cached entry (url, title, text, etag, last_modified, fetched_at), fresh or not."""
+        return await asyncio.to_thread(self._read, url)
+
+    async def put(
+        self,
+        url: str,
+        page: ExtractedPage,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None
+    ) -> None:
+        entry = {
+            "url": url,
+            "title": page.title,
+            "text": page.text,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": time.time(),
+        }
+        try:
+            await asyncio.to_thread(self._write, entry)
+        except OSError as e:
+            logger.warning(f"Failed to cache page {url}: {str(e)}")
+            return
+        self._writes_since_prune += 1
+        if self._writes_since_prune >= PRUNE_EVERY_WRITES:
+            await self.prune()
+
+    async def touch(self, entry: Dict[str, Any]) -> None:
+        """Restart an entry's TTL after the server confirmed it is unchanged (304)."""
+        entry["fetched_at"] = time.time()
+        try:
+            await asyncio.to_thread(self._write, entry)
+        except OSError as e:
+            logger.warning(f"Failed to refresh cached page {entry['url']}: {str(e)}")
+
+
+page_cache = PageCache()
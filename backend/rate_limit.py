@@ -0,0 +1,64 @@
+"""Async rate limiting shared by the search and categorisation scripts"""
+
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Token-bucket limiter for an API quota.
+
+    Tokens refill continuously at `rate` per second up to `capacity`, so short
+    bursts up to capacity go through immediately and sustained throughput
+    settles at the quota. Waiters are served in arrival order.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0, max_concurrency: Optional[int] = None):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        # Optionally also cap requests in flight, e.g. for per-connection limits
+        self._semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        # Set by pause(), e.g. from a Retry-After header; everyone waits it out
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        """Wait for a token."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Hold back every caller for `seconds`, e.g. after a 429 with Retry-After."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def __aenter__(self):
+        if self._semaphore is not None:
+            await self._semaphore.acquire()
+        try:
+            await self.acquire()
+        except BaseException:
+            if self._semaphore is not None:
+                self._semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._semaphore is not None:
+            self._semaphore.release()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Script to measure chunking throughput on a synthetic multi-page document.
+
+Compares the decode-per-window baseline against the single-pass chunker in
+app.services.etl.chunking.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services.etl.chunking import (  # noqa: E402
+    PAGE_BREAK,
+    chunk_by_pages,
+    get_encoder,
+    sliding_window_chunking,
+)
+
+WORDS = (
+    "invoice payment account balance transfer supplier customer ledger vat "
+    "director expense revenue £1,250.00 2025-02-07 GBP reference statement "
+    "período café naïve übersicht 請求書"
+).split()
+
+
+def make_document(pages: int, words_per_page: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    return PAGE_BREAK.join(
+        " ".join(rng.choice(WORDS) for _ in range(words_per_page))
+        for _ in range(pages)
+    )
+
+
+def baseline_chunking(text: str, max_window_size: int = 600, overlap: int = 200) -> list:
+    """The previous implementation: decode every window from its token slice."""
+    encoder = get_encoder()
+    tokens = encoder.encode(text)
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        chunks.append(encoder.decode(tokens[start:start + max_window_size]))
+        start += max_window_size - overlap
+    return chunks
+
+
+def timed(label: str, fn, repeat: int) -> None:
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    print(f"{label:<28} {best * 1000:9.2f} ms   {len(result):6d} chunks")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--words-per-page", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    text = make_document(args.pages, args.words_per_page)
+    # Load the encoder up front so the first timing does not include it
+    get_encoder()
+    print(f"Document: {args.pages} pages, {len(text):,} characters\n")
+
+    timed("baseline (decode/window)", lambda: baseline_chunking(text), args.repeat)
+    timed("sliding_window_chunking", lambda: sliding_window_chunking(text), args.repeat)
+    timed("chunk_by_pages", lambda: chunk_by_pages(text.split(PAGE_BREAK)), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
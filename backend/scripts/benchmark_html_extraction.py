@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Script to measure HTML-to-text throughput of each installed parser backend.
+
+Parses a synthetic documentation-style page with every backend available to
+page_content.extract_page and reports the best time and MB/s.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from page_content import available_backends, extract_page  # noqa: E402
+
+WORDS = (
+    "webhook endpoint request response payload signature header token grant "
+    "account message thread calendar event retry timeout verification secret "
+    "café naïve übersicht 請求書"
+).split()
+
+
+def make_page(sections: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+
+    def sentence(n: int) -> str:
+        return " ".join(rng.choice(WORDS) for _ in range(n))
+
+    body = []
+    for i in range(sections):
+        body.append(f"<h2 id='s{i}'>{sentence(4)}</h2>")
+        body.append(f"<p>{sentence(60)} <a href='/docs/{i}'>{sentence(3)}</a> {sentence(40)}</p>")
+        body.append("<ul>" + "".join(f"<li><code>{sentence(2)}</code> {sentence(12)}</li>" for _ in range(5)) + "</ul>")
+        body.append(f"<pre><code>curl -X POST https://api.example.com/v3/{i} -d '{sentence(8)}'</code></pre>")
+        body.append(f"<script>window.dataLayer.push({{section: {i}}});</script>")
+    nav = "".join(f"<a href='/nav/{i}'>{sentence(2)}</a>" for i in range(200))
+    return (
+        "<!DOCTYPE html><html><head><title>API Reference</title>"
+        "<style>body { font-family: sans-serif; }</style></head>"
+        f"<body><nav>{nav}</nav><main>{''.join(body)}</main></body></html>"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sections", type=int, default=400)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    html = make_page(args.sections)
+    size_mb = len(html.encode()) / 1e6
+    print(f"Page: {size_mb:.2f} MB of HTML\n")
+
+    for backend in available_backends():
+        best = float("inf")
+        page = None
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            page = extract_page(html, backend)
+            best = min(best, time.perf_counter() - started)
+        print(f"{backend:<12} {best * 1000:9.2f} ms   {size_mb / best:7.1f} MB/s   {len(page.text):,} chars")
+
+
+if __name__ == "__main__":
+    main()
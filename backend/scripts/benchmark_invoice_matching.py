@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Script to measure invoice-to-transaction matching on synthetic data.
+
+Builds open invoices from a set of suppliers and bank transactions that pay
+most of them, with statement-style counterparty names, small fee
+differences and payment dates around the due date. Mixed in are unrelated
+payments that share an amount. It then times building the InvoiceIndex and
+matching, and reports how many planted payments were recovered.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from app.services.invoice_matcher import InvoiceIndex  # noqa: E402
+
+SUPPLIERS = [
+    "Amazon Web Services EMEA SARL", "Stripe Payments UK Ltd", "Google Cloud EMEA Limited",
+    "WeWork UK Ltd", "Octopus Energy Ltd", "Vodafone Limited", "Adobe Systems Software Ireland",
+    "Slack Technologies Ltd", "Atlassian Pty Ltd", "DigitalOcean LLC", "Zoom Video Communications Inc",
+    "Royal Mail Group Ltd", "British Gas Trading Ltd", "Thames Water Utilities Ltd", "HubSpot Ireland Ltd",
+]
+
+
+def statement_name(rng: random.Random, supplier: str) -> str:
+    """How a supplier tends to appear on a bank statement."""
+    words = supplier.upper().replace(",", "").split()
+    name = " ".join(words[:rng.randint(1, min(3, len(words)))])
+    return rng.choice(["", "DD ", "CARD PAYMENT TO "]) + name + rng.choice(["", f" REF {rng.randint(10**5, 10**6)}"])
+
+
+def make_data(invoices: int, seed: int):
+    rng = random.Random(seed)
+    start = date(2024, 1, 1)
+    invoice_rows, transactions, planted = [], [], {}
+
+    def add_invoice(supplier: str, pence: int, issued: date) -> None:
+        due = issued + timedelta(days=30)
+        invoice_id = f"inv-{len(invoice_rows):06d}"
+        invoice_rows.append({"id": invoice_id, "client_id": "client_benchmark", "results": {
+            "invoice_from": {"name": supplier},
+            "invoice_to": {"name": "Benchmark Trading Ltd"},
+            "date": {"issue_date": issued.strftime("%d/%m/%Y"), "due_date": due.isoformat()},
+            "amount": {"total": f"£{pence / 100:,.2f}", "currency": "GBP"},
+        }})
+        if rng.random() < 0.8:
+            transaction_id = f"tx-{len(transactions):06d}"
+            fee = rng.choice([0, 0, 0, rng.randint(1, 30)])
+            transactions.append({
+                "id": transaction_id,
+                "amount": -(pence + fee) / 100,
+                "currency": "GBP",
+                "booking_date": (due + timedelta(days=rng.randint(-20, 15))).isoformat(),
+                "creditor_name": statement_name(rng, supplier),
+            })
+            planted[transaction_id] = invoice_id
+
+    # Monthly subscriptions: the same supplier and amount every month
+    plans = [(supplier, pence) for supplier in SUPPLIERS for pence in (999, 1999, 4999, 9900, 12000)]
+    for supplier, pence in rng.sample(plans, min(len(plans), invoices // 48)):
+        for month in range(12):
+            add_invoice(supplier, pence, start + timedelta(days=30 * month + rng.randint(0, 3)))
+    while len(invoice_rows) < invoices:
+        add_invoice(rng.choice(SUPPLIERS), rng.randint(500, 500000), start + timedelta(days=rng.randint(0, 360)))
+
+    # Payments to other vendors, some for amounts an invoice also has
+    for _ in range(invoices // 2):
+        pence = rng.choice([999, 1999, 4999, rng.randint(500, 500000)])
+        transactions.append({
+            "id": f"tx-{len(transactions):06d}",
+            "amount": -pence / 100,
+            "currency": "GBP",
+            "booking_date": (start + timedelta(days=rng.randint(0, 400))).isoformat(),
+            "creditor_name": rng.choice(["TESCO STORES 3021", "TFL TRAVEL CHARGE", "PRET A MANGER", "UBER TRIP"]),
+        })
+    rng.shuffle(transactions)
+    return invoice_rows, transactions, planted
+
+
+def best_of(fn, repeat: int):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--invoices", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    invoices, transactions, planted = make_data(args.invoices, args.seed)
+    print(f"{len(invoices)} invoices, {len(transactions)} transactions ({len(planted)} pay an invoice)")
+
+    build_ms, index = best_of(lambda: InvoiceIndex(invoices), args.repeat)
+    match_ms, matches = best_of(lambda: index.match(transactions), args.repeat)
+    correct = sum(planted.get(m["transaction_id"]) == m["invoice_id"] for m in matches)
+    print(f"  build index   {build_ms:8.2f} ms")
+    print(f"  match         {match_ms:8.2f} ms")
+    print(f"  matches       {len(matches):>8}  ({correct} correct, {len(matches) - correct} wrong, "
+          f"{len(planted) - correct} planted payments missed)")
+
+
+if __name__ == "__main__":
+    main()
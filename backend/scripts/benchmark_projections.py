@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Script to measure what column projections save on transaction reads.
+
+Offline, it builds synthetic rows shaped like the select('*') and projected
+responses and times decoding them (json vs orjson) and validating them (one
+model per row vs one TypeAdapter call). With --user-id and the Supabase
+environment set, it also fetches a real page both ways and reports response
+size and latency.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import List
+
+import orjson
+from pydantic import TypeAdapter
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from app.schemas.transactions import TransactionsTable  # noqa: E402
+from app.services.transactions import TRANSACTIONS_SELECT  # noqa: E402
+
+FULL_SELECT = '*, ntropy_transactions!inner(enriched_data)'
+
+VENDORS = ["Amazon Web Services", "Stripe", "Google Workspace", "Tesco", "HMRC", "WeWork"]
+CATEGORIES = ["software", "payments", "groceries", "taxes", "rent"]
+
+
+def make_row(rng: random.Random, index: int, enriched: bool) -> dict:
+    vendor = rng.choice(VENDORS)
+    category = rng.choice(CATEGORIES)
+    row = {field: None for field in TransactionsTable.model_fields}
+    row.update({
+        "id": f"tx-{index:08d}",
+        "booking_date": "2025-02-07T00:00:00+00:00",
+        "created_at": f"2025-02-07T10:{index % 60:02d}:00+00:00",
+        "user_id": "user_benchmark",
+        "creditor_name": vendor,
+        "amount": rng.randint(-500000, 500000),
+        "currency": "GBP",
+        "remittance_info": f"{vendor.upper()} REF {rng.randint(10**8, 10**9)}",
+        "ntropy_enrich": True,
+    })
+    if enriched:
+        # Roughly the shape and size of a stored Ntropy enrichment
+        row["ntropy_transactions"] = [{"enriched_data": {
+            "id": row["id"],
+            "entities": {
+                "counterparty": {"id": f"ent-{vendor}", "name": vendor, "website": "example.com",
+                                 "logo": "https://logos.example.com/" + vendor.replace(" ", "-"),
+                                 "type": "organization"},
+                "intermediaries": [],
+            },
+            "categories": {"general": category, "accounting": category.title()},
+            "location": {"raw_address": None, "structured": None},
+            "recurrence": "one off",
+            "recurrence_group": None,
+            "created_at": row["created_at"],
+        }}]
+    else:
+        row["ntropy_transactions"] = [{"general_category": category}]
+    return row
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def offline(rows: int, repeat: int) -> None:
+    rng = random.Random(0)
+    full = json.dumps([make_row(rng, i, True) for i in range(rows)]).encode()
+    projected = json.dumps([make_row(rng, i, False) for i in range(rows)]).encode()
+    print(f"Synthetic page of {rows} rows")
+    print(f"  select('*') payload     {len(full):>10,} bytes")
+    print(f"  projected payload       {len(projected):>10,} bytes\n")
+
+    for label, payload in (("select('*')", full), ("projected", projected)):
+        print(f"  {label:<12} json.loads    {best_of(lambda: json.loads(payload), repeat):8.2f} ms")
+        print(f"  {label:<12} orjson.loads  {best_of(lambda: orjson.loads(payload), repeat):8.2f} ms")
+
+    data = orjson.loads(projected)
+    adapter = TypeAdapter(List[TransactionsTable])
+    print()
+    print(f"  per-row TransactionsTable(**tx) {best_of(lambda: [TransactionsTable(**tx) for tx in data], repeat):8.2f} ms")
+    print(f"  TypeAdapter.validate_python     {best_of(lambda: adapter.validate_python(data), repeat):8.2f} ms")
+    print(f"  TypeAdapter.validate_json       {best_of(lambda: adapter.validate_json(projected), repeat):8.2f} ms")
+
+
+async def live(user_id: str, rows: int, repeat: int) -> None:
+    from app.core.supabase_client import close_connections, get_supabase
+
+    supabase = await get_supabase()
+    session = supabase.postgrest.session
+    print(f"\nLive page of up to {rows} rows for {user_id}")
+    try:
+        for label, select in (("select('*')", FULL_SELECT), ("projected", TRANSACTIONS_SELECT)):
+            params = {"select": select, "user_id": f"eq.{user_id}", "limit": str(rows)}
+            timings, size = [], 0
+            for _ in range(repeat):
+                started = time.perf_counter()
+                response = await session.get("/gocardless_transactions", params=params)
+                response.raise_for_status()
+                size = len(response.content)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            print(f"  {label:<12} {size:>10,} bytes   median {timings[len(timings) // 2]:8.2f} ms")
+    finally:
+        await close_connections()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--user-id", help="Also benchmark live queries for this user")
+    args = parser.parse_args()
+
+    offline(args.rows, args.repeat)
+    if args.user_id:
+        asyncio.run(live(args.user_id, args.rows, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
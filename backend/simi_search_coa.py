@@ -11,12 +11,23 @@ from itertools import islice
 from dataclasses import dataclass
 from collections import defaultdict
 
-from app.services.etl.vectorise_data import get_embedding, get_voyage_embedding
+from app.services.etl.vectorise_data import get_embedding, get_voyage_embedding, get_voyage_embeddings
+from app.services.coa_index import get_coa_index
+from app.services.hybrid_search import score_margin
 from backend.app.core.supabase_client import get_supabase
 
 # Initialize OpenAI client
 client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# Hybrid retrieval is precise enough to offer the LLM a shorter shortlist
+PROMPT_ACCOUNT_COUNT = 3
+# A top account this far ahead of the runner-up (fused score) is accepted without the LLM
+AUTO_ACCEPT_MARGIN = 0.25
+AUTO_ACCEPT_MIN_SCORE = 0.6
+# BM25 is normalised per query, so one shared keyword can carry the fused score on
+# its own; the raw cosine similarity must also show a genuine semantic match
+AUTO_ACCEPT_MIN_SIMILARITY = 0.5
+
 class ConfidenceLevel(str, Enum):
     HIGH = "HIGH"
     MEDIUM = "MEDIUM"
@@ -67,23 +78,11 @@ async def search_chart_of_accounts(
         embedding = await get_embedding(query_text)  # Default embedding for other types
     
     try:
-        supabase = await get_supabase()
-        # Get results from RPC
-        response = await supabase.rpc(
-            'search_account_embeddings',
-            {
-                'query_embedding': embedding,
-                'user_id': user_id, 
-                'embedding_column': embedding_column,
-                'similarity_threshold': similarity_threshold,
-                'match_count': match_count
-            }
-        ).execute()
-        
-
-        return response.data
+        # Score against the cached per-user index instead of an RPC round-trip
+        index = await get_coa_index(user_id, embedding_column)
+        return index.search(embedding, match_count, similarity_threshold)
     except Exception as e:
-        raise Exception(f"Error calling search_account_embeddings: {str(e)}")
+        raise Exception(f"Error searching chart of accounts index: {str(e)}")
 
 async def save_account_match(transaction_id: str, account_match: dict) -> None:
     """Save the selected account match back to Supabase"""
@@ -106,14 +105,18 @@ async def save_account_match(transaction_id: str, account_match: dict) -> None:
     except Exception as e:
         print(f"❌ Error saving account match: {str(e)}")
 
-async def prepare_transaction_batch(transactions: List[dict]) -> List[TransactionBatch]:
+async def prepare_transaction_batch(
+    transactions: List[dict],
+    account_count: int = PROMPT_ACCOUNT_COUNT
+) -> List[TransactionBatch]:
     """Prepare transactions for batch processing"""
     batches = []
     print("\n📦 Preparing transaction batch...")
 
+    parsed = []
     for tx in transactions:
         try:
-            if not tx.get('llm_category'):
+            if not tx.get('llm_category') or not tx.get('user_id'):
                 continue
 
             # Parse LLM category
@@ -121,22 +124,37 @@ async def prepare_transaction_batch(transactions: List[dict]) -> List[Transactio
             category = llm_data.get('category')
             if not category:
                 continue
+            parsed.append((tx, category))
+        except Exception as e:
+            print(f"❌ Error preparing transaction {tx['id']}: {str(e)}")
+            continue
+
+    if not parsed:
+        return batches
 
+    # Embed each distinct category once, then rank accounts against each user's own chart
+    categories = list(dict.fromkeys(category for _, category in parsed))
+    embedding_by_category = dict(zip(categories, await get_voyage_embeddings(categories, "query")))
+    categories_by_user = defaultdict(dict)
+    for tx, category in parsed:
+        categories_by_user[tx['user_id']][category] = embedding_by_category[category]
+
+    ranked = {}
+    for user_id, user_categories in categories_by_user.items():
+        index = await get_coa_index(user_id, 'voyage_embeddings')
+        names = list(user_categories)
+        matches = index.hybrid_search_many(names, list(user_categories.values()), account_count)
+        ranked.update({(user_id, name): results for name, results in zip(names, matches)})
+
+    for tx, category in parsed:
+        try:
             entity_name = (
                 tx.get('creditor_name', 'Unknown Entity') if tx['amount'] > 0 
                 else tx.get('debtor_name', 'Unknown Entity')
             )
             remittance_info = tx.get('remittance_info', '')
 
-            # Get similar accounts
-            results = await search_chart_of_accounts(
-                embedding_column='voyage_embeddings',
-                query_text=category,
-                user_id='ALL',
-                similarity_threshold=0.3,
-                match_count=5
-            )
-
+            results = ranked.get((tx['user_id'], category))
             if not results:
                 continue
 
@@ -149,7 +167,8 @@ async def prepare_transaction_batch(transactions: List[dict]) -> List[Transactio
                     'code': match['account_code'],
                     'account_id': match['account_id'],
                     'type': match['account_type'],
-                    'similarity': similarity_percentage
+                    'similarity': similarity_percentage,
+                    'score': match['score']
                 }
                 accounts_context.append(account_info)
 
@@ -173,6 +192,30 @@ async def prepare_transaction_batch(transactions: List[dict]) -> List[Transactio
 
     return batches
 
+def auto_accept_match(tx_batch: TransactionBatch) -> Dict | None:
+    """Return the top account when retrieval alone is decisive, otherwise None"""
+    accounts = tx_batch.potential_accounts
+    if not accounts:
+        return None
+    scores = [acc['score'] for acc in accounts]
+    if scores[0] < AUTO_ACCEPT_MIN_SCORE or score_margin(scores) < AUTO_ACCEPT_MARGIN:
+        return None
+    # 'similarity' is stored as a percentage in the prompt context
+    if accounts[0]['similarity'] / 100 < AUTO_ACCEPT_MIN_SIMILARITY:
+        return None
+
+    best = accounts[0]
+    return {
+        'transaction_id': tx_batch.transaction_id,
+        'account_match': {
+            'name': best['name'],
+            'account_id': best['account_id'],
+            'code': best['code'],
+            'confidence': ConfidenceLevel.HIGH,
+            'reason': f"Hybrid retrieval match (score {scores[0]:.2f}, margin {score_margin(scores):.2f})"
+        }
+    }
+
 def format_llm_prompt(transaction: dict, accounts: List[dict]) -> str:
     """Format prompt for LLM"""
     accounts_text = "\n".join([
@@ -211,8 +254,18 @@ async def process_batch(batch: List[TransactionBatch], batch_size: int = 5) -> L
     """Process a batch of transactions with rate limiting"""
     results = []
     
+    # Skip the LLM for transactions whose best account clearly wins retrieval
+    llm_batch = []
+    for tx_batch in batch:
+        auto_match = auto_accept_match(tx_batch)
+        if auto_match:
+            results.append(auto_match)
+        else:
+            llm_batch.append(tx_batch)
+    print(f"\n⚡ {len(results)} matches accepted from retrieval, {len(llm_batch)} sent to the LLM")
+    
     # Process in smaller chunks to avoid rate limits
-    for chunk in chunks(batch, batch_size):
+    for chunk in chunks(llm_batch, batch_size):
         chunk_tasks = []
         for tx_batch in chunk:
             task = client.beta.chat.completions.parse(
@@ -256,8 +309,8 @@ async def process_batch(batch: List[TransactionBatch], batch_size: int = 5) -> L
 
             except Exception as e:
                 print(f"❌ Error processing transaction {tx_batch.transaction_id}: {str(e)}")
-                # Fallback to highest similarity match
-                best_match = max(tx_batch.potential_accounts, key=lambda x: x['similarity'])
+                # Fallback to highest hybrid score match
+                best_match = max(tx_batch.potential_accounts, key=lambda x: x['score'])
                 results.append({
                     'transaction_id': tx_batch.transaction_id,
                     'account_match': {
@@ -296,6 +349,7 @@ async def search_transactions_categories() -> None:
         response = await supabase.table('gocardless_transactions') \
             .select('''
                 id, 
+                user_id,
                 llm_category,
                 amount,
                 creditor_name,
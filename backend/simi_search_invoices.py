@@ -1,7 +1,12 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 import asyncio
+import time
+
+import numpy as np
 
 from app.services.etl.vectorise_data import get_embedding, get_voyage_embedding
+from app.services.hybrid_search import DEFAULT_VECTOR_WEIGHT, BM25Index, fuse_scores, top_k
+from app.services.invoice_matcher import select_all
 from backend.app.core.supabase_client import get_supabase
 
 async def init_supabase():
@@ -61,6 +66,110 @@ async def search_invoices(
     except Exception as e:
         raise Exception(f"Error calling search_invoices: {str(e)}")
 
+# Keyword indexes per client, rebuilt after this many seconds
+KEYWORD_INDEX_TTL_SECONDS = 300
+_keyword_indexes: Dict[Optional[str], Tuple[float, List[dict], BM25Index]] = {}
+
+def invoice_search_text(results: Dict[str, Any]) -> str:
+    """Flatten the invoice fields worth keyword-matching into one string"""
+    results = results or {}
+    invoice_from = results.get('invoice_from') or {}
+    invoice_to = results.get('invoice_to') or {}
+    dates = results.get('date') or {}
+    amount = results.get('amount') or {}
+    line_items = (results.get('line_items') or {}).get('items') or []
+    parts = [
+        invoice_from.get('name'),
+        invoice_from.get('vat_number'),
+        invoice_to.get('name'),
+        invoice_to.get('reference'),
+        amount.get('total'),
+        amount.get('currency'),
+        dates.get('issue_date'),
+        dates.get('due_date'),
+        *(item.get('description') for item in line_items),
+        results.get('ai_description'),
+    ]
+    return ' '.join(str(part) for part in parts if part)
+
+async def get_invoice_keyword_index(client_id: str = None) -> Tuple[List[dict], BM25Index]:
+    """Load invoices for a client (or all clients) and build a BM25 index over their fields"""
+    cached = _keyword_indexes.get(client_id)
+    if cached and time.monotonic() - cached[0] < KEYWORD_INDEX_TTL_SECONDS:
+        return cached[1], cached[2]
+
+    supabase = await init_supabase()
+
+    def invoices_query():
+        query = supabase.table('invoices').select('id, client_id, status, source_file, created_at, results')
+        return query.eq('client_id', client_id) if client_id else query
+
+    # Paged so invoices past PostgREST's max-rows still get a keyword score
+    invoices = await select_all(invoices_query, 'id')
+    index = BM25Index([invoice_search_text(invoice.get('results')) for invoice in invoices])
+    _keyword_indexes[client_id] = (time.monotonic(), invoices, index)
+    return invoices, index
+
+async def hybrid_search_invoices(
+    query_text: str,
+    client_id: str = None,
+    match_count: int = 10,
+    embedding_column: str = 'voyage_embeddings',
+    vector_weight: float = DEFAULT_VECTOR_WEIGHT,
+) -> List[Dict[Any, Any]]:
+    """
+    Search invoices by fusing vector similarity with BM25 over invoice fields.
+
+    Vector candidates come from the search_invoices RPC without a similarity
+    threshold; invoices that only match on keywords (supplier name, reference,
+    totals) can still rank, so no hand-tuned cut-off is needed.
+
+    Returns:
+        Invoices shaped like search_invoices rows with 'similarity',
+        'keyword_score' and the fused 'score', best first
+    """
+    vector_matches, (invoices, keyword_index) = await asyncio.gather(
+        search_invoices(
+            embedding_column=embedding_column,
+            query_text=query_text,
+            client_id=client_id,
+            match_count=max(match_count * 5, 50),
+            similarity_threshold=0.0,
+        ),
+        get_invoice_keyword_index(client_id),
+    )
+    if not invoices:
+        return []
+
+    position_by_id = {invoice['id']: position for position, invoice in enumerate(invoices)}
+    vector_scores = np.zeros(len(invoices), dtype=np.float32)
+    for match in vector_matches or []:
+        position = position_by_id.get(match.get('invoice_id'))
+        if position is not None:
+            vector_scores[position] = match.get('similarity') or 0.0
+
+    keyword_scores = keyword_index.scores(query_text)
+    fused = fuse_scores(vector_scores, keyword_scores, vector_weight)[0]
+    indices, scores = top_k(fused, match_count)
+
+    results = []
+    for position, score in zip(indices[0].tolist(), scores[0].tolist()):
+        if score <= 0:
+            continue
+        invoice = invoices[position]
+        results.append({
+            'invoice_id': invoice['id'],
+            'client_id': invoice.get('client_id'),
+            'status': invoice.get('status'),
+            'source_file': invoice.get('source_file'),
+            'created_at': invoice.get('created_at'),
+            'results': invoice.get('results'),
+            'similarity': float(vector_scores[position]),
+            'keyword_score': float(keyword_scores[position]),
+            'score': score,
+        })
+    return results
+
 async def main():
     # Test queries
     queries = ["""
@@ -0,0 +1,20 @@
+-- Shared web-search context per counterparty, read by llm_categorise.
+--
+-- Keyed by the normalised entity name (see entity_context.normalize_entity),
+-- so "DIGITALOCEAN.COM" and "DigitalOcean LLC" share one row, and rows are
+-- not per user: a vendor looked up for one customer is reused for all.
+-- Searches that found nothing are stored with an empty context (is_empty) and
+-- a shorter expiry, so they are retried eventually but not on every run.
+--
+-- Apply once in the Supabase SQL editor.
+
+create table if not exists entity_contexts (
+    entity_key   text        primary key,
+    entity_name  text        not null,
+    context      text        not null default '',
+    is_empty     boolean     not null default false,
+    fetched_at   timestamptz not null default now(),
+    expires_at   timestamptz not null
+);
+
+create index if not exists entity_contexts_expires_at_idx on entity_contexts (expires_at);
@@ -0,0 +1,134 @@
+-- Per-user, per-month spending rollups behind GET /transactions/insights.
+--
+-- A trigger on gocardless_transactions keeps the rollups current as rows are
+-- ingested, enriched (ntropy_enrich), categorised (llm_category) or edited, so
+-- insights read a few hundred pre-summed rows instead of the full history.
+-- Amounts are stored as raw sums in minor units; the API divides by 100.
+--
+-- Apply once in the Supabase SQL editor, then backfill existing users with
+--   select rebuild_insight_rollups(user_id) from (select distinct user_id from gocardless_transactions) u;
+
+create table if not exists insight_rollups (
+    user_id    text    not null,
+    month      date    not null,
+    dimension  text    not null check (dimension in ('category', 'entity')),
+    key        text    not null,
+    amount     numeric not null default 0,
+    tx_count   integer not null default 0,
+    primary key (user_id, dimension, month, key)
+);
+
+-- Category as written by llm_categorise: {"category": ...} or a bare string
+create or replace function insight_category(llm_category jsonb)
+returns text
+language sql
+immutable
+as $$
+    select case jsonb_typeof(llm_category)
+        when 'object' then llm_category ->> 'category'
+        when 'string' then llm_category #>> '{}'
+    end
+$$;
+
+create or replace function insight_month(booking_date timestamptz, created_at timestamptz)
+returns date
+language sql
+immutable
+as $$
+    select date_trunc('month', coalesce(booking_date, created_at))::date
+$$;
+
+create or replace function apply_insight_delta(
+    p_user_id text, p_month date, p_dimension text, p_key text, p_amount numeric, p_count integer
+)
+returns void
+language plpgsql
+as $$
+begin
+    if p_key is null or p_key = '' then
+        return;
+    end if;
+    insert into insight_rollups as r (user_id, month, dimension, key, amount, tx_count)
+    values (p_user_id, p_month, p_dimension, p_key, p_amount, p_count)
+    on conflict (user_id, dimension, month, key) do update
+        set amount = r.amount + excluded.amount,
+            tx_count = r.tx_count + excluded.tx_count;
+    delete from insight_rollups
+    where user_id = p_user_id and dimension = p_dimension and month = p_month and key = p_key
+      and tx_count <= 0;
+end
+$$;
+
+-- Only enriched transactions count, matching the ntropy_transactions inner join
+-- the insights endpoint used before the rollups existed. The entity is Ntropy's
+-- counterparty, falling back to the bank's creditor/debtor name.
+create or replace function maintain_insight_rollups()
+returns trigger
+language plpgsql
+as $$
+declare
+    old_month date;
+    new_month date;
+    counterparty text;
+begin
+    if tg_op in ('UPDATE', 'DELETE') and coalesce(old.ntropy_enrich, false) then
+        old_month := insight_month(old.booking_date, old.created_at);
+        perform apply_insight_delta(old.user_id, old_month, 'category',
+            insight_category(old.llm_category), -coalesce(old.amount, 0), -1);
+        select n.enriched_data #>> '{entities,counterparty,name}' into counterparty
+        from ntropy_transactions n where n.ntropy_id = old.id limit 1;
+        perform apply_insight_delta(old.user_id, old_month, 'entity',
+            coalesce(counterparty, old.creditor_name, old.debtor_name), -coalesce(old.amount, 0), -1);
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') and coalesce(new.ntropy_enrich, false) then
+        new_month := insight_month(new.booking_date, new.created_at);
+        perform apply_insight_delta(new.user_id, new_month, 'category',
+            insight_category(new.llm_category), coalesce(new.amount, 0), 1);
+        select n.enriched_data #>> '{entities,counterparty,name}' into counterparty
+        from ntropy_transactions n where n.ntropy_id = new.id limit 1;
+        perform apply_insight_delta(new.user_id, new_month, 'entity',
+            coalesce(counterparty, new.creditor_name, new.debtor_name), coalesce(new.amount, 0), 1);
+    end if;
+    return null;
+end
+$$;
+
+drop trigger if exists gocardless_transactions_insight_rollups on gocardless_transactions;
+create trigger gocardless_transactions_insight_rollups
+after insert or delete or update of user_id, amount, booking_date, ntropy_enrich, llm_category, creditor_name, debtor_name
+on gocardless_transactions
+for each row execute function maintain_insight_rollups();
+
+-- Recompute a user's rollups from scratch (backfill, or repair after a bulk load
+-- that bypassed the trigger)
+create or replace function rebuild_insight_rollups(p_user_id text)
+returns integer
+language plpgsql
+as $$
+declare
+    inserted integer;
+begin
+    delete from insight_rollups where user_id = p_user_id;
+
+    insert into insight_rollups (user_id, month, dimension, key, amount, tx_count)
+    select user_id, month, dimension, key, sum(amount), count(*)
+    from (
+        select user_id, insight_month(booking_date, created_at) as month,
+               'category' as dimension, insight_category(llm_category) as key, coalesce(amount, 0) as amount
+        from gocardless_transactions
+        where user_id = p_user_id and ntropy_enrich
+        union all
+        select t.user_id, insight_month(t.booking_date, t.created_at),
+               'entity', coalesce(n.enriched_data #>> '{entities,counterparty,name}', t.creditor_name, t.debtor_name),
+               coalesce(t.amount, 0)
+        from gocardless_transactions t
+        left join ntropy_transactions n on n.ntropy_id = t.id
+        where t.user_id = p_user_id and t.ntropy_enrich
+    ) contributions
+    where key is not null and key <> ''
+    group by user_id, month, dimension, key;
+
+    get diagnostics inserted = row_count;
+    return inserted;
+end
+$$;
@@ -0,0 +1,25 @@
+-- Per-file status of invoice ingestion runs (extract_invoice_data.py), so a
+-- backfill can be stopped and restarted without redoing finished files.
+--
+-- Keyed by client and the SHA-256 of the PDF, so the same attachment saved
+-- twice or renamed is only extracted once. Failed files keep their error and
+-- are retried by later runs up to a maximum number of attempts.
+-- invoice_ids are the rows written to invoices. They are derived from the
+-- client, file hash and page number, so re-running a file after a crash
+-- overwrites its invoices instead of duplicating them, even if a different
+-- page fails to extract this time.
+--
+-- Apply once in the Supabase SQL editor.
+
+create table if not exists invoice_ingestion_files (
+    client_id      text        not null,
+    file_hash      text        not null,
+    file_name      text        not null,
+    status         text        not null check (status in ('done', 'failed')),
+    invoice_count  integer     not null default 0,
+    invoice_ids    text[]      not null default '{}',
+    attempts       integer     not null default 0,
+    error          text,
+    updated_at     timestamptz not null default now(),
+    primary key (client_id, file_hash)
+);
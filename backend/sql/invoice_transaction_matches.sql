@@ -0,0 +1,24 @@
+-- Links between invoices and the bank transactions that paid them, written by
+-- app.services.invoice_matcher.match_open_invoices.
+--
+-- An invoice or transaction with a row here is no longer open for matching.
+-- Scores are in [0, 1]; amount_difference is invoice minus transaction in
+-- pence, so bank fees and FX rounding can be reviewed.
+--
+-- Apply once in the Supabase SQL editor.
+
+create table if not exists invoice_transaction_matches (
+    invoice_id         text        primary key,
+    transaction_id     text        not null unique,
+    user_id            text        not null,
+    client_id          text,
+    score              real        not null,
+    amount_score       real        not null,
+    name_score         real        not null,
+    date_score         real        not null,
+    amount_difference  bigint      not null default 0,
+    matched_at         timestamptz not null default now()
+);
+
+create index if not exists invoice_transaction_matches_user_idx on invoice_transaction_matches (user_id);
+create index if not exists invoice_transaction_matches_client_idx on invoice_transaction_matches (client_id);
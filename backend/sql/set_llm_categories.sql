@@ -0,0 +1,20 @@
+-- Batch write of llm_categorise results: one round trip per batch instead of
+-- a select and an update per transaction.
+--
+--   select set_llm_categories('[{"id": "...", "llm_category": {...}}, ...]');
+--
+-- Returns the ids that were updated; ids with no matching row are skipped.
+--
+-- Apply once in the Supabase SQL editor. Until it exists llm_categorise falls
+-- back to updating rows one at a time.
+
+create or replace function set_llm_categories(updates jsonb)
+returns setof text
+language sql
+as $$
+    update gocardless_transactions t
+    set llm_category = u.llm_category
+    from jsonb_to_recordset(updates) as u(id text, llm_category jsonb)
+    where t.id = u.id
+    returning t.id
+$$;
@@ -0,0 +1,13 @@
+-- Index behind keyset pagination of gocardless_transactions
+-- (app.services.transactions: GET /transactions/cursor and exports).
+--
+-- Pages are read with user_id = ? ordered by created_at desc, id desc,
+-- starting after the previous page's (created_at, id). With this index each
+-- page is a short range scan, so page latency stays flat however deep the
+-- cursor is, instead of sorting the user's whole history per request.
+--
+-- Apply once in the Supabase SQL editor. On a large table, run it on its
+-- own as "create index concurrently" to avoid blocking ingestion writes.
+
+create index if not exists gocardless_transactions_user_created_id_idx
+    on gocardless_transactions (user_id, created_at desc, id desc);
@@ -0,0 +1,26 @@
+-- Webhook events claimed by app.services.webhook_queue workers.
+--
+-- The first delivery of an event inserts its row; redeliveries (sender
+-- retries, or the same event reaching another process) find the row and are
+-- skipped. status moves from processing to done, or to failed once the
+-- retries are used up, with the last error kept for inspection.
+-- A row left in processing longer than WEBHOOK_CLAIM_LEASE_SECONDS (a worker
+-- cancelled at shutdown, or a crashed process) is claimed again by the next
+-- redelivery.
+--
+-- Apply once in the Supabase SQL editor. Until it exists, deduplication is
+-- per process only.
+
+create table if not exists webhook_events (
+    event_key    text        primary key,
+    source       text        not null,
+    event_type   text,
+    status       text        not null default 'processing'
+                             check (status in ('processing', 'done', 'failed')),
+    attempts     integer     not null default 0,
+    error        text,
+    received_at  timestamptz not null default now(),
+    updated_at   timestamptz not null default now()
+);
+
+create index if not exists webhook_events_received_at_idx on webhook_events (received_at);